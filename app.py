@@ -1,6 +1,5 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file, abort, make_response
-from flask_mysqldb import MySQL
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file, abort, make_response, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import BadRequest, HTTPException
@@ -10,24 +9,28 @@ from datetime import datetime, timedelta
 import uuid
 from functools import wraps
 from config import config
+from db_pool import MySQL
+from events import EventBroker
+from pdf_cache import FileCache, content_key
+from images import ImageDerivatives, derived_key, MANIFEST
+from drawings import DrawingStore, validate_strokes, PNG_SIGNATURE
+from progress_buffer import ProgressBuffer, ProgressEntry
+from item_analysis import analyze_quiz, AnalysisCache
+from jobs import JobQueue, PRIORITY_INTERACTIVE, PRIORITY_DEFAULT, PRIORITY_BULK
+from metrics import MetricsRegistry, instrumented_cursor, start_request, end_request
+from uploads import UploadStore, UploadConflict, UPLOAD_PURPOSES
+from blobs import BlobStore
+from media import MediaStore
+from storage import LocalStorage, S3Storage
 import time
 import math
-import io
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle, PageBreak
-from reportlab.lib.units import inch, cm
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT, TA_JUSTIFY
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import tempfile
-from PIL import Image as PILImage
 import random
 import re
 import logging
 import traceback
+import threading
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 
 
 # # Import the StudentDrawing model
@@ -45,15 +48,24 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# Initialize MySQL
+# Initialize MySQL (pooled, see db_pool.py)
 mysql = MySQL(app)
 
+# Per-request latency and SQL metrics for /metrics (see metrics.py); nothing
+# is installed unless METRICS_ENABLED is set
+metrics = None
+if app.config['METRICS_ENABLED']:
+    metrics = MetricsRegistry(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+    mysql.use_cursorclass(instrumented_cursor(mysql.cursorclass))
+    app.extensions['metrics'] = metrics
+
+# Chat push events, shared between gunicorn workers (see events.py)
+event_broker = EventBroker(app.config['EVENTS_SPOOL_DIR'])
+
 # Test database connection
 def test_db_connection():
     try:
-        cur = mysql.connection.cursor()
-        cur.execute("SELECT 1")
-        cur.close()
+        mysql.connection.ping()
         logger.info("Database connection successful")
     except Exception as e:
         logger.error(f"Database connection failed: {str(e)}")
@@ -65,6 +77,113 @@ os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'), exist_ok=True
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'stories'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'chat'), exist_ok=True)
 
+# Uploaded files live in UPLOAD_FOLDER or, so several app nodes can share them,
+# in an S3-compatible bucket (see storage.py). UPLOAD_FOLDER stays the local
+# staging area for files being received either way.
+if app.config['STORAGE_BACKEND'] == 's3':
+    storage = S3Storage(app.config['S3_BUCKET'],
+                        prefix=app.config['S3_PREFIX'],
+                        endpoint_url=app.config['S3_ENDPOINT_URL'],
+                        region=app.config['S3_REGION'],
+                        access_key=app.config['S3_ACCESS_KEY'],
+                        secret_key=app.config['S3_SECRET_KEY'],
+                        public_url=app.config['S3_PUBLIC_URL'],
+                        url_expiry=app.config['S3_URL_EXPIRY'],
+                        cache_dir=app.config['STORAGE_CACHE_DIR'],
+                        cache_max_bytes=app.config['STORAGE_CACHE_MAX_MB'] * 1024 * 1024)
+elif app.config['STORAGE_BACKEND'] == 'local':
+    storage = LocalStorage(app.config['UPLOAD_FOLDER'])
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND: {app.config['STORAGE_BACKEND']}")
+
+# Uploaded files are served by /media with content-hash URLs and ETags (see media.py)
+media_store = MediaStore(storage,
+                         offload=app.config['MEDIA_OFFLOAD'],
+                         accel_prefix=app.config['MEDIA_ACCEL_PREFIX'])
+if app.config['MEDIA_OFFLOAD'] == 'x-sendfile':
+    app.config['USE_X_SENDFILE'] = True
+
+# Resized/recompressed variants of uploaded images, built in the background (see images.py)
+image_derivatives = ImageDerivatives(storage, app.static_folder, app.config['IMAGE_WORKERS'],
+                                     url_builder=media_store.url)
+
+# Students' private drawings: PNG snapshots and stroke logs (see drawings.py)
+drawing_store = DrawingStore(app.config['DRAWINGS_FOLDER'])
+
+# Uploaded files are stored once per content hash and deleted by gc_blobs.py
+# when nothing refers to them any more (see blobs.py)
+blob_store = BlobStore(storage, app.config['UPLOAD_FOLDER'], grace_hours=app.config['BLOB_GC_GRACE_HOURS'])
+
+# Resumable chunked uploads of story media (see uploads.py)
+upload_store = UploadStore(app.config['UPLOAD_FOLDER'], blob_store,
+                           chunk_size=app.config['UPLOAD_CHUNK_BYTES'],
+                           max_bytes=app.config['UPLOAD_MAX_BYTES'],
+                           session_hours=app.config['UPLOAD_SESSION_HOURS'])
+
+# Durable background jobs, run by job_worker.py processes (see jobs.py). Call
+# sites only enqueue when JOB_QUEUE_ENABLED is set; otherwise they keep using
+# this process's thread pools.
+job_queue = JobQueue(max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+                     retry_delay=app.config['JOB_RETRY_DELAY'],
+                     lease_seconds=app.config['JOB_LEASE_SECONDS'],
+                     retention_days=app.config['JOB_RETENTION_DAYS'])
+app.extensions['job_queue'] = job_queue
+
+def enqueue_job(kind, payload, priority=PRIORITY_DEFAULT, dedupe_key=None):
+    """Queue a job in its own transaction (never the caller's) and return its id"""
+    created_by = session.get('user_id') if has_request_context() else None
+    with app.app_context():
+        cur = mysql.connection.cursor()
+        try:
+            job_id = job_queue.enqueue(cur, kind, payload, priority=priority,
+                                       dedupe_key=dedupe_key, created_by=created_by)
+            mysql.connection.commit()
+            return job_id
+        except Exception:
+            mysql.connection.rollback()
+            raise
+        finally:
+            cur.close()
+
+@job_queue.handler('image_derivatives')
+def image_derivatives_job(folder, filename):
+    if not storage.exists(f'{folder}/{filename}'):
+        return {'built': False}
+    if image_derivatives.build(folder, filename) is None:
+        raise RuntimeError(f"Could not build image derivatives for {folder}/{filename}")
+    return {'built': True}
+
+def dispatch_image_derivatives(folder, filename):
+    """Hand a derivative build to the job queue; False falls back to the local thread pool"""
+    try:
+        enqueue_job('image_derivatives', {'folder': folder, 'filename': filename},
+                    priority=PRIORITY_BULK, dedupe_key=f'image_derivatives:{folder}/{filename}')
+        return True
+    except Exception as e:
+        logger.error(f"Could not queue image derivatives for {folder}/{filename}: {str(e)}")
+        return False
+
+if app.config['JOB_QUEUE_ENABLED']:
+    image_derivatives.dispatch = dispatch_image_derivatives
+
+@app.context_processor
+def inject_image_variants():
+    """Templates: {% set img = image_variants('stories', story.cover_image) %}"""
+    return {'image_variants': image_derivatives.variants}
+
+@app.template_global()
+def media_url(folder, filename):
+    """Fingerprinted /media URL of an uploaded file: {{ media_url('profiles', student.profile_photo) }}"""
+    return media_store.url(f'{folder}/{filename}')
+
+@app.route('/media/v/<fingerprint>/<path:filename>')
+def serve_fingerprinted_media(fingerprint, filename):
+    return media_store.send(filename, fingerprint)
+
+@app.route('/media/<path:filename>')
+def serve_media(filename):
+    return media_store.send(filename)
+
 
 # Helper functions
 def allowed_file(filename, file_type='image'):
@@ -87,54 +206,119 @@ def allowed_file(filename, file_type='image'):
 #     return None
 
 def save_file(file, folder, file_type='image'):
+    """Store an upload under its content hash (see blobs.py); returns the file name.
+
+    The blob row is committed in its own transaction; the caller records the
+    reference with blob_store.set_refs() alongside the row that uses the file.
+    """
     if file and allowed_file(file.filename, file_type):
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        filepath = os.path.join(folder, unique_filename)
-        file.save(filepath)
-        return unique_filename
+        folder = os.path.relpath(folder, app.config['UPLOAD_FOLDER'])
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            try:
+                filename, duplicate = blob_store.save(cur, folder, file.stream, file.filename)
+                mysql.connection.commit()
+            except Exception:
+                mysql.connection.rollback()
+                raise
+            finally:
+                cur.close()
+        # A duplicate's derivatives were built when it was first stored
+        if file_type == 'image' and not duplicate:
+            image_derivatives.schedule(folder, filename)
+        return filename
     return None
 
-def get_student_id():
-    if 'user_id' in session and session.get('user_type') == 'student':
+def resolve_role_identity(user_id, user_type):
+    """Look up the students/teachers row behind a user account (id and class level)"""
+    table = 'students' if user_type == 'student' else 'teachers'
+    columns = 'id, class_level' if user_type == 'student' else 'id'
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute(f"SELECT {columns} FROM {table} WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    if not row:
+        return None
+    return {'id': row['id'], 'class_level': row.get('class_level')}
+
+def store_role_identity(identity):
+    """Cache the resolved role identity in the signed session cookie"""
+    session[f"{session['user_type']}_id"] = identity['id']
+    session['class_level'] = identity['class_level']
+    session.modified = True
+
+def load_role_identity():
+    """Populate g.student_id / g.teacher_id / g.class_level for this request.
+
+    The ids are resolved once at login and carried in the session; sessions
+    created before that (or by other means) are resolved here once and cached.
+    """
+    if g.get('role_identity_loaded'):
+        return
+    user_type = session.get('user_type')
+    key = f'{user_type}_id'
+    if 'user_id' in session and user_type in ('student', 'teacher') and session.get(key) is None:
         try:
-            cur = mysql.connection.cursor()
-            cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-            student = cur.fetchone()
-            cur.close()
-            return student['id'] if student else None
+            identity = resolve_role_identity(session['user_id'], user_type)
+            if identity:
+                store_role_identity(identity)
         except Exception as e:
-            logger.error(f"Error getting student ID: {str(e)}")
-            return None
+            logger.error(f"Error resolving {user_type} identity: {str(e)}")
+    g.student_id = session.get('student_id') if user_type == 'student' else None
+    g.teacher_id = session.get('teacher_id') if user_type == 'teacher' else None
+    g.class_level = session.get('class_level')
+    g.role_identity_loaded = True
+
+def get_student_id():
+    if 'user_id' in session and session.get('user_type') == 'student':
+        load_role_identity()
+        return g.student_id
     return None
 
 def get_teacher_id():
     if 'user_id' in session and session.get('user_type') == 'teacher':
-        try:
-            cur = mysql.connection.cursor()
-            cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-            teacher = cur.fetchone()
-            cur.close()
-            return teacher['id'] if teacher else None
-        except Exception as e:
-            logger.error(f"Error getting teacher ID: {str(e)}")
-            return None
+        load_role_identity()
+        return g.teacher_id
     return None
 
 def check_db_connection():
-    """Check if database connection is alive, reconnect if needed"""
+    """Check if database connection is alive (the pool already pings stale connections on checkout)"""
     try:
         if mysql.connection is None:
             logger.warning("Database connection is None, reinitializing")
             return False
-        cur = mysql.connection.cursor()
-        cur.execute("SELECT 1")
-        cur.close()
+        mysql.connection.ping()
         return True
     except Exception as e:
         logger.error(f"Database connection check failed: {str(e)}")
         return False
 
+QUERY_BATCH_SIZE = 500  # ids per IN (...) list
+
+def fetch_rows_by_ids(cur, sql, ids, key=None, many=False, args=(), batch_size=QUERY_BATCH_SIZE):
+    """Run `sql` once per batch of ids instead of once per id.
+
+    `sql` contains {ids} where the IN list goes, e.g. "... WHERE story_page_id IN ({ids})";
+    `args` are bound before the ids. Returns the rows as a list, or with `key` a dict
+    of row[key] -> row (-> list of rows when many=True).
+    """
+    ids = list(dict.fromkeys(ids))
+    rows = []
+    for start in range(0, len(ids), batch_size):
+        chunk = ids[start:start + batch_size]
+        cur.execute(sql.format(ids=', '.join(['%s'] * len(chunk))), tuple(args) + tuple(chunk))
+        rows.extend(cur.fetchall())
+    if key is None:
+        return rows
+    if many:
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row[key], []).append(row)
+        return grouped
+    return {row[key]: row for row in rows}
+
 def api_error_handler(f):
     """Decorator for API endpoints to handle errors consistently"""
     @wraps(f)
@@ -178,6 +362,7 @@ def teacher_required(f):
         if session.get('user_type') != 'teacher':
             flash('Access denied. Teacher privileges required.', 'danger')
             return redirect(url_for('student_dashboard'))
+        load_role_identity()
         return f(*args, **kwargs)
     return decorated_function
 
@@ -188,6 +373,7 @@ def student_required(f):
         if session.get('user_type') != 'student':
             flash('Access denied. Student privileges required.', 'danger')
             return redirect(url_for('teacher_dashboard'))
+        load_role_identity()
         return f(*args, **kwargs)
     return decorated_function
 
@@ -246,11 +432,20 @@ def login():
             
             # Set session data
             session.permanent = True
+            for key in ('student_id', 'teacher_id', 'class_level'):
+                session.pop(key, None)
             session['user_id'] = user['id']
             session['email'] = user['email']
             session['user_type'] = user['user_type']
             session.modified = True
             
+            # Resolve the student/teacher id once so handlers never have to
+            identity = resolve_role_identity(user['id'], user['user_type'])
+            if identity:
+                store_role_identity(identity)
+            else:
+                logger.warning(f"No {user['user_type']} record found for user: {email}")
+            
             logger.info(f"Session created for user: {email}, Type: {user['user_type']}")
             
             # Update last login timestamp
@@ -384,6 +579,7 @@ def register_student():
                 """, (user_id, first_name, middle_name, last_name, date_of_birth, phone, address,
                       gender, class_level, roll_number, profile_photo, parent_full_name,
                       parent_email, parent_phone, parent_relationship))
+                blob_store.set_refs(cur, 'student_profile', [(cur.lastrowid, profile_photo)])
                 
                 mysql.connection.commit()
                 cur.close()
@@ -499,6 +695,7 @@ def register_teacher():
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """, (user_id, first_name, last_name, email, phone, date_of_birth, address,
                       gender, registration_number, profile_photo))
+                blob_store.set_refs(cur, 'teacher_profile', [(cur.lastrowid, profile_photo)])
                 
                 mysql.connection.commit()
                 cur.close()
@@ -535,67 +732,167 @@ def logout():
     return redirect(url_for('index'))
 
 # ================================= Student Drawing =========================================================
+# The canvas is stored as a PNG snapshot plus an append-only stroke log on disk
+# (see drawings.py); student_drawings only holds metadata. The client appends
+# vector strokes as they are drawn and uploads a fresh snapshot for raster edits
+# (fill, undo/redo), when the log grows large, or when the student presses Save.
+
+def lock_student_drawing(cur, story_id, student_id):
+    """Drawing row for (story, student), created if needed and locked FOR UPDATE"""
+    current_time = datetime.utcnow()
+    cur.execute("""
+        INSERT IGNORE INTO student_drawings (story_id, student_id, created_at, updated_at)
+        VALUES (%s, %s, %s, %s)
+    """, (story_id, student_id, current_time, current_time))
+    cur.execute("""
+        SELECT id, generation, has_snapshot, log_bytes, stroke_count
+        FROM student_drawings
+        WHERE story_id = %s AND student_id = %s
+        FOR UPDATE
+    """, (story_id, student_id))
+    return cur.fetchone()
+
+def student_drawing_etag(drawing):
+    return f"drawing-{drawing['id']}-{drawing['generation']}"
 
 @app.route('/api/save_student_drawing', methods=['POST'])
 @api_error_handler
 def save_student_drawing():
-    """Save student's private drawing to database"""
+    """Replace the student's drawing with a PNG snapshot (raw image/png body)"""
     cur = None
+    new_path = None
     try:
         logger.info("Save student drawing request received")
-        
+
+        story_id = request.args.get('story_id', type=int)
+        if not story_id:
+            logger.warning("Missing story_id parameter")
+            return jsonify({'success': False, 'error': 'Missing story_id'}), 400
+
+        if 'user_id' not in session:
+            logger.warning("User not logged in")
+            return jsonify({'success': False, 'error': 'Not logged in'}), 401
+
+        student_id = get_student_id()
+        if not student_id:
+            logger.warning(f"Student not found for user_id: {session['user_id']}")
+            return jsonify({'success': False, 'error': 'Student not found'}), 404
+
+        if request.content_length and request.content_length > app.config['DRAWING_MAX_BYTES']:
+            return jsonify({'success': False, 'error': 'Drawing is too large'}), 413
+
+        image_data = request.get_data(cache=False)
+        if not image_data.startswith(PNG_SIGNATURE):
+            logger.warning(f"Drawing upload is not a PNG for student {student_id}, story {story_id}")
+            return jsonify({'success': False, 'error': 'Drawing must be a PNG image'}), 400
+
+        cur = mysql.connection.cursor()
+        drawing = lock_student_drawing(cur, story_id, student_id)
+        generation = drawing['generation'] + 1
+
+        # The new file gets a new generation, so the committed one stays intact
+        new_path = drawing_store.write_snapshot(student_id, story_id, generation, image_data)
+        cur.execute("""
+            UPDATE student_drawings
+            SET generation = %s, has_snapshot = TRUE, log_bytes = 0, stroke_count = 0, updated_at = %s
+            WHERE id = %s
+        """, (generation, datetime.utcnow(), drawing['id']))
+        mysql.connection.commit()
+        new_path = None
+
+        drawing_store.discard_older_generations(student_id, story_id, generation)
+        logger.info(f"Saved drawing snapshot for student {student_id}, story {story_id} ({len(image_data)} bytes)")
+
+        return jsonify({'success': True, 'message': 'Drawing saved', 'generation': generation})
+
+    except Exception as e:
+        logger.error(f"Error saving drawing: {str(e)}")
+        logger.error(traceback.format_exc())
+        try:
+            mysql.connection.rollback()
+        except:
+            pass
+        if new_path:
+            try:
+                os.remove(new_path)
+            except OSError:
+                pass
+        return jsonify({'success': False, 'error': 'Failed to save drawing'}), 500
+    finally:
+        if cur:
+            try:
+                cur.close()
+            except:
+                pass
+
+@app.route('/api/append_student_drawing_strokes', methods=['POST'])
+@api_error_handler
+def append_student_drawing_strokes():
+    """Append new vector strokes to the student's drawing without resending the image"""
+    cur = None
+    try:
         data = request.get_json()
         if not data:
             logger.warning("No JSON data received")
             return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
-        
+
         story_id = data.get('story_id')
-        drawing_data = data.get('drawing_data')
-        
-        if not all([story_id, drawing_data]):
-            logger.warning(f"Missing fields: story_id={story_id}, has_drawing_data={bool(drawing_data)}")
+        generation = data.get('generation')
+        if not story_id or generation is None:
+            logger.warning(f"Missing fields: story_id={story_id}, generation={generation}")
             return jsonify({'success': False, 'error': 'Missing required fields'}), 400
-        
+
+        try:
+            strokes = validate_strokes(data.get('strokes'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid strokes: {str(e)}'}), 400
+
         if 'user_id' not in session:
             logger.warning("User not logged in")
             return jsonify({'success': False, 'error': 'Not logged in'}), 401
-        
-        cur = mysql.connection.cursor()
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        
-        if not student:
+
+        student_id = get_student_id()
+        if not student_id:
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify({'success': False, 'error': 'Student not found'}), 404
-            
-        student_id = student['id']
-        
-        # Check if drawing exists
-        cur.execute("SELECT id FROM student_drawings WHERE story_id = %s AND student_id = %s", 
-                   (story_id, student_id))
-        existing = cur.fetchone()
-        
-        current_time = datetime.utcnow()
-        
-        if existing:
-            cur.execute("UPDATE student_drawings SET drawing_data = %s, updated_at = %s WHERE id = %s",
-                       (drawing_data, current_time, existing['id']))
-            message = 'Drawing updated'
-            logger.info(f"Updated drawing for student {student_id}, story {story_id}")
-        else:
-            cur.execute("INSERT INTO student_drawings (story_id, student_id, drawing_data, created_at, updated_at) VALUES (%s, %s, %s, %s, %s)",
-                       (story_id, student_id, drawing_data, current_time, current_time))
-            message = 'Drawing saved'
-            logger.info(f"Saved new drawing for student {student_id}, story {story_id}")
-        
+
+        cur = mysql.connection.cursor()
+        drawing = lock_student_drawing(cur, story_id, student_id)
+
+        # Saved or cleared elsewhere (e.g. another tab): the client's strokes were
+        # drawn on a different base, so it has to send a full snapshot instead
+        if drawing['generation'] != generation:
+            mysql.connection.rollback()
+            return jsonify({
+                'success': False,
+                'error': 'Drawing changed since it was loaded',
+                'generation': drawing['generation']
+            }), 409
+
+        log_bytes = drawing_store.append_strokes(student_id, story_id, drawing['generation'],
+                                                 drawing['log_bytes'], strokes)
+        cur.execute("""
+            UPDATE student_drawings
+            SET log_bytes = %s, stroke_count = stroke_count + %s, updated_at = %s
+            WHERE id = %s
+        """, (log_bytes, len(strokes), datetime.utcnow(), drawing['id']))
         mysql.connection.commit()
-        logger.info(f"Drawing operation successful: {message}")
-        
-        return jsonify({'success': True, 'message': message})
-        
+
+        return jsonify({
+            'success': True,
+            'generation': drawing['generation'],
+            'stroke_count': drawing['stroke_count'] + len(strokes),
+            # Ask the client to fold the log into a new snapshot
+            'compact': log_bytes > app.config['DRAWING_LOG_COMPACT_BYTES']
+        })
+
     except Exception as e:
-        logger.error(f"Error saving drawing: {str(e)}")
+        logger.error(f"Error appending drawing strokes: {str(e)}")
         logger.error(traceback.format_exc())
+        try:
+            mysql.connection.rollback()
+        except:
+            pass
         return jsonify({'success': False, 'error': 'Failed to save drawing'}), 500
     finally:
         if cur:
@@ -607,42 +904,50 @@ def save_student_drawing():
 @app.route('/api/get_student_drawing', methods=['GET'])
 @api_error_handler
 def get_student_drawing():
-    """Get student's private drawing from database"""
+    """Drawing metadata: snapshot URL (if any) and the strokes drawn since it"""
     cur = None
     try:
         logger.info("Get student drawing request received")
-        
+
         story_id = request.args.get('story_id', type=int)
-        
+
         if not story_id:
             logger.warning("Missing story_id parameter")
             return jsonify({'success': False, 'error': 'Missing story_id'}), 400
-        
+
         if 'user_id' not in session:
             logger.warning("User not logged in")
             return jsonify({'success': False, 'error': 'Not logged in'}), 401
-        
-        cur = mysql.connection.cursor()
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        
-        if not student:
+
+        student_id = get_student_id()
+        if not student_id:
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify({'success': False, 'error': 'Student not found'}), 404
-            
-        student_id = student['id']
-        
-        cur.execute("SELECT drawing_data FROM student_drawings WHERE story_id = %s AND student_id = %s", 
-                   (story_id, student_id))
+
+        cur = mysql.connection.cursor()
+
+        cur.execute("""
+            SELECT id, generation, has_snapshot, log_bytes
+            FROM student_drawings
+            WHERE story_id = %s AND student_id = %s
+        """, (story_id, student_id))
         drawing = cur.fetchone()
-        
-        if drawing:
-            logger.info(f"Retrieved drawing for student {student_id}, story {story_id}")
-            return jsonify({'success': True, 'drawing_data': drawing['drawing_data']})
-        else:
+
+        if not drawing:
             logger.info(f"No drawing found for student {student_id}, story {story_id}")
-            return jsonify({'success': True, 'drawing_data': None})
-            
+            return jsonify({'success': True, 'generation': 0, 'image_url': None, 'strokes': []})
+
+        image_url = None
+        if drawing['has_snapshot']:
+            image_url = url_for('student_drawing_image', story_id=story_id, g=drawing['generation'])
+
+        return jsonify({
+            'success': True,
+            'generation': drawing['generation'],
+            'image_url': image_url,
+            'strokes': drawing_store.read_strokes(student_id, story_id, drawing['generation'], drawing['log_bytes'])
+        })
+
     except Exception as e:
         logger.error(f"Error getting drawing: {str(e)}")
         logger.error(traceback.format_exc())
@@ -654,78 +959,100 @@ def get_student_drawing():
             except:
                 pass
 
+@app.route('/api/student_drawing_image')
+@login_required
+def student_drawing_image():
+    """The student's drawing snapshot as image/png, with ETag/304 support"""
+    story_id = request.args.get('story_id', type=int)
+    student_id = get_student_id()
+    if not story_id or not student_id:
+        abort(404)
+
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute("""
+            SELECT id, generation, has_snapshot
+            FROM student_drawings
+            WHERE story_id = %s AND student_id = %s
+        """, (story_id, student_id))
+        drawing = cur.fetchone()
+    finally:
+        cur.close()
+
+    if not drawing or not drawing['has_snapshot']:
+        abort(404)
+
+    etag = student_drawing_etag(drawing)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    path = drawing_store.snapshot_path(student_id, story_id, drawing['generation'])
+    if not os.path.isfile(path):
+        logger.warning(f"Drawing snapshot missing for student {student_id}, story {story_id}")
+        abort(404)
+
+    response = send_file(path, mimetype='image/png', etag=etag, conditional=True, max_age=0)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/api/clear_student_drawing', methods=['POST'])
 @api_error_handler
 def clear_student_drawing():
-    """Clear student's drawing (save empty canvas)"""
+    """Clear student's drawing (metadata only: the row stops pointing at any files)"""
     cur = None
     try:
         logger.info("Clear student drawing request received")
-        
+
         data = request.get_json()
         if not data:
             logger.warning("No JSON data received")
             return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
-        
+
         story_id = data.get('story_id')
-        
+
         if not story_id:
             logger.warning("Missing story_id parameter")
             return jsonify({'success': False, 'error': 'Missing story_id'}), 400
-        
+
         # Check if user is logged in
         if 'user_id' not in session:
             logger.warning("User not logged in")
             return jsonify({'success': False, 'error': 'Not logged in'}), 401
-        
-        cur = mysql.connection.cursor()
-        
-        # Get student_id from students table
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        
-        if not student:
+
+        student_id = get_student_id()
+        if not student_id:
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify({'success': False, 'error': 'Student not found'}), 404
-            
-        student_id = student['id']
-        
-        # Create a blank canvas data URL (transparent 1x1 pixel)
-        blank_canvas_data = 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
-        
-        # Check if drawing already exists
+
+        cur = mysql.connection.cursor()
+
+        cur.execute("""
+            UPDATE student_drawings
+            SET generation = generation + 1, has_snapshot = FALSE, log_bytes = 0, stroke_count = 0,
+                updated_at = %s
+            WHERE story_id = %s AND student_id = %s
+        """, (datetime.utcnow(), story_id, student_id))
         cur.execute("""
-            SELECT id FROM student_drawings 
+            SELECT generation FROM student_drawings
             WHERE story_id = %s AND student_id = %s
         """, (story_id, student_id))
-        
-        existing_drawing = cur.fetchone()
-        
-        current_time = datetime.utcnow()
-        
-        if existing_drawing:
-            # Update with blank canvas
-            cur.execute("""
-                UPDATE student_drawings 
-                SET drawing_data = %s, updated_at = %s
-                WHERE id = %s
-            """, (blank_canvas_data, current_time, existing_drawing['id']))
-        else:
-            # Create new blank drawing
-            cur.execute("""
-                INSERT INTO student_drawings 
-                (story_id, student_id, drawing_data, created_at, updated_at)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (story_id, student_id, blank_canvas_data, current_time, current_time))
-        
+        drawing = cur.fetchone()
         mysql.connection.commit()
+
+        generation = drawing['generation'] if drawing else 0
+        if drawing:
+            drawing_store.discard_older_generations(student_id, story_id, generation)
         logger.info(f"Drawing cleared successfully for story_id: {story_id}, student_id: {student_id}")
-        
+
         return jsonify({
             'success': True,
-            'message': 'Drawing cleared successfully'
+            'message': 'Drawing cleared successfully',
+            'generation': generation
         })
-        
+
     except Exception as e:
         logger.error(f"Error clearing drawing: {str(e)}")
         logger.error(traceback.format_exc())
@@ -740,20 +1067,160 @@ def clear_student_drawing():
                 cur.close()
             except:
                 pass
-    
+
+
+#========================================== Realtime chat events ================================================
+def publish_event(channels, event_type, data):
+    """Push an event to the given user channels; never fails the calling request"""
+    try:
+        event_broker.publish(channels, event_type, data)
+    except Exception as e:
+        logger.error(f"Error publishing {event_type} event: {str(e)}")
+
+def current_event_channel():
+    """Channel carrying events for the logged-in user, e.g. 'teacher:3' or 'student:12'"""
+    user_type = session.get('user_type')
+    role_id = get_teacher_id() if user_type == 'teacher' else get_student_id()
+    if not role_id:
+        return None
+    return f"{user_type}:{role_id}"
+
+def format_sse(event):
+    return f"id: {event['id']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+def events_busy_response(payload, status=200):
+    """Answer for a client turned away because this worker's waiter slots are taken"""
+    retry = app.config['EVENTS_BUSY_RETRY']
+    response = jsonify(dict(payload, retry_after=retry))
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry)
+    return response
+
+@app.route('/api/events')
+@login_required
+def event_stream():
+    """Server-sent event stream of chat events for the current user"""
+    channel = current_event_channel()
+    if not channel:
+        return jsonify({'success': False, 'error': 'User not found'}), 404
+
+    # Every open stream holds a thread; past the limit the client falls back
+    # to polling (see realtime.js) instead of queueing other requests behind it
+    if not event_broker.acquire_waiter(app.config['EVENTS_MAX_WAITERS']):
+        return events_busy_response({'success': False, 'error': 'Too many open event streams'}, 503)
+
+    cursor = (request.headers.get('Last-Event-ID', type=int) or request.args.get('cursor', type=int)
+              or event_broker.latest_id())
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    max_age = app.config['EVENTS_STREAM_MAX_AGE']
+
+    # Deliberately not wrapped in stream_with_context: the request context (and
+    # with it the pooled DB connection) is released before streaming starts.
+    def generate(cursor):
+        yield 'retry: 3000\n\n'
+        deadline = time.monotonic() + max_age
+        while time.monotonic() < deadline:
+            events = event_broker.wait(channel, cursor, heartbeat)
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                cursor = event['id']
+                yield format_sse(event)
+        # The browser reconnects with Last-Event-ID, freeing this thread
+
+    response = app.response_class(generate(cursor), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Runs when the server closes the response, even if streaming never started
+    response.call_on_close(event_broker.release_waiter)
+    return response
+
+@app.route('/api/events/poll')
+@login_required
+@api_error_handler
+def poll_events():
+    """Long-polling fallback for clients that cannot keep an event stream open"""
+    channel = current_event_channel()
+    if not channel:
+        return jsonify({'success': False, 'error': 'User not found'}), 404
+
+    cursor = request.args.get('cursor', type=int)
+    if cursor is None:
+        return jsonify({'events': [], 'cursor': event_broker.latest_id()})
+
+    if not event_broker.acquire_waiter(app.config['EVENTS_MAX_WAITERS']):
+        # No thread to spare: hand over what is buffered now, without waiting
+        events = event_broker.wait(channel, cursor, 0)
+        return events_busy_response({'events': events, 'cursor': events[-1]['id'] if events else cursor})
+    try:
+        events = event_broker.wait(channel, cursor, app.config['EVENTS_LONG_POLL_TIMEOUT'])
+    finally:
+        event_broker.release_waiter()
+    return jsonify({'events': events, 'cursor': events[-1]['id'] if events else cursor})
 
 
 #========================================== Student<-> Teacher chat routes ================================================
-def get_current_teacher_id():
-    cur = mysql.connection.cursor()
-    cur.execute("""
-        SELECT id 
-        FROM teachers 
-        WHERE user_id = %s
-    """, (session['user_id'],))
+def fetch_message_page(cur, table, columns, conversation_id):
+    """Fetch one page of a conversation using keyset pagination on message id.
+
+    ?since_id=N returns messages newer than N (oldest first), ?before_id=N the
+    page just before N, and neither the latest page. Always ordered oldest first.
+    """
+    since_id = request.args.get('since_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', app.config['CHAT_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['CHAT_PAGE_SIZE_MAX']))
+
+    if since_id is not None:
+        cur.execute(f"""
+            SELECT {columns} FROM {table}
+            WHERE conversation_id = %s AND id > %s
+            ORDER BY id ASC
+            LIMIT %s
+        """, (conversation_id, since_id, limit))
+        return list(cur.fetchall())
+
+    if before_id is not None:
+        cur.execute(f"""
+            SELECT {columns} FROM {table}
+            WHERE conversation_id = %s AND id < %s
+            ORDER BY id DESC
+            LIMIT %s
+        """, (conversation_id, before_id, limit))
+    else:
+        cur.execute(f"""
+            SELECT {columns} FROM {table}
+            WHERE conversation_id = %s
+            ORDER BY id DESC
+            LIMIT %s
+        """, (conversation_id, limit))
+    return list(reversed(cur.fetchall()))
+
+def adjust_unread_total(cur, participant_type, participant_id, column, delta):
+    """Add delta to a participant's materialized unread total (never below zero).
+
+    column is 'chat_unread' for teacher<->student chat or 'student_chat_unread'
+    for student<->student chat. Call inside the transaction that changes the
+    messages, after locking the conversation row.
+    """
+    cur.execute(f"""
+        INSERT INTO chat_unread_counters (participant_type, participant_id, {column})
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE {column} = GREATEST({column} + %s, 0)
+    """, (participant_type, participant_id, max(delta, 0), delta))
+
+def get_unread_total(cur, participant_type, participant_id, column):
+    """Read a participant's materialized unread total (primary key lookup)"""
+    cur.execute(f"""
+        SELECT {column} AS count FROM chat_unread_counters
+        WHERE participant_type = %s AND participant_id = %s
+    """, (participant_type, participant_id))
     row = cur.fetchone()
-    cur.close()
-    return row['id'] if row else None
+    return row['count'] if row else 0
+
+def get_current_teacher_id():
+    return get_teacher_id()
 
 
 def get_or_create_conversation(teacher_id, student_id):
@@ -827,38 +1294,52 @@ def send_chat_message():
         if user_type == 'teacher':
             teacher_id = get_current_teacher_id()
             cur.execute("""
-                SELECT id FROM chat_conversations
+                SELECT id, teacher_id, student_id FROM chat_conversations
                 WHERE id = %s AND teacher_id = %s
             """, (conversation_id, teacher_id))
         else:
-            cur.execute("""
-                SELECT s.id as student_id
-                FROM students s
-                WHERE s.user_id = %s
-            """, (user_id,))
-            row = cur.fetchone()
-            if not row:
+            student_id = get_student_id()
+            if not student_id:
                 logger.warning(f"Student not found for user_id: {user_id}")
                 return jsonify({'success': False, 'error': 'Student not found'}), 404
-            student_id = row['student_id']
 
             cur.execute("""
-                SELECT id FROM chat_conversations
+                SELECT id, teacher_id, student_id FROM chat_conversations
                 WHERE id = %s AND student_id = %s
             """, (conversation_id, student_id))
 
-        if not cur.fetchone():
+        conversation = cur.fetchone()
+        if not conversation:
             logger.warning(f"Invalid conversation {conversation_id} for {user_type} {user_id}")
             return jsonify({'success': False, 'error': 'Invalid conversation'}), 403
 
+        # Bump the recipient's counters first: the conversation row is always
+        # locked before message rows, in the same order as mark-read.
+        recipient_type = 'student' if user_type == 'teacher' else 'teacher'
+        cur.execute(f"""
+            UPDATE chat_conversations
+            SET {recipient_type}_unread = {recipient_type}_unread + 1,
+                last_message_at = NOW()
+            WHERE id = %s
+        """, (conversation_id,))
+
         cur.execute("""
             INSERT INTO chat_messages 
             (conversation_id, sender_type, sender_id, message, is_read)
             VALUES (%s, %s, %s, %s, FALSE)
         """, (conversation_id, user_type, user_id, message))
+        message_id = cur.lastrowid
+
+        adjust_unread_total(cur, recipient_type, conversation[f'{recipient_type}_id'], 'chat_unread', 1)
 
         mysql.connection.commit()
         logger.info(f"Chat message sent successfully to conversation {conversation_id}")
+
+        publish_event(
+            [f"teacher:{conversation['teacher_id']}", f"student:{conversation['student_id']}"],
+            'chat_message',
+            {'conversation_id': conversation['id'], 'message_id': message_id, 'sender_type': user_type}
+        )
         return jsonify({'success': True})
 
     except Exception as e:
@@ -880,28 +1361,21 @@ def send_chat_message():
 @login_required
 @api_error_handler
 def get_chat_messages(conversation_id):
-    """Get all messages for a chat conversation"""
+    """Get a page of messages for a chat conversation (see fetch_message_page)"""
     cur = None
     try:
         logger.info(f"Fetching chat messages for conversation {conversation_id}")
         
         cur = mysql.connection.cursor()
         
-        # Simple query without DATE_FORMAT to avoid % issues
-        cur.execute("""
-            SELECT sender_type, message, created_at
-            FROM chat_messages
-            WHERE conversation_id = %s
-            ORDER BY created_at ASC
-        """, (conversation_id,))
-        
-        messages = cur.fetchall()
+        messages = fetch_message_page(cur, 'chat_messages', 'id, sender_type, message, created_at', conversation_id)
         logger.info(f"Retrieved {len(messages)} messages for conversation {conversation_id}")
         
         # Format messages for JSON response
         result = []
         for msg in messages:
             result.append({
+                'id': msg['id'],
                 'sender_type': msg['sender_type'],
                 'message': msg['message'],
                 'created_at': msg['created_at'].isoformat() if msg['created_at'] else None
@@ -973,40 +1447,17 @@ def get_unread_count():
                 logger.warning(f"Teacher not found for user_id: {session['user_id']}")
                 return jsonify({'count': 0, 'success': True})
 
-            cur.execute("""
-                SELECT COUNT(cm.id) as count
-                FROM chat_messages cm
-                JOIN chat_conversations cc ON cm.conversation_id = cc.id
-                WHERE cc.teacher_id = %s
-                  AND cm.sender_type = 'student'
-                  AND cm.is_read = FALSE
-            """, (teacher_id,))
+            count = get_unread_total(cur, 'teacher', teacher_id, 'chat_unread')
 
         else:  # student
-            # student_id is stored in students table, NOT users
-            cur.execute("""
-                SELECT s.id as student_id
-                FROM students s
-                WHERE s.user_id = %s
-            """, (session['user_id'],))
-            row = cur.fetchone()
-            student_id = row['student_id'] if row else None
+            # student_id is stored in students table, NOT users (resolved at login)
+            student_id = get_student_id()
 
             if not student_id:
                 logger.warning(f"Student not found for user_id: {session['user_id']}")
                 return jsonify({'count': 0, 'success': True})
 
-            cur.execute("""
-                SELECT COUNT(cm.id) as count
-                FROM chat_messages cm
-                JOIN chat_conversations cc ON cm.conversation_id = cc.id
-                WHERE cc.student_id = %s
-                  AND cm.sender_type = 'teacher'
-                  AND cm.is_read = FALSE
-            """, (student_id,))
-
-        result = cur.fetchone()
-        count = result['count'] if result and result['count'] else 0
+            count = get_unread_total(cur, 'student', student_id, 'chat_unread')
         logger.info(f"Unread message count for {session['user_type']}: {count}")
 
         return jsonify({'count': count, 'success': True})
@@ -1064,42 +1515,42 @@ def mark_messages_as_read(conversation_id):
         
         cur = mysql.connection.cursor()
 
-        if session['user_type'] == 'teacher':
-            teacher_id = get_current_teacher_id()
-
-            if not teacher_id:
-                logger.warning(f"Teacher not found for user_id: {session['user_id']}")
-                return jsonify({'success': True})
+        user_type = session['user_type']
+        role_id = get_current_teacher_id() if user_type == 'teacher' else get_student_id()
+
+        if not role_id:
+            logger.warning(f"{user_type.title()} not found for user_id: {session['user_id']}")
+            return jsonify({'success': True})
+
+        sender_type = 'student' if user_type == 'teacher' else 'teacher'
+        cur.execute(f"""
+            SELECT {user_type}_unread AS unread
+            FROM chat_conversations
+            WHERE id = %s AND {user_type}_id = %s
+            FOR UPDATE
+        """, (conversation_id, role_id))
+
+        conversation = cur.fetchone()
+        if not conversation:
+            logger.warning(f"Invalid conversation {conversation_id} for {user_type} {role_id}")
+            return jsonify({'success': False, 'error': 'Invalid conversation'}), 403
 
+        # Nothing to do (and no message rows to touch) when the counter is zero
+        if conversation['unread']:
             cur.execute("""
                 UPDATE chat_messages 
                 SET is_read = TRUE 
                 WHERE conversation_id = %s
-                  AND sender_type = 'student'
+                  AND sender_type = %s
                   AND is_read = FALSE
-            """, (conversation_id,))
+            """, (conversation_id, sender_type))
 
-        else:  # student
-            cur.execute("""
-                SELECT s.id as student_id
-                FROM students s
-                WHERE s.user_id = %s
-            """, (session['user_id'],))
-            row = cur.fetchone()
-            student_id = row['student_id'] if row else None
-
-            if not student_id:
-                logger.warning(f"Student not found for user_id: {session['user_id']}")
-                return jsonify({'success': True})
-
-            cur.execute("""
-                UPDATE chat_messages 
-                SET is_read = TRUE 
-                WHERE conversation_id = %s
-                  AND sender_type = 'teacher'
-                  AND is_read = FALSE
+            cur.execute(f"""
+                UPDATE chat_conversations SET {user_type}_unread = 0 WHERE id = %s
             """, (conversation_id,))
 
+            adjust_unread_total(cur, user_type, role_id, 'chat_unread', -conversation['unread'])
+
         mysql.connection.commit()
         logger.info(f"Messages marked as read successfully in conversation {conversation_id}")
         return jsonify({'success': True})
@@ -1134,15 +1585,12 @@ def get_teacher_unread_by_student():
                 s.id as student_id,
                 s.first_name,
                 s.last_name,
-                COUNT(cm.id) as unread_count,
-                MAX(cm.created_at) as last_message_time
-            FROM chat_messages cm
-            JOIN chat_conversations cc ON cm.conversation_id = cc.id
+                cc.teacher_unread as unread_count,
+                cc.last_message_at as last_message_time
+            FROM chat_conversations cc
             JOIN students s ON cc.student_id = s.id
             WHERE cc.teacher_id = %s
-              AND cm.sender_type = 'student'
-              AND cm.is_read = FALSE
-            GROUP BY s.id
+              AND cc.teacher_unread > 0
             ORDER BY last_message_time DESC
         """, (teacher_id,))
 
@@ -1158,11 +1606,7 @@ def get_teacher_unread_by_student():
 
 
 def get_current_student_id():
-    cur = mysql.connection.cursor()
-    cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-    student = cur.fetchone()
-    cur.close()
-    return student['id'] if student else None
+    return get_student_id()
 
 # @app.route('/api/student/classmates')
 # @student_required
@@ -1226,14 +1670,12 @@ def get_student_classmates():
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify([])
 
-        # Get my class
-        cur.execute("SELECT class_level FROM students WHERE id = %s", (student_id,))
-        me = cur.fetchone()
-        if not me:
+        # My class (resolved at login alongside the student id)
+        my_class = g.class_level
+        if not my_class:
             logger.warning(f"Student data not found for student_id: {student_id}")
             return jsonify([])
 
-        my_class = me['class_level']
         logger.info(f"Student's class level: {my_class}")
 
         # Get classmates + conversation + unread count
@@ -1244,14 +1686,11 @@ def get_student_classmates():
                 s.last_name,
                 sc.id AS conversation_id,
 
-                -- Unread count from this classmate
-                SUM(
-                    CASE 
-                        WHEN sm.is_read = FALSE 
-                         AND sm.sender_id = s.id 
-                        THEN 1 ELSE 0 
-                    END
-                ) AS unread_count
+                -- Unread count from this classmate (materialized on the conversation)
+                CASE 
+                    WHEN sc.student1_id = %s THEN sc.student1_unread
+                    ELSE sc.student2_unread
+                END AS unread_count
 
             FROM students s
 
@@ -1261,15 +1700,11 @@ def get_student_classmates():
                  OR (sc.student2_id = %s AND sc.student1_id = s.id)
               )
 
-            LEFT JOIN student_messages sm
-              ON sm.conversation_id = sc.id
-
             WHERE LOWER(TRIM(s.class_level)) = LOWER(TRIM(%s))
               AND s.id != %s
 
-            GROUP BY s.id, sc.id
             ORDER BY s.first_name
-        """, (student_id, student_id, my_class, student_id))
+        """, (student_id, student_id, student_id, my_class, student_id))
 
         classmates = cur.fetchall()
         logger.info(f"Found {len(classmates)} classmates for student_id: {student_id}")
@@ -1375,14 +1810,41 @@ def send_student_chat_message():
         logger.info(f"Student {student_id} sending message to conversation {conversation_id}")
 
         cur = mysql.connection.cursor()
+        cur.execute("""
+            SELECT id, student1_id, student2_id FROM student_conversations
+            WHERE id = %s AND (student1_id = %s OR student2_id = %s)
+        """, (conversation_id, student_id, student_id))
+
+        conversation = cur.fetchone()
+        if not conversation:
+            logger.warning(f"Invalid conversation {conversation_id} for student {student_id}")
+            return jsonify({'success': False, 'error': 'Invalid conversation'}), 403
+
+        # Recipient's counters first (conversation row before message rows)
+        recipient = 'student2' if conversation['student1_id'] == student_id else 'student1'
+        cur.execute(f"""
+            UPDATE student_conversations
+            SET {recipient}_unread = {recipient}_unread + 1
+            WHERE id = %s
+        """, (conversation_id,))
+
         cur.execute("""
             INSERT INTO student_messages (conversation_id, sender_id, message, is_read)
             VALUES (%s, %s, %s, FALSE)
         """, (conversation_id, student_id, message))
+        message_id = cur.lastrowid
+
+        adjust_unread_total(cur, 'student', conversation[f'{recipient}_id'], 'student_chat_unread', 1)
 
         mysql.connection.commit()
         logger.info(f"Message sent successfully to conversation {conversation_id}")
 
+        publish_event(
+            [f"student:{conversation['student1_id']}", f"student:{conversation['student2_id']}"],
+            'student_chat_message',
+            {'conversation_id': conversation['id'], 'message_id': message_id, 'sender_id': student_id}
+        )
+
         return jsonify({'success': True})
 
     except Exception as e:
@@ -1404,20 +1866,15 @@ def send_student_chat_message():
 @student_required
 @api_error_handler
 def get_student_chat_messages(conversation_id):
-    """Get all messages in a student conversation"""
+    """Get a page of messages in a student conversation (see fetch_message_page)"""
     cur = None
     try:
         logger.info(f"Fetching student chat messages for conversation {conversation_id}")
         
         cur = mysql.connection.cursor()
-        cur.execute("""
-            SELECT id, sender_id, message, created_at, is_read
-            FROM student_messages
-            WHERE conversation_id = %s
-            ORDER BY created_at ASC
-        """, (conversation_id,))
-
-        messages = cur.fetchall()
+        messages = fetch_message_page(
+            cur, 'student_messages', 'id, sender_id, message, created_at, is_read', conversation_id
+        )
         logger.info(f"Retrieved {len(messages)} messages for conversation {conversation_id}")
 
         # Convert datetime to string
@@ -1460,17 +1917,7 @@ def get_student_chat_unread_count():
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify({'count': 0}), 404
 
-        cur.execute("""
-            SELECT COUNT(*) as count
-            FROM student_messages sm
-            JOIN student_conversations sc ON sm.conversation_id = sc.id
-            WHERE (sc.student1_id = %s OR sc.student2_id = %s)
-              AND sm.sender_id != %s
-              AND sm.is_read = FALSE
-        """, (student_id, student_id, student_id))
-
-        result = cur.fetchone()
-        count = result['count'] if result and result['count'] else 0
+        count = get_unread_total(cur, 'student', student_id, 'student_chat_unread')
         logger.info(f"Unread student chat count: {count}")
 
         return jsonify({'count': count, 'success': True})
@@ -1503,11 +1950,35 @@ def mark_student_messages_read(conversation_id):
             return jsonify({'success': False, 'error': 'Student not found'}), 404
 
         cur.execute("""
-            UPDATE student_messages
-            SET is_read = TRUE
-            WHERE conversation_id = %s
-              AND sender_id != %s
-        """, (conversation_id, student_id))
+            SELECT student1_id, student1_unread, student2_unread
+            FROM student_conversations
+            WHERE id = %s AND (student1_id = %s OR student2_id = %s)
+            FOR UPDATE
+        """, (conversation_id, student_id, student_id))
+
+        conversation = cur.fetchone()
+        if not conversation:
+            logger.warning(f"Invalid conversation {conversation_id} for student {student_id}")
+            return jsonify({'success': False, 'error': 'Invalid conversation'}), 403
+
+        me = 'student1' if conversation['student1_id'] == student_id else 'student2'
+        unread = conversation[f'{me}_unread']
+
+        # Nothing to do (and no message rows to touch) when the counter is zero
+        if unread:
+            cur.execute("""
+                UPDATE student_messages
+                SET is_read = TRUE
+                WHERE conversation_id = %s
+                  AND sender_id != %s
+                  AND is_read = FALSE
+            """, (conversation_id, student_id))
+
+            cur.execute(f"""
+                UPDATE student_conversations SET {me}_unread = 0 WHERE id = %s
+            """, (conversation_id,))
+
+            adjust_unread_total(cur, 'student', student_id, 'student_chat_unread', -unread)
 
         mysql.connection.commit()
         logger.info(f"Messages marked as read in conversation {conversation_id}")
@@ -1666,6 +2137,106 @@ def generate_puzzle_from_text(text_content, puzzle_type='word_search'):
     
     return puzzle_data
 
+def choose_puzzle_type(text_content):
+    """Pick a random puzzle type suited to the length of a page's text"""
+    text_length = len(text_content)
+    
+    if text_length > 200:
+        puzzle_types = ['word_search', 'fill_blank', 'multiple_choice']
+    elif text_length > 100:
+        puzzle_types = ['true_false', 'multiple_choice', 'fill_blank']
+    else:
+        puzzle_types = ['true_false', 'multiple_choice']
+    
+    return random.choice(puzzle_types)
+
+# Puzzles are generated in the background when a story is saved, so students
+# never wait for (or race on) puzzle creation when they open a page. With
+# JOB_QUEUE_ENABLED that is a story_puzzles job, otherwise this thread pool.
+puzzle_executor = ThreadPoolExecutor(max_workers=app.config['PUZZLE_WORKERS'], thread_name_prefix='puzzle')
+_puzzle_jobs = {}  # story_id -> True if the story changed while its job was running
+_puzzle_jobs_lock = threading.Lock()
+
+def generate_story_puzzles(story_id):
+    """Create a puzzle for every page of a story that does not have one yet"""
+    with app.app_context():
+        cur = mysql.connection.cursor()
+        try:
+            cur.execute("""
+                SELECT sp.id, sp.text_content
+                FROM story_pages sp
+                LEFT JOIN story_page_puzzles spp ON spp.story_page_id = sp.id
+                WHERE sp.story_id = %s AND spp.id IS NULL
+            """, (story_id,))
+            pages = cur.fetchall()
+            if not pages:
+                return 0
+
+            cur.execute("SELECT id, name FROM puzzle_types")
+            puzzle_type_ids = {row['name']: row['id'] for row in cur.fetchall()}
+
+            rows = []
+            for page in pages:
+                if not page['text_content']:
+                    continue
+                selected_type = choose_puzzle_type(page['text_content'])
+                if selected_type not in puzzle_type_ids:
+                    continue
+                puzzle_data = generate_puzzle_from_text(page['text_content'], selected_type)
+                rows.append((page['id'], puzzle_type_ids[selected_type], json.dumps(puzzle_data), 'medium', 180, 70))
+
+            # IGNORE: a teacher may have created a puzzle for the page meanwhile
+            cur.executemany("""
+                INSERT IGNORE INTO story_page_puzzles 
+                (story_page_id, puzzle_type_id, puzzle_data, difficulty, time_limit, required_score)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, rows)
+            mysql.connection.commit()
+            logger.info(f"Generated {len(rows)} puzzle(s) for story {story_id}")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error generating puzzles for story {story_id}: {str(e)}")
+            logger.error(traceback.format_exc())
+            try:
+                mysql.connection.rollback()
+            except:
+                pass
+            raise
+        finally:
+            cur.close()
+
+@job_queue.handler('story_puzzles')
+def story_puzzles_job(story_id):
+    return {'generated': generate_story_puzzles(story_id)}
+
+def _run_story_puzzle_job(story_id):
+    while True:
+        try:
+            generate_story_puzzles(story_id)
+        except Exception:
+            pass  # logged; the next save or page view schedules it again
+        with _puzzle_jobs_lock:
+            if not _puzzle_jobs.pop(story_id, False):
+                return
+            # Pages changed while we ran; go again with the new pages
+            _puzzle_jobs[story_id] = False
+
+def schedule_story_puzzles(story_id):
+    """Queue background puzzle generation for a story (call after committing its pages)"""
+    if app.config['JOB_QUEUE_ENABLED']:
+        try:
+            enqueue_job('story_puzzles', {'story_id': story_id},
+                        dedupe_key=f'story_puzzles:{story_id}')
+            return
+        except Exception as e:
+            logger.error(f"Could not queue puzzle generation for story {story_id}: {str(e)}")
+    with _puzzle_jobs_lock:
+        if story_id in _puzzle_jobs:
+            _puzzle_jobs[story_id] = True
+            return
+        _puzzle_jobs[story_id] = False
+    puzzle_executor.submit(_run_story_puzzle_job, story_id)
+
 # # API to submit puzzle answer
 # @app.route('/api/submit_puzzle_answer', methods=['POST'])
 # @student_required
@@ -1894,13 +2465,11 @@ def submit_puzzle_answer():
             logger.warning(f"Puzzle not found: {puzzle_id}")
             return jsonify({'success': False, 'error': 'Puzzle not found'}), 404
 
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        if not student:
+        # Student ID (resolved at login)
+        student_id = g.student_id
+        if not student_id:
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify({'success': False, 'error': 'Student not found'}), 404
-        student_id = student['id']
         
         logger.info(f"Student {student_id} submitting puzzle {puzzle_id}")
         
@@ -2105,8 +2674,7 @@ def submit_puzzle_answer():
                 story_id = page_info['story_id']
                 current_page = page_info['page_number']
 
-                cur.execute("SELECT COUNT(*) as total FROM story_pages WHERE story_id = %s", (story_id,))
-                total_pages = cur.fetchone()['total']
+                total_pages = get_story_page_count(story_id)
 
                 is_last_page = current_page >= total_pages
 
@@ -2381,13 +2949,11 @@ def skip_puzzle():
         
         cur = mysql.connection.cursor()
         
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        if not student:
+        # Student ID (resolved at login)
+        student_id = g.student_id
+        if not student_id:
             logger.warning(f"Student not found for user_id: {session['user_id']}")
             return jsonify({'success': False, 'error': 'Student not found'}), 404
-        student_id = student['id']
         
         logger.info(f"Student {student_id} skipping puzzle {puzzle_id}")
         
@@ -2410,8 +2976,7 @@ def skip_puzzle():
         logger.info(f"Puzzle is on page {current_page} of story {story_id}")
         
         # Get total pages
-        cur.execute("SELECT COUNT(*) as total FROM story_pages WHERE story_id = %s", (story_id,))
-        total_pages = cur.fetchone()['total']
+        total_pages = get_story_page_count(story_id)
         
         # Check if this is the last page
         is_last_page = current_page >= total_pages
@@ -2654,16 +3219,7 @@ def auto_generate_puzzle():
         logger.info(f"Generating puzzle for page {page_id}")
         
         # Choose random puzzle type based on text length
-        text_length = len(page['text_content'])
-        
-        if text_length > 200:
-            puzzle_types = ['word_search', 'fill_blank', 'multiple_choice']
-        elif text_length > 100:
-            puzzle_types = ['true_false', 'multiple_choice', 'fill_blank']
-        else:
-            puzzle_types = ['true_false', 'multiple_choice']
-        
-        selected_type = random.choice(puzzle_types)
+        selected_type = choose_puzzle_type(page['text_content'])
         logger.info(f"Selected puzzle type: {selected_type}")
         
         # Get puzzle type ID
@@ -2927,6 +3483,479 @@ def to_letters_filter(num):
     return str(num)
 
 
+# ====================== Analytics rollups ==================================================
+# story_stats (per story), class_story_stats (per story and class), teacher_stats
+# (per teacher) and quiz_stats (per quiz) hold the counters behind the teacher
+# dashboard, analytics pages and the class stats on the quiz result page.
+# The progress, quiz and story write paths keep them up to date incrementally in the
+# same transaction; rebuild_story_rollups/rebuild_teacher_rollups recompute them from
+# the base tables (python rebuild_rollups.py does every story and teacher).
+# Locks are taken in the order quiz_stats, story_stats, class_story_stats, stories,
+# teacher_stats, so a quiz submission and a teacher's save never wait on each other
+# in a cycle.
+
+def record_story_progress(cur, story_id, class_level, started=0, completed=0):
+    """Count a student starting and/or completing a story"""
+    if not (started or completed):
+        return
+    cur.execute("""
+        INSERT INTO story_stats (story_id, students_started, students_completed)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            students_started = students_started + VALUES(students_started),
+            students_completed = students_completed + VALUES(students_completed)
+    """, (story_id, started, completed))
+    cur.execute("""
+        INSERT INTO class_story_stats (story_id, class_level, students_started, students_completed)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            students_started = students_started + VALUES(students_started),
+            students_completed = students_completed + VALUES(students_completed)
+    """, (story_id, class_level, started, completed))
+
+def record_quiz_attempt(cur, story_id, quiz_id, class_level, score, passed, first_pass):
+    """Count a submitted quiz attempt; first_pass if it is the student's first passing one"""
+    cur.execute("""
+        INSERT INTO quiz_stats (quiz_id, total_attempts, score_sum, passed_count, failed_count)
+        VALUES (%s, 1, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            total_attempts = total_attempts + 1,
+            score_sum = score_sum + VALUES(score_sum),
+            passed_count = passed_count + VALUES(passed_count),
+            failed_count = failed_count + VALUES(failed_count)
+    """, (quiz_id, score, 1 if passed else 0, 0 if passed else 1))
+    cur.execute("""
+        INSERT INTO story_stats
+            (story_id, quiz_attempts, quiz_score_sum, quiz_score_min, quiz_score_max, students_passed)
+        VALUES (%s, 1, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            quiz_attempts = quiz_attempts + 1,
+            quiz_score_sum = quiz_score_sum + VALUES(quiz_score_sum),
+            quiz_score_min = LEAST(COALESCE(quiz_score_min, VALUES(quiz_score_min)), VALUES(quiz_score_min)),
+            quiz_score_max = GREATEST(COALESCE(quiz_score_max, VALUES(quiz_score_max)), VALUES(quiz_score_max)),
+            students_passed = students_passed + VALUES(students_passed)
+    """, (story_id, score, score, score, 1 if first_pass else 0))
+    cur.execute("""
+        INSERT INTO class_story_stats (story_id, class_level, quiz_attempts, quiz_score_sum)
+        VALUES (%s, %s, 1, %s)
+        ON DUPLICATE KEY UPDATE
+            quiz_attempts = quiz_attempts + 1,
+            quiz_score_sum = quiz_score_sum + VALUES(quiz_score_sum)
+    """, (story_id, class_level, score))
+    cur.execute("""
+        INSERT INTO teacher_stats (teacher_id, quiz_attempts, quiz_score_sum, quiz_score_min, quiz_score_max)
+        SELECT teacher_id, 1, %s, %s, %s FROM stories WHERE id = %s
+        ON DUPLICATE KEY UPDATE
+            quiz_attempts = quiz_attempts + 1,
+            quiz_score_sum = quiz_score_sum + VALUES(quiz_score_sum),
+            quiz_score_min = LEAST(COALESCE(quiz_score_min, VALUES(quiz_score_min)), VALUES(quiz_score_min)),
+            quiz_score_max = GREATEST(COALESCE(quiz_score_max, VALUES(quiz_score_max)), VALUES(quiz_score_max))
+    """, (score, score, score, story_id))
+
+def record_teacher_stories(cur, teacher_id, total=0, published=0, quiz_attempts=0, quiz_score_sum=0):
+    """Adjust a teacher's story counts (and quiz totals, for a deleted story).
+
+    quiz_score_min/max are left alone, as they cannot be taken back; a deleted
+    story's scores stay in them until rebuild_rollups.py runs.
+    """
+    if not (total or published or quiz_attempts):
+        return
+    cur.execute("""
+        INSERT INTO teacher_stats (teacher_id, total_stories, published_stories, quiz_attempts, quiz_score_sum)
+        VALUES (%s, GREATEST(%s, 0), GREATEST(%s, 0), GREATEST(%s, 0), GREATEST(%s, 0))
+        ON DUPLICATE KEY UPDATE
+            total_stories = GREATEST(total_stories + %s, 0),
+            published_stories = GREATEST(published_stories + %s, 0),
+            quiz_attempts = GREATEST(quiz_attempts + %s, 0),
+            quiz_score_sum = GREATEST(quiz_score_sum + %s, 0)
+    """, (teacher_id, total, published, quiz_attempts, quiz_score_sum,
+          total, published, quiz_attempts, quiz_score_sum))
+
+def rebuild_story_rollups(cur, story_id=None):
+    """Recompute story_stats, class_story_stats and quiz_stats for one story, or all when story_id is None"""
+    story_filter = "WHERE s.id = %s" if story_id else ""
+    progress_filter = "WHERE sp.story_id = %s" if story_id else ""
+    quiz_filter = "WHERE q.story_id = %s" if story_id else ""
+    args = (story_id,) if story_id else ()
+
+    cur.execute(f"""
+        DELETE qs FROM quiz_stats qs
+        JOIN quizzes q ON q.id = qs.quiz_id
+        {quiz_filter}
+    """, args)
+    cur.execute(f"""
+        INSERT INTO quiz_stats (quiz_id, total_attempts, score_sum, passed_count, failed_count)
+        SELECT q.id,
+               COUNT(*),
+               SUM(sqa.score),
+               SUM(sqa.score >= q.passing_score),
+               SUM(sqa.score < q.passing_score)
+        FROM student_quiz_attempts sqa
+        JOIN quizzes q ON q.id = sqa.quiz_id
+        {quiz_filter}
+        GROUP BY q.id
+    """, args)
+
+    cur.execute(f"DELETE FROM story_stats {'WHERE story_id = %s' if story_id else ''}", args)
+    cur.execute(f"""
+        INSERT INTO story_stats
+            (story_id, students_started, students_completed, quiz_attempts,
+             quiz_score_sum, quiz_score_min, quiz_score_max, students_passed)
+        SELECT s.id,
+               COALESCE(p.started, 0), COALESCE(p.completed, 0), COALESCE(a.attempts, 0),
+               COALESCE(a.score_sum, 0), a.score_min, a.score_max, COALESCE(a.passed, 0)
+        FROM stories s
+        LEFT JOIN (
+            SELECT sp.story_id, COUNT(*) AS started, SUM(sp.is_completed) AS completed
+            FROM student_progress sp
+            {progress_filter}
+            GROUP BY sp.story_id
+        ) p ON p.story_id = s.id
+        LEFT JOIN (
+            SELECT q.story_id,
+                   COUNT(*) AS attempts,
+                   SUM(sqa.score) AS score_sum,
+                   MIN(sqa.score) AS score_min,
+                   MAX(sqa.score) AS score_max,
+                   COUNT(DISTINCT CASE WHEN sqa.score >= q.passing_score THEN sqa.student_id END) AS passed
+            FROM student_quiz_attempts sqa
+            JOIN quizzes q ON q.id = sqa.quiz_id
+            {quiz_filter}
+            GROUP BY q.story_id
+        ) a ON a.story_id = s.id
+        {story_filter}
+    """, args * 3)
+
+    # Attributed to each student's current class
+    cur.execute(f"DELETE FROM class_story_stats {'WHERE story_id = %s' if story_id else ''}", args)
+    cur.execute(f"""
+        INSERT INTO class_story_stats
+            (story_id, class_level, students_started, students_completed, quiz_attempts, quiz_score_sum)
+        SELECT story_id, class_level, SUM(started), SUM(completed), SUM(attempts), SUM(score)
+        FROM (
+            SELECT sp.story_id, st.class_level,
+                   1 AS started, sp.is_completed AS completed, 0 AS attempts, 0 AS score
+            FROM student_progress sp
+            JOIN students st ON st.id = sp.student_id
+            {progress_filter}
+            UNION ALL
+            SELECT q.story_id, st.class_level, 0, 0, 1, sqa.score
+            FROM student_quiz_attempts sqa
+            JOIN quizzes q ON q.id = sqa.quiz_id
+            JOIN students st ON st.id = sqa.student_id
+            {quiz_filter}
+        ) AS activity
+        GROUP BY story_id, class_level
+    """, args * 2)
+
+def rebuild_teacher_rollups(cur, teacher_id=None):
+    """Recompute teacher_stats (from stories and story_stats) for one teacher, or all.
+
+    Reads every story_stats row of the teacher, so it is for rebuild_rollups.py,
+    not request handlers (those call record_teacher_stories).
+    """
+    args = (teacher_id,) if teacher_id else ()
+    cur.execute(f"DELETE FROM teacher_stats {'WHERE teacher_id = %s' if teacher_id else ''}", args)
+    cur.execute(f"""
+        INSERT INTO teacher_stats
+            (teacher_id, total_stories, published_stories, quiz_attempts,
+             quiz_score_sum, quiz_score_min, quiz_score_max)
+        SELECT t.id,
+               COUNT(s.id),
+               COALESCE(SUM(s.is_published), 0),
+               COALESCE(SUM(ss.quiz_attempts), 0),
+               COALESCE(SUM(ss.quiz_score_sum), 0),
+               MIN(ss.quiz_score_min),
+               MAX(ss.quiz_score_max)
+        FROM teachers t
+        LEFT JOIN stories s ON s.teacher_id = t.id
+        LEFT JOIN story_stats ss ON ss.story_id = s.id
+        {'WHERE t.id = %s' if teacher_id else ''}
+        GROUP BY t.id
+    """, args)
+
+def get_teacher_stats(cur, teacher_id):
+    """teacher_stats row with avg_quiz_score, or zeros if the teacher has none yet"""
+    cur.execute("""
+        SELECT total_stories, published_stories, quiz_attempts,
+               quiz_score_sum / NULLIF(quiz_attempts, 0) AS avg_quiz_score,
+               quiz_score_min, quiz_score_max
+        FROM teacher_stats
+        WHERE teacher_id = %s
+    """, (teacher_id,))
+    return cur.fetchone() or {
+        'total_stories': 0, 'published_stories': 0, 'quiz_attempts': 0,
+        'avg_quiz_score': None, 'quiz_score_min': None, 'quiz_score_max': None
+    }
+
+def get_teacher_class_totals(cur, teacher_id, published_only=False):
+    """Number of classes the teacher's stories are assigned to and students in them"""
+    cur.execute(f"""
+        SELECT COUNT(*) AS total_classes, COALESCE(SUM(c.students), 0) AS total_students
+        FROM (
+            SELECT ca.class_level,
+                   (SELECT COUNT(*) FROM students st WHERE st.class_level = ca.class_level) AS students
+            FROM class_assignments ca
+            JOIN stories s ON s.id = ca.story_id
+            WHERE s.teacher_id = %s {'AND s.is_published = TRUE' if published_only else ''}
+            GROUP BY ca.class_level
+        ) c
+    """, (teacher_id,))
+    return cur.fetchone()
+
+
+# ====================== Quiz item statistics ==================================================
+# quiz_question_stats (answers/correct per question), quiz_answer_counts (how often
+# each distinct answer was given) and quiz_score_buckets (10-point score histogram
+# per quiz) back /api/quiz_statistics. take_quiz records each submission into them
+# in its own transaction; python rebuild_quiz_statistics.py backfills them.
+
+TOP_ANSWERS_PER_QUESTION = 5
+ANSWER_KEY_LENGTH = 191  # quiz_answer_counts.answer is part of the primary key
+
+def answer_key(student_answer):
+    """quiz_answer_counts key of an answer; strip(' ') matches the rebuild's LEFT(TRIM(...)) exactly"""
+    return (student_answer or '').strip(' ')[:ANSWER_KEY_LENGTH]
+
+def score_bucket(score):
+    """Lower bound of the score's 10-point bucket, as FLOOR(score/10)*10 on the stored DECIMAL(5,2)"""
+    return int(round(float(score), 2) // 10) * 10
+
+def record_quiz_answers(cur, quiz_id, score, answers):
+    """Count one attempt's answers into the per-question stats and its score into the histogram"""
+    # Sorted so concurrent submissions lock rows in the same order
+    answers = sorted(answers, key=lambda a: a['question_id'])
+    if answers:
+        cur.executemany("""
+            INSERT INTO quiz_question_stats (question_id, quiz_id, total_answers, correct_answers)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                total_answers = total_answers + VALUES(total_answers),
+                correct_answers = correct_answers + VALUES(correct_answers)
+        """, [(a['question_id'], quiz_id, 1, 1 if a['is_correct'] else 0) for a in answers])
+        cur.executemany("""
+            INSERT INTO quiz_answer_counts (question_id, answer, answer_count)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE answer_count = answer_count + VALUES(answer_count)
+        """, [(a['question_id'], answer_key(a['student_answer']), 1) for a in answers])
+    cur.execute("""
+        INSERT INTO quiz_score_buckets (quiz_id, bucket, attempt_count)
+        VALUES (%s, %s, 1)
+        ON DUPLICATE KEY UPDATE attempt_count = attempt_count + 1
+    """, (quiz_id, score_bucket(score)))
+
+def rebuild_quiz_item_stats(cur, quiz_id=None):
+    """Recompute the item statistics tables for one quiz, or all when quiz_id is None"""
+    quiz_filter = "WHERE qq.quiz_id = %s" if quiz_id else ""
+    args = (quiz_id,) if quiz_id else ()
+
+    cur.execute(f"DELETE FROM quiz_question_stats {'WHERE quiz_id = %s' if quiz_id else ''}", args)
+    cur.execute(f"""
+        INSERT INTO quiz_question_stats (question_id, quiz_id, total_answers, correct_answers)
+        SELECT qq.id, qq.quiz_id, COUNT(*), SUM(sqa.is_correct)
+        FROM student_quiz_answers sqa
+        JOIN quiz_questions qq ON qq.id = sqa.question_id
+        {quiz_filter}
+        GROUP BY qq.id, qq.quiz_id
+    """, args)
+
+    cur.execute(f"""
+        DELETE ac FROM quiz_answer_counts ac
+        JOIN quiz_questions qq ON qq.id = ac.question_id
+        {quiz_filter}
+    """, args)
+    # TRIM() removes spaces only, as answer_key does, so the rebuild yields the live keys
+    cur.execute(f"""
+        INSERT INTO quiz_answer_counts (question_id, answer, answer_count)
+        SELECT sqa.question_id, LEFT(TRIM(sqa.student_answer), {ANSWER_KEY_LENGTH}), COUNT(*)
+        FROM student_quiz_answers sqa
+        JOIN quiz_questions qq ON qq.id = sqa.question_id
+        {quiz_filter}
+        GROUP BY sqa.question_id, LEFT(TRIM(sqa.student_answer), {ANSWER_KEY_LENGTH})
+    """, args)
+
+    cur.execute(f"DELETE FROM quiz_score_buckets {'WHERE quiz_id = %s' if quiz_id else ''}", args)
+    cur.execute(f"""
+        INSERT INTO quiz_score_buckets (quiz_id, bucket, attempt_count)
+        SELECT quiz_id, FLOOR(score/10)*10, COUNT(*)
+        FROM student_quiz_attempts
+        {'WHERE quiz_id = %s' if quiz_id else ''}
+        GROUP BY quiz_id, FLOOR(score/10)*10
+    """, args)
+
+
+# Difficulty/discrimination analysis (see item_analysis.py) for the analytics page.
+# Each worker caches results until the quiz is saved again or gets new attempts.
+item_analysis_cache = AnalysisCache()
+
+def get_quiz_item_analyses(cur, teacher_id, quiz_id=None):
+    """A teacher's quizzes (or just quiz_id) with their item analysis under 'analysis'"""
+    cur.execute(f"""
+        SELECT q.id, q.title, q.version, s.title AS story_title,
+               COALESCE(qs.total_attempts, 0) AS attempts
+        FROM quizzes q
+        JOIN stories s ON s.id = q.story_id
+        LEFT JOIN quiz_stats qs ON qs.quiz_id = q.id
+        WHERE s.teacher_id = %s {'AND q.id = %s' if quiz_id else ''}
+        ORDER BY s.created_at DESC
+    """, (teacher_id, quiz_id) if quiz_id else (teacher_id,))
+    quizzes = cur.fetchall()
+
+    analyses = {}
+    stale = []
+    for quiz in quizzes:
+        cached = item_analysis_cache.get(quiz['id'], (quiz['version'], quiz['attempts']))
+        if cached is None:
+            stale.append(quiz)
+        else:
+            analyses[quiz['id']] = cached
+
+    if stale:
+        # Batched queries for all stale quizzes; the per-quiz work happens in NumPy
+        quiz_ids = [quiz['id'] for quiz in stale]
+        questions = fetch_rows_by_ids(cur, """
+            SELECT id, quiz_id, question_text, question_type, correct_answer
+            FROM quiz_questions
+            WHERE quiz_id IN ({ids})
+            ORDER BY id
+        """, quiz_ids, key='quiz_id', many=True)
+
+        answers = {}
+        for row in fetch_rows_by_ids(cur, """
+            SELECT sqa.quiz_id, sa.attempt_id, sa.question_id, sa.is_correct, sa.student_answer
+            FROM student_quiz_attempts sqa
+            JOIN student_quiz_answers sa ON sa.attempt_id = sqa.id
+            WHERE sqa.quiz_id IN ({ids})
+        """, quiz_ids):
+            answers.setdefault(row['quiz_id'], []).append(
+                (row['attempt_id'], row['question_id'], row['is_correct'], row['student_answer']))
+
+        for quiz in stale:
+            result = analyze_quiz(questions.get(quiz['id'], []), answers.get(quiz['id'], []))
+            item_analysis_cache.put(quiz['id'], (quiz['version'], quiz['attempts']), result)
+            analyses[quiz['id']] = result
+
+    return [dict(quiz, analysis=analyses[quiz['id']]) for quiz in quizzes]
+
+
+# ====================== Story counters ==================================================
+# stories.page_count, has_quiz and question_count are copies of counts over
+# story_pages/quizzes/quiz_questions so listings and page turns do not count rows
+# per story. Everything that changes pages or quiz questions (create_story,
+# edit_story, create_quiz) calls refresh_story_counters before committing;
+# python check_story_counters.py [--fix] finds and repairs drift.
+
+# Joined to stories (aliased s) as p and q; {pages_filter}/{quiz_filter} narrow them to one story
+STORY_COUNTER_JOINS = """
+    LEFT JOIN (
+        SELECT story_id, COUNT(*) AS pages
+        FROM story_pages
+        {pages_filter}
+        GROUP BY story_id
+    ) p ON p.story_id = s.id
+    LEFT JOIN (
+        SELECT qz.story_id, COUNT(qq.id) AS questions
+        FROM quizzes qz
+        LEFT JOIN quiz_questions qq ON qq.quiz_id = qz.id
+        {quiz_filter}
+        GROUP BY qz.story_id
+    ) q ON q.story_id = s.id
+"""
+
+def refresh_story_counters(cur, story_id=None):
+    """Recompute page_count/has_quiz/question_count for one story, or all when story_id is None"""
+    if story_id:
+        joins = STORY_COUNTER_JOINS.format(pages_filter="WHERE story_id = %s",
+                                           quiz_filter="WHERE qz.story_id = %s")
+        args = (story_id, story_id, story_id)
+    else:
+        joins = STORY_COUNTER_JOINS.format(pages_filter="", quiz_filter="")
+        args = ()
+    cur.execute(f"""
+        UPDATE stories s
+        {joins}
+        SET s.page_count = COALESCE(p.pages, 0),
+            s.has_quiz = q.story_id IS NOT NULL,
+            s.question_count = COALESCE(q.questions, 0)
+        {'WHERE s.id = %s' if story_id else ''}
+    """, args)
+
+def find_story_counter_drift(cur):
+    """Stories whose stored counters differ from the base tables"""
+    cur.execute(f"""
+        SELECT s.id, s.title, s.page_count, s.has_quiz, s.question_count,
+               COALESCE(p.pages, 0) AS actual_page_count,
+               q.story_id IS NOT NULL AS actual_has_quiz,
+               COALESCE(q.questions, 0) AS actual_question_count
+        FROM stories s
+        {STORY_COUNTER_JOINS.format(pages_filter="", quiz_filter="")}
+        HAVING s.page_count <> actual_page_count
+            OR s.has_quiz <> actual_has_quiz
+            OR s.question_count <> actual_question_count
+        ORDER BY s.id
+    """)
+    return cur.fetchall()
+
+
+# ====================== Background job status ==================================================
+# Jobs queued from a request (see enqueue_job) record the user who queued
+# them; only that user can poll them here.
+
+JOB_LIST_LIMIT = 20
+
+def job_status_payload(job):
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'result': job['result'],
+        'error': job['error'].strip().splitlines()[-1] if job['error'] else None,
+        'created_at': job['created_at'].isoformat() if job['created_at'] else None,
+        'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None
+    }
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job_status(job_id):
+    cur = None
+    try:
+        cur = mysql.connection.cursor()
+        job = job_queue.get(cur, job_id)
+        if not job or job['created_by'] != session['user_id']:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        response = jsonify({'success': True, 'job': job_status_payload(job)})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    except Exception as e:
+        logger.error(f"Error loading job {job_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    """The current user's most recent jobs, optionally filtered by ?status="""
+    cur = None
+    try:
+        cur = mysql.connection.cursor()
+        jobs = job_queue.recent(cur, session['user_id'], status=request.args.get('status'),
+                                limit=JOB_LIST_LIMIT)
+        jobs = [job_status_payload(job) for job in jobs]
+        response = jsonify({'success': True, 'jobs': jobs})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    except Exception as e:
+        logger.error(f"Error listing jobs: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+
+
 # ======================  Student Portal Routes ==================================================
 # main code 
 # @app.route('/student/dashboard')
@@ -3002,12 +4031,7 @@ def student_dashboard():
                    t.last_name as teacher_last_name,
                    sp.current_page, 
                    sp.is_completed,
-                   (SELECT COUNT(*) 
-                    FROM story_pages sp2 
-                    WHERE sp2.story_id = s.id) as total_pages,
-                   (SELECT COUNT(*) 
-                    FROM quizzes q 
-                    WHERE q.story_id = s.id) as has_quiz,
+                   s.page_count as total_pages,
                    (SELECT COUNT(*) 
                     FROM student_quiz_attempts sqa 
                     JOIN quizzes q ON sqa.quiz_id = q.id 
@@ -3050,11 +4074,9 @@ def student_dashboard():
             )
             # Get unread count for student
             cur.execute("""
-                SELECT COUNT(*) as unread_count
-                FROM chat_messages cm
-                WHERE cm.conversation_id = %s 
-                  AND cm.sender_type = 'teacher'
-                  AND cm.is_read = FALSE
+                SELECT student_unread as unread_count
+                FROM chat_conversations
+                WHERE id = %s
             """, (conversation_id,))
             
             unread_result = cur.fetchone()
@@ -3166,6 +4188,74 @@ def student_dashboard():
 #     except Exception as e:
 #         flash(f'Error loading story: {str(e)}', 'danger')
 #         return redirect(url_for('student_dashboard'))
+# The reader loads one page at a time: view_story embeds the student's current page
+# and the client fetches others from /api/story/<id>/page/<n> as it navigates.
+# Page numbers here are positions (1..page_count), as page_number may have gaps.
+READER_IMAGE_SIZES = '(max-width: 900px) 100vw, 900px'
+
+def load_story_page(cur, story_id, position, student_id):
+    """Page at a 1-based position with its puzzle and the student's puzzle progress.
+
+    Returns (payload, next_image): payload is None past the last page, and
+    next_image holds the image variants of the following page, if any.
+    """
+    # The next page's row comes along only for its image, to preload it
+    cur.execute("""
+        SELECT * FROM story_pages
+        WHERE story_id = %s
+        ORDER BY page_number
+        LIMIT 2 OFFSET %s
+    """, (story_id, position - 1))
+    rows = cur.fetchall()
+    if not rows:
+        return None, None
+
+    page = rows[0]
+    if page['image_url']:
+        page['image'] = image_derivatives.variants('story_pages', page['image_url'])
+    next_image = None
+    if len(rows) > 1 and rows[1]['image_url']:
+        next_image = image_derivatives.variants('story_pages', rows[1]['image_url'])
+
+    # Puzzles are generated in the background when the story is saved
+    cur.execute("""
+        SELECT spp.*, pt.name as puzzle_type_name
+        FROM story_page_puzzles spp
+        JOIN puzzle_types pt ON spp.puzzle_type_id = pt.id
+        WHERE spp.story_page_id = %s
+    """, (page['id'],))
+    puzzle = cur.fetchone()
+
+    # Stories saved before background generation existed: queue it, don't wait
+    if not puzzle and page['text_content']:
+        schedule_story_puzzles(story_id)
+
+    student_puzzle_progress = None
+    if puzzle:
+        cur.execute("""
+            SELECT * FROM student_puzzle_progress
+            WHERE student_id = %s AND puzzle_id = %s
+        """, (student_id, puzzle['id']))
+        student_puzzle_progress = cur.fetchone()
+
+    payload = {
+        'number': position,
+        'page': page,
+        'puzzle': puzzle,
+        'student_puzzle_progress': student_puzzle_progress,
+        'next_image': next_image
+    }
+    return payload, next_image
+
+def add_preload_link(response, image):
+    """Link: rel=preload header so the browser fetches the next page's image early"""
+    if image:
+        link = f'<{image["src"]}>; rel=preload; as=image'
+        if image['srcset']:
+            link += f'; imagesrcset="{image["srcset"]}"; imagesizes="{READER_IMAGE_SIZES}"'
+        response.headers.add('Link', link)
+    return response
+
 # Updated student story view route with puzzles
 @app.route('/student/story/<int:story_id>')
 @student_required
@@ -3186,18 +4276,7 @@ def view_story(story_id):
             flash('Story not found', 'danger')
             return redirect(url_for('student_dashboard'))
         
-        # Get story pages
-        cur.execute("""
-            SELECT * FROM story_pages
-            WHERE story_id = %s
-            ORDER BY page_number
-        """, (story_id,))
-        pages = cur.fetchall()
-        
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        student_id = student['id']
+        student_id = g.student_id
         
         # Get or create student progress
         cur.execute("""
@@ -3207,7 +4286,7 @@ def view_story(story_id):
         
         progress = cur.fetchone()
         
-        total_pages = len(pages)
+        total_pages = story['page_count']
         
         if not progress:
             # Create new progress entry
@@ -3216,6 +4295,7 @@ def view_story(story_id):
                 (student_id, story_id, current_page, started_at, is_completed)
                 VALUES (%s, %s, 1, NOW(), FALSE)
             """, (student_id, story_id))
+            record_story_progress(cur, story_id, g.class_level, started=1)
             mysql.connection.commit()
             
             cur.execute("""
@@ -3224,90 +4304,61 @@ def view_story(story_id):
             """, (student_id, story_id))
             progress = cur.fetchone()
         
-        current_page = progress['current_page']
-        current_page_data = pages[current_page - 1]
-        
-        # Check if puzzle exists for this page, if not create one
-        cur.execute("""
-            SELECT spp.*, pt.name as puzzle_type_name
-            FROM story_page_puzzles spp
-            JOIN puzzle_types pt ON spp.puzzle_type_id = pt.id
-            WHERE spp.story_page_id = %s
-        """, (current_page_data['id'],))
-        
-        puzzle = cur.fetchone()
+        # Page turns this worker hasn't flushed yet are newer than the row
+        pending = progress_buffer.pending(student_id, story_id) if progress_buffer else None
+        if pending:
+            progress = dict(progress, current_page=pending.current_page,
+                            is_completed=progress['is_completed'] or pending.is_completed)
         
-        # If no puzzle exists for this page, create one automatically
-        if not puzzle and current_page_data['text_content']:
-            # Choose a random puzzle type based on text length
-            text_length = len(current_page_data['text_content'])
-            
-            if text_length > 200:
-                puzzle_types = ['word_search', 'fill_blank', 'multiple_choice']
-            elif text_length > 100:
-                puzzle_types = ['true_false', 'multiple_choice', 'fill_blank']
-            else:
-                puzzle_types = ['true_false', 'multiple_choice']
-            
-            selected_type = random.choice(puzzle_types)
-            
-            # Get puzzle type ID
-            cur.execute("SELECT id FROM puzzle_types WHERE name = %s", (selected_type,))
-            puzzle_type = cur.fetchone()
-            
-            if puzzle_type:
-                # Generate puzzle from text content
-                puzzle_data = generate_puzzle_from_text(
-                    current_page_data['text_content'], 
-                    selected_type
-                )
-                
-                # Save puzzle to database
-                cur.execute("""
-                    INSERT INTO story_page_puzzles 
-                    (story_page_id, puzzle_type_id, puzzle_data, difficulty, time_limit, required_score)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    current_page_data['id'],
-                    puzzle_type['id'],
-                    json.dumps(puzzle_data),
-                    'medium',
-                    180,
-                    70
-                ))
-                mysql.connection.commit()
-                
-                # Get the newly created puzzle
-                cur.execute("""
-                    SELECT spp.*, pt.name as puzzle_type_name
-                    FROM story_page_puzzles spp
-                    JOIN puzzle_types pt ON spp.puzzle_type_id = pt.id
-                    WHERE spp.story_page_id = %s
-                """, (current_page_data['id'],))
-                puzzle = cur.fetchone()
-        
-        # Get student's puzzle progress for this page
-        student_puzzle_progress = None
-        if puzzle:
-            cur.execute("""
-                SELECT * FROM student_puzzle_progress
-                WHERE student_id = %s AND puzzle_id = %s
-            """, (student_id, puzzle['id']))
-            student_puzzle_progress = cur.fetchone()
+        # The story may have lost pages since the student was last here
+        current_page = max(1, min(progress['current_page'], total_pages))
+        progress = dict(progress, current_page=current_page)
         
+        page_data, next_image = load_story_page(cur, story_id, current_page, student_id)
         cur.close()
         
-        return render_template('student/story_view.html', 
-                             story=story, 
-                             pages=pages, 
-                             progress=progress,
-                             total_pages=total_pages,
-                             current_page_data=current_page_data,
-                             puzzle=puzzle,
-                             student_puzzle_progress=student_puzzle_progress)
+        if not page_data:
+            flash('This story has no pages yet', 'warning')
+            return redirect(url_for('student_dashboard'))
+        
+        response = make_response(render_template('student/story_view.html', 
+                                                 story=story, 
+                                                 progress=progress,
+                                                 total_pages=total_pages,
+                                                 page_data=page_data))
+        return add_preload_link(response, next_image)
     except Exception as e:
         flash(f'Error loading story: {str(e)}', 'danger')
         return redirect(url_for('student_dashboard'))
+
+@app.route('/api/story/<int:story_id>/page/<int:page_number>')
+@student_required
+@api_error_handler
+def get_story_page(story_id, page_number):
+    """One page of a published story for the reader, with its puzzle state"""
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute("""
+            SELECT page_count FROM stories
+            WHERE id = %s AND is_published = TRUE
+        """, (story_id,))
+        story = cur.fetchone()
+        if not story:
+            return jsonify({'success': False, 'error': 'Story not found'}), 404
+
+        page_data = None
+        next_image = None
+        if 1 <= page_number <= story['page_count']:
+            page_data, next_image = load_story_page(cur, story_id, page_number, g.student_id)
+    finally:
+        cur.close()
+
+    if not page_data:
+        return jsonify({'success': False, 'error': 'Page not found'}), 404
+
+    response = jsonify(dict(page_data, success=True, total_pages=story['page_count']))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return add_preload_link(response, next_image)
       
 # @app.route('/api/update_progress', methods=['POST'])
 # @student_required
@@ -3376,9 +4427,109 @@ def view_story(story_id):
 #         })
 #     except Exception as e:
 #         return jsonify({'success': False, 'error': str(e)}), 500
+# Page counts change only when a teacher edits a story but are read on every page turn
+_page_counts = {}  # story_id -> (page_count, expires_at)
+_page_counts_lock = threading.Lock()
+PAGE_COUNT_TTL = 30  # seconds; other workers pick up edits within this
+
+def get_story_page_count(story_id):
+    now = time.monotonic()
+    with _page_counts_lock:
+        cached = _page_counts.get(story_id)
+    if cached and cached[1] > now:
+        return cached[0]
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute("SELECT page_count FROM stories WHERE id = %s", (story_id,))
+        row = cur.fetchone()
+        total_pages = row['page_count'] if row else 0
+    finally:
+        cur.close()
+    with _page_counts_lock:
+        _page_counts[story_id] = (total_pages, now + PAGE_COUNT_TTL)
+    return total_pages
+
+def invalidate_story_page_count(story_id):
+    with _page_counts_lock:
+        _page_counts.pop(story_id, None)
+
+# completed_at is assigned before is_completed so it sees the old value: it is set once,
+# when the story first becomes completed. Only plain placeholders in VALUES, so
+# executemany sends a batch as one multi-row statement.
+PROGRESS_UPSERT = """
+    INSERT INTO student_progress
+        (student_id, story_id, current_page, is_completed, started_at, completed_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        completed_at = IF(VALUES(is_completed) AND NOT is_completed, VALUES(completed_at), completed_at),
+        is_completed = is_completed OR VALUES(is_completed),
+        current_page = VALUES(current_page)
+"""
+
+def write_progress_entries(cur, entries):
+    """Upsert progress entries and count newly started/completed stories in the rollups.
+
+    A single page turn that doesn't complete the story is one statement. Completions
+    and batches first lock the existing rows to see which transitions are new.
+    """
+    entries = sorted(entries, key=lambda e: (e.student_id, e.story_id))  # consistent lock order
+    existing = None
+    if len(entries) > 1 or entries[0].is_completed:
+        placeholders = ', '.join(['(%s, %s)'] * len(entries))
+        cur.execute(f"""
+            SELECT student_id, story_id, is_completed
+            FROM student_progress
+            WHERE (student_id, story_id) IN ({placeholders})
+            FOR UPDATE
+        """, [value for e in entries for value in (e.student_id, e.story_id)])
+        existing = {(row['student_id'], row['story_id']): row['is_completed'] for row in cur.fetchall()}
+
+    cur.executemany(PROGRESS_UPSERT, [
+        (e.student_id, e.story_id, e.current_page, e.is_completed, e.first_seen, e.completed_at)
+        for e in entries
+    ])
+    if existing is None:
+        # One row: 1 affected row means it was inserted, 2 (or 0) that it existed
+        existing = {} if cur.rowcount == 1 else {(entries[0].student_id, entries[0].story_id): False}
+
+    deltas = {}
+    for e in entries:
+        key = (e.student_id, e.story_id)
+        started = 0 if key in existing else 1
+        completed = 1 if e.is_completed and not existing.get(key) else 0
+        if started or completed:
+            delta = deltas.setdefault((e.story_id, e.class_level), [0, 0])
+            delta[0] += started
+            delta[1] += completed
+    for (story_id, class_level), (started, completed) in sorted(deltas.items()):
+        record_story_progress(cur, story_id, class_level, started=started, completed=completed)
+
+def flush_progress_entries(entries):
+    """ProgressBuffer callback: write a batch in one transaction"""
+    with app.app_context():
+        cur = mysql.connection.cursor()
+        try:
+            write_progress_entries(cur, entries)
+            mysql.connection.commit()
+        except Exception:
+            mysql.connection.rollback()
+            raise
+        finally:
+            cur.close()
+    logger.debug(f"Flushed {len(entries)} buffered progress updates")
+
+# Optional write-behind buffering of page turns (PROGRESS_WRITE_MODE = 'buffered')
+progress_buffer = None
+if app.config['PROGRESS_WRITE_MODE'] == 'buffered':
+    progress_buffer = ProgressBuffer(flush_progress_entries,
+                                     interval=app.config['PROGRESS_FLUSH_INTERVAL'],
+                                     max_pending=app.config['PROGRESS_FLUSH_MAX'])
+    app.extensions['progress_buffer'] = progress_buffer
+
 @app.route('/api/update_progress', methods=['POST'])
 @student_required
 def update_progress():
+    cur = None
     try:
         data = request.json
         story_id = data.get('story_id')
@@ -3387,72 +4538,32 @@ def update_progress():
         if not story_id or not current_page:
             return jsonify({'success': False, 'error': 'Missing story_id or current_page'}), 400
         
-        cur = mysql.connection.cursor()
-        
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student_result = cur.fetchone()
-        
-        if not student_result:
-            cur.close()
+        student_id = g.student_id
+        if not student_id:
             return jsonify({'success': False, 'error': 'Student not found'}), 404
         
-        student_id = student_result['id']
-        
-        # Get total pages in the story
-        cur.execute("SELECT COUNT(*) as total_pages FROM story_pages WHERE story_id = %s", (story_id,))
-        total_pages_result = cur.fetchone()
-        total_pages = total_pages_result['total_pages'] if total_pages_result and total_pages_result['total_pages'] else 0
+        total_pages = get_story_page_count(story_id)
         
         # Ensure current_page doesn't exceed total_pages
-        if current_page > total_pages:
-            current_page = total_pages
+        current_page = min(int(current_page), total_pages)
         
         # Check if this is the last page
         is_completed = current_page >= total_pages
         
-        # Check if progress entry already exists
-        cur.execute("SELECT * FROM student_progress WHERE student_id = %s AND story_id = %s", 
-                   (student_id, story_id))
-        existing_progress = cur.fetchone()
+        entry = ProgressEntry(student_id, story_id, g.class_level, current_page, is_completed, datetime.now())
         
-        if existing_progress:
-            # Update existing progress
-            if is_completed and not existing_progress['is_completed']:
-                # Story just completed - set completed_at
-                cur.execute("""
-                    UPDATE student_progress 
-                    SET current_page = %s, 
-                        is_completed = TRUE,
-                        completed_at = NOW()
-                    WHERE student_id = %s AND story_id = %s
-                """, (current_page, student_id, story_id))
-            else:
-                # Just updating page, not completing
-                cur.execute("""
-                    UPDATE student_progress 
-                    SET current_page = %s
-                    WHERE student_id = %s AND story_id = %s
-                """, (current_page, student_id, story_id))
+        if progress_buffer and not (is_completed and app.config['PROGRESS_SYNC_COMPLETION']):
+            progress_buffer.record(entry)
         else:
-            # Insert new progress entry
-            if is_completed:
-                # Story completed in first go
-                cur.execute("""
-                    INSERT INTO student_progress 
-                    (student_id, story_id, current_page, is_completed, started_at, completed_at)
-                    VALUES (%s, %s, %s, TRUE, NOW(), NOW())
-                """, (student_id, story_id, current_page))
-            else:
-                # Story not completed yet
-                cur.execute("""
-                    INSERT INTO student_progress 
-                    (student_id, story_id, current_page, is_completed, started_at)
-                    VALUES (%s, %s, %s, FALSE, NOW())
-                """, (student_id, story_id, current_page))
-        
-        mysql.connection.commit()
-        cur.close()
+            if progress_buffer:
+                # Fold in any buffered turns so a later flush can't rewind this write
+                pending = progress_buffer.take(student_id, story_id)
+                if pending:
+                    pending.merge(entry)
+                    entry = pending
+            cur = mysql.connection.cursor()
+            write_progress_entries(cur, [entry])
+            mysql.connection.commit()
         
         return jsonify({
             'success': True, 
@@ -3462,7 +4573,14 @@ def update_progress():
         })
     except Exception as e:
         app.logger.error(f"Error updating progress: {str(e)}")
+        try:
+            mysql.connection.rollback()
+        except:
+            pass
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
           
 # @app.route('/student/quiz/<int:story_id>', methods=['GET', 'POST'])
 # @student_required
@@ -3636,11 +4754,8 @@ def take_quiz(story_id):
     try:
         cur = mysql.connection.cursor()
         
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
-        
-        if not student:
+        student_id = g.student_id
+        if not student_id:
             flash('Student not found', 'danger')
             return redirect(url_for('student_dashboard'))
         
@@ -3652,7 +4767,7 @@ def take_quiz(story_id):
             WHERE q.story_id = %s AND sqa.student_id = %s
             ORDER BY sqa.submitted_at DESC
             LIMIT 1
-        """, (story_id, student['id']))
+        """, (story_id, student_id))
         
         previous_attempt = cur.fetchone()
         
@@ -3749,38 +4864,50 @@ def take_quiz(story_id):
             cur.execute("""
                 INSERT INTO student_quiz_attempts (student_id, quiz_id, score, time_taken, submitted_at)
                 VALUES (%s, %s, %s, %s, NOW())
-            """, (student['id'], quiz['id'], percentage_score, request.form.get('time_taken', 0)))
+            """, (student_id, quiz['id'], percentage_score, request.form.get('time_taken', 0)))
             
             attempt_id = cur.lastrowid
             
-            # Record answers - ONLY FOR THIS STUDENT
-            for answer in answers:
-                cur.execute("""
+            # Record answers - ONLY FOR THIS STUDENT (one multi-row INSERT)
+            if answers:
+                cur.executemany("""
                     INSERT INTO student_quiz_answers (attempt_id, question_id, student_answer, is_correct)
                     VALUES (%s, %s, %s, %s)
-                """, (attempt_id, answer['question_id'], answer['student_answer'], answer['is_correct']))
+                """, [(attempt_id, answer['question_id'], answer['student_answer'], answer['is_correct'])
+                      for answer in answers])
             
-            mysql.connection.commit()
+            # students_passed counts each student once, at their first passing attempt
+            passed = percentage_score >= quiz['passing_score']
+            first_pass = False
+            if passed:
+                cur.execute("""
+                    SELECT COUNT(*) AS passes FROM student_quiz_attempts
+                    WHERE quiz_id = %s AND student_id = %s AND score >= %s
+                """, (quiz['id'], student_id, quiz['passing_score']))
+                first_pass = cur.fetchone()['passes'] == 1
+            record_quiz_attempt(cur, story_id, quiz['id'], g.class_level, percentage_score, passed, first_pass)
+            record_quiz_answers(cur, quiz['id'], percentage_score, answers)
             
-            # Get statistics - AGGREGATED DATA ONLY (no individual answers)
+            # Get statistics - AGGREGATED DATA ONLY (no individual answers),
+            # from the quiz_stats row this attempt just updated
             cur.execute("""
-                SELECT 
-                    COUNT(*) as total_attempts,
-                    ROUND(AVG(score), 2) as average_score,
-                    SUM(CASE WHEN score >= %s THEN 1 ELSE 0 END) as passed_count,
-                    SUM(CASE WHEN score < %s THEN 1 ELSE 0 END) as failed_count
-                FROM student_quiz_attempts
+                SELECT total_attempts,
+                       ROUND(score_sum / NULLIF(total_attempts, 0), 2) as average_score,
+                       passed_count,
+                       failed_count
+                FROM quiz_stats
                 WHERE quiz_id = %s
-            """, (quiz['passing_score'], quiz['passing_score'], quiz['id']))
+            """, (quiz['id'],))
             
             stats = cur.fetchone()
             
+            mysql.connection.commit()
             cur.close()
             
             return render_template('student/quiz_result.html', 
                                  quiz=quiz, 
                                  score=percentage_score, 
-                                 passed=percentage_score >= quiz['passing_score'],
+                                 passed=passed,
                                  total_points=total_points,
                                  earned_points=score,
                                  stats=stats,
@@ -3977,9 +5104,7 @@ def check_quiz_attempt(story_id):
     try:
         cur = mysql.connection.cursor()
         
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
+        student_id = g.student_id
         
         # Check if quiz has been attempted
         cur.execute("""
@@ -3987,7 +5112,7 @@ def check_quiz_attempt(story_id):
             FROM student_quiz_attempts sqa
             JOIN quizzes q ON sqa.quiz_id = q.id
             WHERE q.story_id = %s AND sqa.student_id = %s
-        """, (story_id, student['id']))
+        """, (story_id, student_id))
         
         result = cur.fetchone()
         cur.close()
@@ -4064,9 +5189,7 @@ def view_quiz_results(story_id):
     try:
         cur = mysql.connection.cursor()
         
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
+        student_id = g.student_id
         
         # Get quiz details
         cur.execute("""
@@ -4088,7 +5211,7 @@ def view_quiz_results(story_id):
             WHERE sqa.quiz_id = %s AND sqa.student_id = %s
             ORDER BY sqa.submitted_at DESC
             LIMIT 1
-        """, (quiz['id'], student['id']))
+        """, (quiz['id'], student_id))
         
         attempt = cur.fetchone()
         
@@ -4211,35 +5334,24 @@ def teacher_dashboard():
         """, (session['user_id'],))
         teacher = cur.fetchone()
         
-        # Get statistics
-        cur.execute("""
-            SELECT 
-                COUNT(DISTINCT s.id) as total_stories,
-                COUNT(DISTINCT ca.class_level) as total_classes,
-                COUNT(DISTINCT st.id) as total_students,
-                AVG(sqa.score) as avg_quiz_score
-            FROM teachers t
-            LEFT JOIN stories s ON t.id = s.teacher_id AND s.is_published = TRUE
-            LEFT JOIN class_assignments ca ON s.id = ca.story_id
-            LEFT JOIN students st ON ca.class_level = st.class_level
-            LEFT JOIN quizzes q ON s.id = q.story_id
-            LEFT JOIN student_quiz_attempts sqa ON q.id = sqa.quiz_id
-            WHERE t.id = %s
-        """, (teacher['id'],))
-        
-        stats = cur.fetchone()
+        # Get statistics (from the rollup tables)
+        teacher_stats = get_teacher_stats(cur, teacher['id'])
+        class_totals = get_teacher_class_totals(cur, teacher['id'], published_only=True)
+        stats = {
+            'total_stories': teacher_stats['published_stories'],
+            'total_classes': class_totals['total_classes'],
+            'total_students': class_totals['total_students'],
+            'avg_quiz_score': teacher_stats['avg_quiz_score']
+        }
         
         # Get recent stories
         cur.execute("""
             SELECT s.*, 
-                   COUNT(DISTINCT sp.student_id) as student_count,
-                   COUNT(DISTINCT sqa.id) as quiz_attempts
+                   COALESCE(ss.students_started, 0) as student_count,
+                   COALESCE(ss.quiz_attempts, 0) as quiz_attempts
             FROM stories s
-            LEFT JOIN student_progress sp ON s.id = sp.story_id
-            LEFT JOIN quizzes q ON s.id = q.story_id
-            LEFT JOIN student_quiz_attempts sqa ON q.id = sqa.quiz_id
+            LEFT JOIN story_stats ss ON ss.story_id = s.id
             WHERE s.teacher_id = %s
-            GROUP BY s.id
             ORDER BY s.created_at DESC
             LIMIT 5
         """, (teacher['id'],))
@@ -4274,17 +5386,7 @@ def teacher_dashboard():
         chat_students = cur.fetchall()
 
         # Get unread count for teacher
-        cur.execute("""
-            SELECT COUNT(*) as unread_count
-            FROM chat_messages cm
-            JOIN chat_conversations cc ON cm.conversation_id = cc.id
-            WHERE cc.teacher_id = %s 
-              AND cm.sender_type = 'student'
-              AND cm.is_read = FALSE
-        """, (teacher['id'],))
-        
-        unread_result = cur.fetchone()
-        unread_count = unread_result['unread_count'] if unread_result else 0
+        unread_count = get_unread_total(cur, 'teacher', teacher['id'], 'chat_unread')
 
         # ============================================================
 
@@ -4310,14 +5412,12 @@ def teacher_stories():
     try:
         cur = mysql.connection.cursor()
         
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
+        teacher_id = g.teacher_id
         
         cur.execute("""
             SELECT s.*, 
                    COUNT(DISTINCT sp.student_id) as student_count,
-                   COUNT(DISTINCT sqa.id) as quiz_attempts,
-                   (SELECT COUNT(*) FROM story_pages WHERE story_id = s.id) as page_count
+                   COUNT(DISTINCT sqa.id) as quiz_attempts
             FROM stories s
             LEFT JOIN student_progress sp ON s.id = sp.story_id
             LEFT JOIN quizzes q ON s.id = q.story_id
@@ -4325,7 +5425,7 @@ def teacher_stories():
             WHERE s.teacher_id = %s
             GROUP BY s.id
             ORDER BY s.created_at DESC
-        """, (teacher['id'],))
+        """, (teacher_id,))
         
         stories = cur.fetchall()
         cur.close()
@@ -4515,19 +5615,13 @@ def view_story_details(story_id):
         
         pages = cur.fetchall()
         
-        # Get puzzles for each page
-        puzzles_by_page = {}
-        for page in pages:
-            cur.execute("""
-                SELECT spp.*, pt.name as puzzle_type_name
-                FROM story_page_puzzles spp
-                JOIN puzzle_types pt ON spp.puzzle_type_id = pt.id
-                WHERE spp.story_page_id = %s
-            """, (page['id'],))
-            
-            puzzle = cur.fetchone()
-            if puzzle:
-                puzzles_by_page[page['id']] = puzzle
+        # Get puzzles for all pages at once
+        puzzles_by_page = fetch_rows_by_ids(cur, """
+            SELECT spp.*, pt.name as puzzle_type_name
+            FROM story_page_puzzles spp
+            JOIN puzzle_types pt ON spp.puzzle_type_id = pt.id
+            WHERE spp.story_page_id IN ({ids})
+        """, [page['id'] for page in pages], key='story_page_id')
         
         # Get assigned classes
         cur.execute("""
@@ -4541,12 +5635,13 @@ def view_story_details(story_id):
         cur.execute("""
             SELECT st.first_name, st.last_name, st.class_level, st.roll_number,
                    sp.current_page, sp.is_completed, sp.completed_at, sp.started_at,
-                   (SELECT COUNT(*) FROM story_pages WHERE story_id = %s) as total_pages
+                   s.page_count as total_pages
             FROM student_progress sp
             JOIN students st ON sp.student_id = st.id
+            JOIN stories s ON s.id = sp.story_id
             WHERE sp.story_id = %s
             ORDER BY st.class_level, st.roll_number
-        """, (story_id, story_id))
+        """, (story_id,))
         
         student_progress = cur.fetchall()
         
@@ -4580,6 +5675,104 @@ def view_story_details(story_id):
     except Exception as e:
         flash(f'Error loading story details: {str(e)}', 'danger')
         return redirect(url_for('teacher_stories'))
+
+
+# ====================== Chunked uploads ==================================================
+# Story media is sent ahead of the story form as resumable chunks (see
+# uploads.py and static/js/uploads.js); the form then posts the upload ids
+# (cover_upload_id, page_upload_id_N) instead of the files.
+
+@app.route('/api/uploads', methods=['POST'])
+@teacher_required
+def create_upload():
+    """Open an upload session: {purpose, filename, size, sha256?}"""
+    cur = None
+    try:
+        data = request.get_json(silent=True) or {}
+        purpose = data.get('purpose')
+        filename = (data.get('filename') or '').strip()
+        if purpose not in UPLOAD_PURPOSES:
+            return jsonify({'success': False, 'error': 'Unknown upload purpose'}), 400
+        if not filename or not allowed_file(filename, UPLOAD_PURPOSES[purpose][1]):
+            return jsonify({'success': False, 'error': 'File type not allowed'}), 400
+
+        cur = mysql.connection.cursor()
+        upload_store.purge_expired(cur)
+        upload = upload_store.create(cur, session['user_id'], purpose, filename,
+                                     data.get('size'), data.get('sha256'))
+        mysql.connection.commit()
+        return jsonify({'success': True, 'upload': upload_store.payload(upload)}), 201
+    except ValueError as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error creating upload: {str(e)}")
+        logger.error(traceback.format_exc())
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@teacher_required
+def get_upload(upload_id):
+    """Where an interrupted upload should resume"""
+    cur = None
+    try:
+        cur = mysql.connection.cursor()
+        upload = upload_store.get(cur, upload_id, session['user_id'])
+        if not upload:
+            return jsonify({'success': False, 'error': 'Upload not found'}), 404
+        return jsonify({'success': True, 'upload': upload_store.payload(upload)})
+    except Exception as e:
+        logger.error(f"Error loading upload {upload_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@teacher_required
+def upload_chunk(upload_id):
+    """Append the raw request body at the Upload-Offset header's position"""
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'success': False, 'error': 'Missing Upload-Offset header'}), 400
+    if request.content_length is None:
+        return jsonify({'success': False, 'error': 'Content-Length required'}), 411
+
+    cur = None
+    try:
+        cur = mysql.connection.cursor()
+        upload = upload_store.append(cur, upload_id, session['user_id'], offset,
+                                     request.stream, request.content_length)
+        if upload is None:
+            return jsonify({'success': False, 'error': 'Upload not found'}), 404
+        mysql.connection.commit()
+
+        if upload['status'] == 'failed':
+            return jsonify({'success': False, 'error': 'Checksum mismatch; upload the file again',
+                            'upload': upload_store.payload(upload)}), 422
+        # A duplicate's derivatives were built when it was first stored
+        is_image = UPLOAD_PURPOSES[upload['purpose']][1] == 'image'
+        if upload['status'] == 'complete' and is_image and not upload.get('duplicate'):
+            image_derivatives.schedule(UPLOAD_PURPOSES[upload['purpose']][0], upload['stored_name'])
+        return jsonify({'success': True, 'upload': upload_store.payload(upload)})
+    except UploadConflict as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e), 'offset': e.offset}), 409
+    except ValueError as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error writing chunk for upload {upload_id}: {str(e)}")
+        logger.error(traceback.format_exc())
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
     
 
 # # main   
@@ -4681,8 +5874,7 @@ def create_story():
     if request.method == 'POST':
         try:
             cur = mysql.connection.cursor()
-            cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-            teacher = cur.fetchone()
+            teacher_id = g.teacher_id
 
             title = request.form.get('title')
             description = request.form.get('description')
@@ -4691,25 +5883,26 @@ def create_story():
 
             # ---------------- SAVE COVER IMAGE ----------------
             cover_image = None
-            if 'cover_image' in request.files:
+            cover_upload_id = request.form.get('cover_upload_id')
+            if cover_upload_id:
+                cover_image = upload_store.attach(cur, cover_upload_id, session['user_id'], 'story_cover')
+            elif 'cover_image' in request.files:
                 file = request.files['cover_image']
                 if file and file.filename != '' and allowed_file(file.filename):
-                    filename = secure_filename(f"{int(time.time())}_{file.filename}")
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'stories', filename)
-                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                    file.save(filepath)
-                    cover_image = filename
+                    cover_image = save_file(file, os.path.join(app.config['UPLOAD_FOLDER'], 'stories'))
 
             # ---------------- CREATE STORY ----------------
             cur.execute("""
                 INSERT INTO stories (teacher_id, title, description, cover_image, is_published)
                 VALUES (%s, %s, %s, %s, %s)
-            """, (teacher['id'], title, description, cover_image, is_published))
+            """, (teacher_id, title, description, cover_image, is_published))
 
             story_id = cur.lastrowid
+            blob_store.set_refs(cur, 'story_cover', [(story_id, cover_image)])
 
             # ---------------- SAVE STORY PAGES (NO JSON) ----------------
             page_number = 1
+            page_images = []  # (page id, image file) for blob_refs
 
             while True:
                 text = request.form.get(f'page_text_{page_number}')
@@ -4722,16 +5915,13 @@ def create_story():
                 page_file_key = f'page_image_{page_number}'
                 image_url = 'default_page_image.jpg'
 
-                if page_file_key in request.files:
+                page_upload_id = request.form.get(f'page_upload_id_{page_number}')
+                if page_upload_id:
+                    image_url = upload_store.attach(cur, page_upload_id, session['user_id'], 'story_page')
+                elif page_file_key in request.files:
                     file = request.files[page_file_key]
                     if file and file.filename != '' and allowed_file(file.filename):
-                        filename = secure_filename(
-                            f"{story_id}_page_{page_number}_{int(time.time())}_{file.filename}"
-                        )
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'story_pages', filename)
-                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                        file.save(filepath)
-                        image_url = filename
+                        image_url = save_file(file, os.path.join(app.config['UPLOAD_FOLDER'], 'story_pages'))
 
                 cur.execute("""
                     INSERT INTO story_pages
@@ -4745,20 +5935,29 @@ def create_story():
                     notes,
                     int(duration)
                 ))
+                page_images.append((cur.lastrowid, image_url))
 
                 page_number += 1
 
+            blob_store.set_refs(cur, 'story_page', page_images)
+
             # ---------------- ASSIGN TO CLASSES ----------------
-            for class_level in assigned_classes:
-                if class_level.strip():
-                    cur.execute("""
-                        INSERT INTO class_assignments (story_id, class_level, assigned_by)
-                        VALUES (%s, %s, %s)
-                    """, (story_id, class_level.strip(), teacher['id']))
+            class_rows = [(story_id, class_level.strip(), teacher_id)
+                          for class_level in assigned_classes if class_level.strip()]
+            if class_rows:
+                cur.executemany("""
+                    INSERT INTO class_assignments (story_id, class_level, assigned_by)
+                    VALUES (%s, %s, %s)
+                """, class_rows)
+
+            refresh_story_counters(cur, story_id)
+            record_teacher_stories(cur, teacher_id, total=1, published=int(is_published))
 
             mysql.connection.commit()
             cur.close()
 
+            schedule_story_puzzles(story_id)
+
             flash('Story created successfully!', 'success')
             return redirect(url_for('teacher_stories'))
 
@@ -4835,10 +6034,7 @@ def edit_story(story_id):
     cur.execute("SELECT teacher_id FROM stories WHERE id = %s", (story_id,))
     story = cur.fetchone()
 
-    cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-    teacher = cur.fetchone()
-
-    if not story or story['teacher_id'] != teacher['id']:
+    if not story or story['teacher_id'] != g.teacher_id:
         flash('Access denied', 'danger')
         return redirect(url_for('teacher_stories'))
 
@@ -4852,16 +6048,17 @@ def edit_story(story_id):
 
             # -------- UPDATE COVER IMAGE (OPTIONAL) --------
             cover_image = None
-            if 'cover_image' in request.files:
+            cover_upload_id = request.form.get('cover_upload_id')
+            if cover_upload_id:
+                cover_image = upload_store.attach(cur, cover_upload_id, session['user_id'], 'story_cover')
+            elif 'cover_image' in request.files:
                 file = request.files['cover_image']
                 if file and file.filename != '' and allowed_file(file.filename):
-                    filename = secure_filename(f"{int(time.time())}_{file.filename}")
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'stories', filename)
-                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                    file.save(filepath)
-                    cover_image = filename
+                    cover_image = save_file(file, os.path.join(app.config['UPLOAD_FOLDER'], 'stories'))
 
             # -------- UPDATE STORY --------
+            cur.execute("SELECT is_published FROM stories WHERE id = %s FOR UPDATE", (story_id,))
+            was_published = bool(cur.fetchone()['is_published'])
             if cover_image:
                 cur.execute("""
                     UPDATE stories
@@ -4884,26 +6081,23 @@ def edit_story(story_id):
 
             # -------- UPDATE ASSIGNED CLASSES --------
             cur.execute("DELETE FROM class_assignments WHERE story_id = %s", (story_id,))
-            for class_level in assigned_classes:
-                if class_level.strip():
-                    cur.execute("""
-                        INSERT INTO class_assignments (story_id, class_level, assigned_by)
-                        VALUES (%s, %s, %s)
-                    """, (story_id, class_level.strip(), teacher['id']))
-
-            # -------- LOAD EXISTING PAGE IMAGES (CRITICAL FIX) --------
+            class_rows = [(story_id, class_level.strip(), g.teacher_id)
+                          for class_level in assigned_classes if class_level.strip()]
+            if class_rows:
+                cur.executemany("""
+                    INSERT INTO class_assignments (story_id, class_level, assigned_by)
+                    VALUES (%s, %s, %s)
+                """, class_rows)
+
+            # -------- UPDATE STORY PAGES (only what changed) --------
+            # Existing pages keep their rows, so their puzzles and the students'
+            # puzzle progress survive the edit; the form posts each row's id as page_id_N
             cur.execute("""
-                SELECT page_number, image_url
+                SELECT id, page_number, image_url, text_content, important_notes, duration_seconds
                 FROM story_pages
                 WHERE story_id = %s
             """, (story_id,))
-            existing_images = {
-                row['page_number']: row['image_url']
-                for row in cur.fetchall()
-            }
-
-            # -------- UPDATE STORY PAGES --------
-            cur.execute("DELETE FROM story_pages WHERE story_id = %s", (story_id,))
+            existing_pages = {row['id']: row for row in cur.fetchall()}
 
             # Detect page numbers safely
             page_numbers = []
@@ -4917,45 +6111,113 @@ def edit_story(story_id):
 
             page_numbers = sorted(page_numbers)
 
+            kept_ids = set()
+            updates = []        # (page_number, image_url, text, notes, duration, id)
+            new_pages = []      # (story_id, page_number, image_url, text, notes, duration)
+            text_changed = []   # page ids whose puzzles were made from the old text
+
             for page_number in page_numbers:
                 text = request.form.get(f'page_text_{page_number}')
                 if not text:
                     continue
 
                 notes = request.form.get(f'page_notes_{page_number}', '')
-                duration = request.form.get(f'page_duration_{page_number}', 10)
+                duration = int(request.form.get(f'page_duration_{page_number}', 10))
+
+                page_id = request.form.get(f'page_id_{page_number}', type=int)
+                existing = existing_pages.get(page_id)
+                if existing and page_id in kept_ids:
+                    existing = None
 
                 page_file_key = f'page_image_{page_number}'
 
                 # ✅ DEFAULT = EXISTING IMAGE FROM DB
-                image_url = existing_images.get(page_number, 'default_page_image.jpg')
+                image_url = existing['image_url'] if existing else 'default_page_image.jpg'
 
                 # If new image uploaded, replace ONLY that page
-                if page_file_key in request.files:
+                page_upload_id = request.form.get(f'page_upload_id_{page_number}')
+                if page_upload_id:
+                    image_url = upload_store.attach(cur, page_upload_id, session['user_id'], 'story_page')
+                elif page_file_key in request.files:
                     file = request.files[page_file_key]
                     if file and file.filename != '' and allowed_file(file.filename):
-                        filename = secure_filename(
-                            f"{story_id}_page_{page_number}_{int(time.time())}_{file.filename}"
-                        )
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'story_pages', filename)
-                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                        file.save(filepath)
-                        image_url = filename
+                        image_url = save_file(file, os.path.join(app.config['UPLOAD_FOLDER'], 'story_pages'))
 
-                cur.execute("""
+                if not existing:
+                    new_pages.append((story_id, page_number, image_url, text, notes, duration))
+                    continue
+
+                kept_ids.add(page_id)
+                if text != existing['text_content']:
+                    text_changed.append(page_id)
+                if (page_number, image_url, text, notes or None, duration) != (
+                        existing['page_number'], existing['image_url'], existing['text_content'],
+                        existing['important_notes'] or None, existing['duration_seconds']):
+                    updates.append((page_number, image_url, text, notes, duration, page_id))
+
+            removed_ids = [page_id for page_id in existing_pages if page_id not in kept_ids]
+            if removed_ids:
+                placeholders = ', '.join(['%s'] * len(removed_ids))
+                cur.execute(f"DELETE FROM story_pages WHERE id IN ({placeholders})", removed_ids)
+
+            if updates:
+                # Move renumbered pages out of the way first: (story_id, page_number) is unique
+                moved = [(-row[0], row[-1]) for row in updates
+                         if row[0] != existing_pages[row[-1]]['page_number']]
+                if moved:
+                    cur.executemany("UPDATE story_pages SET page_number = %s WHERE id = %s", moved)
+                cur.executemany("""
+                    UPDATE story_pages
+                    SET page_number = %s, image_url = %s, text_content = %s,
+                        important_notes = %s, duration_seconds = %s
+                    WHERE id = %s
+                """, updates)
+
+            if text_changed:
+                # Puzzles are generated from the page text; students' progress on them cascades
+                placeholders = ', '.join(['%s'] * len(text_changed))
+                cur.execute(f"DELETE FROM story_page_puzzles WHERE story_page_id IN ({placeholders})",
+                            text_changed)
+
+            if new_pages:
+                cur.executemany("""
                     INSERT INTO story_pages
                     (story_id, page_number, image_url, text_content, important_notes, duration_seconds)
                     VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    story_id,
-                    page_number,
-                    image_url,
-                    text,
-                    notes,
-                    int(duration)
-                ))
+                """, new_pages)
+
+            # -------- BLOB REFERENCES (see blobs.py) --------
+            if cover_image:
+                blob_store.set_refs(cur, 'story_cover', [(story_id, cover_image)])
+            blob_store.drop_refs(cur, 'story_page', removed_ids)
+            page_images = [(row[-1], row[1]) for row in updates
+                           if row[1] != existing_pages[row[-1]]['image_url']]
+            if new_pages:
+                new_numbers = [row[1] for row in new_pages]
+                cur.execute(f"""
+                    SELECT id, image_url FROM story_pages
+                    WHERE story_id = %s AND page_number IN ({', '.join(['%s'] * len(new_numbers))})
+                """, [story_id] + new_numbers)
+                page_images.extend((row['id'], row['image_url']) for row in cur.fetchall())
+            blob_store.set_refs(cur, 'story_page', page_images)
+
+            pages_added_or_removed = bool(new_pages or removed_ids)
+            if pages_added_or_removed:
+                refresh_story_counters(cur, story_id)
+            if is_published != was_published:
+                record_teacher_stories(cur, g.teacher_id, published=1 if is_published else -1)
 
             mysql.connection.commit()
+            if pages_added_or_removed:
+                invalidate_story_page_count(story_id)
+
+            # Only new pages and pages with new text are missing puzzles
+            if new_pages or text_changed:
+                schedule_story_puzzles(story_id)
+
+            logger.info(f"Story {story_id} edited: {len(updates)} page(s) updated, "
+                        f"{len(new_pages)} added, {len(removed_ids)} removed")
+
             flash('Story and pages updated successfully!', 'success')
             return redirect(url_for('view_story_details', story_id=story_id))
 
@@ -5003,15 +6265,35 @@ def delete_story(story_id):
         cur.execute("SELECT teacher_id FROM stories WHERE id = %s", (story_id,))
         story = cur.fetchone()
         
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
-        
-        if not story or story['teacher_id'] != teacher['id']:
+        if not story or story['teacher_id'] != g.teacher_id:
             flash('Access denied', 'danger')
             return redirect(url_for('teacher_stories'))
         
-        # Delete story
+        # Its files are reclaimed by gc_blobs.py once nothing else uses them
+        cur.execute("SELECT id FROM story_pages WHERE story_id = %s", (story_id,))
+        blob_store.drop_refs(cur, 'story_page', [row['id'] for row in cur.fetchall()])
+        blob_store.drop_refs(cur, 'story_cover', [story_id])
+
+        # Its quiz totals leave the teacher's. The rollup rows the delete cascades
+        # to are locked first, in the same order as record_quiz_attempt
+        cur.execute("""
+            SELECT qs.quiz_id FROM quiz_stats qs
+            JOIN quizzes q ON q.id = qs.quiz_id
+            WHERE q.story_id = %s FOR UPDATE
+        """, (story_id,))
+        cur.execute("""
+            SELECT quiz_attempts, quiz_score_sum FROM story_stats
+            WHERE story_id = %s FOR UPDATE
+        """, (story_id,))
+        stats = cur.fetchone() or {'quiz_attempts': 0, 'quiz_score_sum': 0}
+        cur.execute("SELECT is_published FROM stories WHERE id = %s FOR UPDATE", (story_id,))
+        is_published = cur.fetchone()['is_published']
+
+        # Delete story (its story_stats/class_story_stats rows cascade)
         cur.execute("DELETE FROM stories WHERE id = %s", (story_id,))
+        record_teacher_stories(cur, g.teacher_id, total=-1, published=-1 if is_published else 0,
+                               quiz_attempts=-stats['quiz_attempts'],
+                               quiz_score_sum=-stats['quiz_score_sum'])
         mysql.connection.commit()
         
         flash('Story deleted successfully!', 'success')
@@ -5113,10 +6395,7 @@ def create_quiz(story_id):
     cur.execute("SELECT teacher_id FROM stories WHERE id = %s", (story_id,))
     story = cur.fetchone()
 
-    cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-    teacher = cur.fetchone()
-
-    if not story or story['teacher_id'] != teacher['id']:
+    if not story or story['teacher_id'] != g.teacher_id:
         flash('Access denied', 'danger')
         return redirect(url_for('teacher_stories'))
 
@@ -5139,7 +6418,7 @@ def create_quiz(story_id):
                 quiz_id = existing_quiz['id']
                 cur.execute("""
                     UPDATE quizzes
-                    SET title=%s, description=%s, time_limit=%s, passing_score=%s
+                    SET title=%s, description=%s, time_limit=%s, passing_score=%s, version=version+1
                     WHERE id=%s
                 """, (title, description, time_limit_seconds, passing_score, quiz_id))
             else:
@@ -5156,13 +6435,13 @@ def create_quiz(story_id):
 
                 cur.execute("DELETE FROM quiz_questions WHERE quiz_id = %s", (quiz_id,))
 
-                for q in questions:
-                    cur.execute("""
+                if questions:
+                    cur.executemany("""
                         INSERT INTO quiz_questions
                         (quiz_id, question_text, question_type, points, correct_answer,
                          option_a, option_b, option_c, option_d, explanation)
                         VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    """, (
+                    """, [(
                         quiz_id,
                         q['text'],
                         q['type'],
@@ -5173,7 +6452,12 @@ def create_quiz(story_id):
                         q.get('option_c'),
                         q.get('option_d'),
                         q.get('explanation')
-                    ))
+                    ) for q in questions])
+
+            refresh_story_counters(cur, story_id)
+            # A changed passing score changes who counts as passed (teacher_stats
+            # has no pass counts, so it is unaffected)
+            rebuild_story_rollups(cur, story_id)
 
             mysql.connection.commit()
             flash('Quiz saved successfully!', 'success')
@@ -5202,88 +6486,172 @@ def create_quiz(story_id):
 
 #============================ PDF Download the Story And Quiz Questions & Answers =======================================================
 
-@app.route('/teacher/story/<int:story_id>/download', methods=['GET'])
-@teacher_required
-def download_story_pdf(story_id):
-    """Download story and quiz as PDF"""
+# Rendered PDFs are cached on disk by content hash (see pdf_cache.py).
+# Bump STORY_PDF_VERSION whenever StoryPdfRenderer's output (story_pdf.py) changes.
+STORY_PDF_VERSION = 2
+story_pdf_cache = FileCache(app.config['PDF_CACHE_DIR'], app.config['PDF_CACHE_MAX_BYTES'])
+
+def load_story_pdf_data(cur, story_id):
+    """Load everything a story PDF needs; returns None if the story is missing"""
+    # Get story details
+    cur.execute("""
+        SELECT s.*, t.first_name, t.last_name
+        FROM stories s
+        JOIN teachers t ON s.teacher_id = t.id
+        WHERE s.id = %s
+    """, (story_id,))
+    
+    story = cur.fetchone()
+    
+    if not story:
+        return None
+    
+    # Get story pages
+    cur.execute("""
+        SELECT * FROM story_pages
+        WHERE story_id = %s
+        ORDER BY page_number
+    """, (story_id,))
+    
+    pages = cur.fetchall()
+    
+    # Get quiz and questions WITH answers for the answer key; the student
+    # version is the same rows without the answer columns
+    cur.execute("SELECT * FROM quizzes WHERE story_id = %s", (story_id,))
+    quiz = cur.fetchone()
+    
+    answer_key_questions = []
+    if quiz:
+        cur.execute("""
+            SELECT id, quiz_id, question_text, question_type, points, 
+                   option_a, option_b, option_c, option_d,
+                   correct_answer, explanation
+            FROM quiz_questions
+            WHERE quiz_id = %s
+            ORDER BY id
+        """, (quiz['id'],))
+        answer_key_questions = cur.fetchall()
+    
+    student_questions = [
+        {k: v for k, v in q.items() if k not in ('correct_answer', 'explanation')}
+        for q in answer_key_questions
+    ]
+    
+    return story, pages, quiz, student_questions, answer_key_questions
+
+def story_pdf_cache_key(story, pages, quiz, answer_key_questions):
+    """Content hash of every input to the story PDF, including image files"""
+    images = [('stories', story['cover_image'])] + [('story_pages', page['image_url']) for page in pages]
+    image_files = []
+    for folder, filename in images:
+        if filename:
+            key = f'{folder}/{filename}'
+            # The PDF switches to the print derivative once it is built
+            manifest_key = f'{derived_key(folder, filename)}/{MANIFEST}'
+            image_files.append([key, storage.signature(key), storage.signature(manifest_key)])
+    
+    return content_key(
+        STORY_PDF_VERSION, story, pages, quiz, answer_key_questions, image_files
+    )
+
+_story_pdf_renderer = None
+
+def story_pdf_renderer():
+    """The story PDF renderer; reportlab and Pillow are imported on first use (see story_pdf.py)"""
+    global _story_pdf_renderer
+    if _story_pdf_renderer is None:
+        from story_pdf import StoryPdfRenderer
+        _story_pdf_renderer = StoryPdfRenderer(image_derivatives, storage)
+    return _story_pdf_renderer
+
+def render_story_pdf(story_id, key, data):
+    """Render a story PDF into the cache and return its path"""
+    logger.info(f"Rendering PDF for story {story_id} (cache miss)")
+    story, pages, quiz, student_questions, answer_key_questions = data
+    pdf_buffer = story_pdf_renderer().render(story, pages, quiz, student_questions, answer_key_questions)
+    return story_pdf_cache.put(key, pdf_buffer.getvalue())
+
+@job_queue.handler('story_pdf')
+def story_pdf_job(story_id):
+    """Warm the PDF cache so the teacher's next request for the PDF is a hit"""
+    cur = mysql.connection.cursor()
+    try:
+        data = load_story_pdf_data(cur, story_id)
+    finally:
+        cur.close()
+    if not data:
+        return {'rendered': False}
+    story, pages, quiz, student_questions, answer_key_questions = data
+    key = story_pdf_cache_key(story, pages, quiz, answer_key_questions)
+    if story_pdf_cache.get(key) is None:
+        render_story_pdf(story_id, key, data)
+    return {'rendered': True, 'key': key}
+
+def send_story_pdf(story_id, disposition, filename_suffix):
+    """Serve a story PDF from the cache with ETag/304 support.
+
+    On a miss the PDF is rendered here, or with JOB_QUEUE_ENABLED queued for a
+    job worker while the teacher gets a page that waits for it.
+    """
+    cur = mysql.connection.cursor()
     try:
-        cur = mysql.connection.cursor()
-        
         # Check if teacher owns this story
         cur.execute("SELECT teacher_id FROM stories WHERE id = %s", (story_id,))
         story_owner = cur.fetchone()
         
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
-        
-        if not story_owner or story_owner['teacher_id'] != teacher['id']:
+        if not story_owner or story_owner['teacher_id'] != g.teacher_id:
             flash('Access denied', 'danger')
             return redirect(url_for('teacher_stories'))
         
-        # Get story details
-        cur.execute("""
-            SELECT s.*, t.first_name, t.last_name
-            FROM stories s
-            JOIN teachers t ON s.teacher_id = t.id
-            WHERE s.id = %s
-        """, (story_id,))
-        
-        story = cur.fetchone()
-        
-        if not story:
-            flash('Story not found', 'danger')
-            return redirect(url_for('teacher_stories'))
-        
-        # Get story pages
-        cur.execute("""
-            SELECT * FROM story_pages
-            WHERE story_id = %s
-            ORDER BY page_number
-        """, (story_id,))
-        
-        pages = cur.fetchall()
-        
-        # Get quiz and questions (WITHOUT answers - for student version)
-        cur.execute("SELECT * FROM quizzes WHERE story_id = %s", (story_id,))
-        quiz = cur.fetchone()
-        
-        student_questions = []
-        if quiz:
-            cur.execute("""
-                SELECT id, quiz_id, question_text, question_type, points, 
-                       option_a, option_b, option_c, option_d
-                FROM quiz_questions
-                WHERE quiz_id = %s
-                ORDER BY id
-            """, (quiz['id'],))
-            student_questions = cur.fetchall()
-        
-        # Get questions WITH answers for answer key
-        answer_key_questions = []
-        if quiz:
-            cur.execute("""
-                SELECT id, quiz_id, question_text, question_type, points, 
-                       option_a, option_b, option_c, option_d,
-                       correct_answer, explanation
-                FROM quiz_questions
-                WHERE quiz_id = %s
-                ORDER BY id
-            """, (quiz['id'],))
-            answer_key_questions = cur.fetchall()
-        
+        data = load_story_pdf_data(cur, story_id)
+    finally:
         cur.close()
-        
-        # Generate PDF
-        pdf_buffer = generate_story_pdf(story, pages, quiz, student_questions, answer_key_questions)
-        
-        # Return PDF as download
-        response = make_response(pdf_buffer.getvalue())
-        response.headers['Content-Type'] = 'application/pdf'
-        filename = secure_filename(f"{story['title']}_Story_and_Quiz.pdf")
-        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        
+    
+    if not data:
+        flash('Story not found', 'danger')
+        return redirect(url_for('teacher_stories'))
+    
+    story, pages, quiz, student_questions, answer_key_questions = data
+    key = story_pdf_cache_key(story, pages, quiz, answer_key_questions)
+    
+    # A matching ETag needs neither the cached file nor a render
+    if key in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(key)
+        response.headers['Cache-Control'] = 'private, no-cache'
         return response
-        
+    
+    path = story_pdf_cache.get(key)
+    if path is None and app.config['JOB_QUEUE_ENABLED']:
+        # Render in a job worker; the pending page polls the job and comes back here
+        try:
+            job_id = enqueue_job('story_pdf', {'story_id': story_id},
+                                 priority=PRIORITY_INTERACTIVE, dedupe_key=f'story_pdf:{key}')
+            return render_template('teacher/pdf_pending.html',
+                                   story=story, job_id=job_id, retry_url=request.url), 202
+        except Exception as e:
+            logger.error(f"Could not queue PDF for story {story_id}, rendering inline: {str(e)}")
+    if path is None:
+        path = render_story_pdf(story_id, key, data)
+    
+    response = send_file(
+        path,
+        mimetype='application/pdf',
+        as_attachment=(disposition == 'attachment'),
+        download_name=secure_filename(f"{story['title']}_{filename_suffix}.pdf"),
+        etag=key,
+        conditional=True,
+        max_age=0
+    )
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/teacher/story/<int:story_id>/download', methods=['GET'])
+@teacher_required
+def download_story_pdf(story_id):
+    """Download story and quiz as PDF"""
+    try:
+        return send_story_pdf(story_id, 'attachment', 'Story_and_Quiz')
     except Exception as e:
         flash(f'Error generating PDF: {str(e)}', 'danger')
         return redirect(url_for('view_story_details', story_id=story_id))
@@ -5293,545 +6661,11 @@ def download_story_pdf(story_id):
 def preview_story_pdf(story_id):
     """Preview story PDF without downloading"""
     try:
-        cur = mysql.connection.cursor()
-        
-        # Check if teacher owns this story
-        cur.execute("SELECT teacher_id FROM stories WHERE id = %s", (story_id,))
-        story_owner = cur.fetchone()
-        
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
-        
-        if not story_owner or story_owner['teacher_id'] != teacher['id']:
-            flash('Access denied', 'danger')
-            return redirect(url_for('teacher_stories'))
-        
-        # Get story details
-        cur.execute("""
-            SELECT s.*, t.first_name, t.last_name
-            FROM stories s
-            JOIN teachers t ON s.teacher_id = t.id
-            WHERE s.id = %s
-        """, (story_id,))
-        
-        story = cur.fetchone()
-        
-        if not story:
-            flash('Story not found', 'danger')
-            return redirect(url_for('teacher_stories'))
-        
-        # Get story pages
-        cur.execute("""
-            SELECT * FROM story_pages
-            WHERE story_id = %s
-            ORDER BY page_number
-        """, (story_id,))
-        
-        pages = cur.fetchall()
-        
-        # Get quiz and questions (WITHOUT answers - for student version)
-        cur.execute("SELECT * FROM quizzes WHERE story_id = %s", (story_id,))
-        quiz = cur.fetchone()
-        
-        student_questions = []
-        if quiz:
-            cur.execute("""
-                SELECT id, quiz_id, question_text, question_type, points, 
-                       option_a, option_b, option_c, option_d
-                FROM quiz_questions
-                WHERE quiz_id = %s
-                ORDER BY id
-            """, (quiz['id'],))
-            student_questions = cur.fetchall()
-        
-        # Get questions WITH answers for answer key
-        answer_key_questions = []
-        if quiz:
-            cur.execute("""
-                SELECT id, quiz_id, question_text, question_type, points, 
-                       option_a, option_b, option_c, option_d,
-                       correct_answer, explanation
-                FROM quiz_questions
-                WHERE quiz_id = %s
-                ORDER BY id
-            """, (quiz['id'],))
-            answer_key_questions = cur.fetchall()
-        
-        cur.close()
-        
-        # Generate PDF for preview
-        pdf_buffer = generate_story_pdf(story, pages, quiz, student_questions, answer_key_questions)
-        
-        # Return PDF inline for preview
-        response = make_response(pdf_buffer.getvalue())
-        response.headers['Content-Type'] = 'application/pdf'
-        filename = secure_filename(f"{story['title']}_Preview.pdf")
-        response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
-        
-        return response
-        
+        return send_story_pdf(story_id, 'inline', 'Preview')
     except Exception as e:
         flash(f'Error generating PDF preview: {str(e)}', 'danger')
         return redirect(url_for('view_story_details', story_id=story_id))
 
-def generate_story_pdf(story, pages, quiz, student_questions, answer_key_questions=None):
-    """Generate PDF document for story and quiz"""
-    buffer = io.BytesIO()
-    
-    # Create PDF document
-    doc = SimpleDocTemplate(
-        buffer,
-        pagesize=A4,
-        rightMargin=72,
-        leftMargin=72,
-        topMargin=72,
-        bottomMargin=72,
-        title=story['title']
-    )
-    
-    # Define styles
-    styles = getSampleStyleSheet()
-    
-    # Custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Title'],
-        fontSize=28,
-        spaceAfter=40,
-        spaceBefore=60,
-        alignment=TA_CENTER,
-        textColor=colors.HexColor('#2C3E50'),
-        fontName='Helvetica-Bold',
-        leading=32 
-    )
-    
-    subtitle_style = ParagraphStyle(
-        'CustomSubtitle',
-        parent=styles['Heading2'],
-        fontSize=16,
-        spaceAfter=20,
-        alignment=TA_CENTER,
-        textColor=colors.HexColor('#7F8C8D')
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading1',
-        parent=styles['Heading1'],
-        fontSize=18,
-        spaceAfter=12,
-        textColor=colors.HexColor('#3498DB'),
-        fontName='Helvetica-Bold'
-    )
-    
-    heading2_style = ParagraphStyle(
-        'CustomHeading2',
-        parent=styles['Heading2'],
-        fontSize=14,
-        spaceAfter=8,
-        textColor=colors.HexColor('#2C3E50'),
-        fontName='Helvetica-Bold'
-    )
-    
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=6,
-        textColor=colors.HexColor('#34495E'),
-        alignment=TA_JUSTIFY
-    )
-    
-    story_text_style = ParagraphStyle(
-        'StoryText',
-        parent=styles['Normal'],
-        fontSize=13,
-        spaceAfter=12,
-        leading=16,
-        alignment=TA_JUSTIFY,
-        textColor=colors.HexColor('#2C3E50')
-    )
-    
-    note_style = ParagraphStyle(
-        'NoteStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=6,
-        leftIndent=20,
-        textColor=colors.HexColor('#E74C3C'),
-        fontName='Helvetica-Bold'
-    )
-    
-    question_style = ParagraphStyle(
-        'QuestionStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=8,
-        textColor=colors.HexColor('#2C3E50'),
-        fontName='Helvetica-Bold'
-    )
-    
-    option_style = ParagraphStyle(
-        'OptionStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=4,
-        leftIndent=20,
-        textColor=colors.HexColor('#34495E')
-    )
-    
-    answer_style = ParagraphStyle(
-        'AnswerStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=6,
-        leftIndent=10,
-        textColor=colors.HexColor('#27ae60'),
-        fontName='Helvetica-Bold'
-    )
-    
-    explanation_style = ParagraphStyle(
-        'ExplanationStyle',
-        parent=styles['Normal'],
-        fontSize=10,
-        spaceAfter=6,
-        leftIndent=10,
-        textColor=colors.HexColor('#7f8c8d'),
-        fontStyle='italic'
-    )
-    
-    # Build story content
-    story_content = []
-    
-    # Cover page with title
-    story_content.append(Spacer(1, 2*inch))
-    story_content.append(Paragraph(story['title'], title_style))
-    story_content.append(Spacer(1, 0.5*inch))
-    
-    
-    # Add cover image if exists
-    if story['cover_image'] and story['cover_image'] != 'default_story_image.jpg':
-        try:
-            # Check if file exists in uploads folder
-            upload_folder = app.config['UPLOAD_FOLDER']
-            cover_image_path = os.path.join(upload_folder, 'stories', story['cover_image'])
-            
-            if os.path.exists(cover_image_path):
-                # Process image from file path
-                pil_img = PILImage.open(cover_image_path)
-                
-                # Calculate dimensions to fit within page
-                max_width = 5*inch
-                max_height = 4*inch
-                
-                # Maintain aspect ratio
-                width, height = pil_img.size
-                aspect_ratio = width / height
-                
-                if width > max_width:
-                    width = max_width
-                    height = width / aspect_ratio
-                
-                if height > max_height:
-                    height = max_height
-                    width = height * aspect_ratio
-                
-                # Convert PIL Image to bytes for ReportLab
-                img_buffer = io.BytesIO()
-                
-                # Convert RGBA to RGB if necessary
-                if pil_img.mode == 'RGBA':
-                    rgb_img = PILImage.new('RGB', pil_img.size, (255, 255, 255))
-                    rgb_img.paste(pil_img, mask=pil_img.split()[3])
-                    rgb_img.save(img_buffer, format='JPEG', quality=90)
-                else:
-                    pil_img.save(img_buffer, format='JPEG', quality=90)
-                
-                img_buffer.seek(0)
-                
-                # Add image to PDF
-                story_content.append(Image(img_buffer, width=width, height=height))
-                story_content.append(Spacer(1, 20))
-            else:
-                print(f"Cover image not found at: {cover_image_path}")
-                story_content.append(Paragraph("<i>Cover image not available</i>", normal_style))
-        except Exception as e:
-            print(f"Error loading cover image: {str(e)}")
-            story_content.append(Paragraph("<i>Cover image not available</i>", normal_style))
-    
-    # Story metadata
-    meta_data = [
-        f"<b>Author:</b> {story['first_name']} {story['last_name']}",
-        f"<b>Created:</b> {story['created_at'].strftime('%B %d, %Y')}",
-        f"<b>Status:</b> {'Published' if story['is_published'] else 'Draft'}",
-        f"<b>Total Pages:</b> {len(pages)}"
-    ]
-    
-    for meta in meta_data:
-        story_content.append(Paragraph(meta, normal_style))
-    
-    story_content.append(Spacer(1, 30))
-    
-    # Story description
-    if story['description']:
-        story_content.append(Paragraph("<b>Story Description:</b>", heading2_style))
-        story_content.append(Paragraph(story['description'], story_text_style))
-        story_content.append(Spacer(1, 20))
-    
-    # Page break before story pages
-    story_content.append(PageBreak())
-    
-    # Story pages
-    story_content.append(Paragraph("Story Pages", heading_style))
-    story_content.append(Spacer(1, 20))
-    
-    for i, page in enumerate(pages, 1):
-        # Page header
-        story_content.append(Paragraph(f"<b>Page {page['page_number']}</b>", heading2_style))
-        story_content.append(Spacer(1, 10))
-        
-        # Try to add page image if exists
-        if page['image_url'] and page['image_url'] != 'default_page_image.jpg':
-            try:
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'story_pages', page['image_url'])
-                
-                if os.path.exists(image_path):
-                    # Process image for PDF
-                    pil_img = PILImage.open(image_path)
-                    
-                    # Calculate dimensions to fit within page
-                    max_width = 6*inch
-                    max_height = 4*inch
-                    
-                    # Maintain aspect ratio
-                    width, height = pil_img.size
-                    aspect_ratio = width / height
-                    
-                    if width > max_width:
-                        width = max_width
-                        height = width / aspect_ratio
-                    
-                    if height > max_height:
-                        height = max_height
-                        width = height * aspect_ratio
-                    
-                    # Save processed image to buffer
-                    img_buffer = io.BytesIO()
-                    
-                    # Convert RGBA to RGB if necessary
-                    if pil_img.mode == 'RGBA':
-                        rgb_img = PILImage.new('RGB', pil_img.size, (255, 255, 255))
-                        rgb_img.paste(pil_img, mask=pil_img.split()[3])
-                        rgb_img.save(img_buffer, format='JPEG', quality=90)
-                    else:
-                        pil_img.save(img_buffer, format='JPEG', quality=90)
-                    
-                    img_buffer.seek(0)
-                    
-                    # Add image to PDF
-                    story_content.append(Image(img_buffer, width=width, height=height))
-                    story_content.append(Spacer(1, 10))
-            except Exception as e:
-                print(f"Error loading page image {page['image_url']}: {str(e)}")
-                # Don't add placeholder, just continue
-        
-        # Page text content
-        story_content.append(Paragraph("<b>Text Content:</b>", normal_style))
-        story_content.append(Paragraph(page['text_content'], story_text_style))
-        story_content.append(Spacer(1, 10))
-        
-        # Important notes (if any)
-        if page['important_notes'] and page['important_notes'].strip():
-            story_content.append(Paragraph("<b>Important Notes:</b>", normal_style))
-            story_content.append(Paragraph(page['important_notes'], note_style))
-            story_content.append(Spacer(1, 10))
-        
-        # Add separator between pages
-        if i < len(pages):
-            story_content.append(Spacer(1, 20))
-            # Add page break every 3 pages for better readability
-            if i % 3 == 0:
-                story_content.append(PageBreak())
-    
-    # Add quiz section if quiz exists
-    if quiz:
-        story_content.append(PageBreak())
-        story_content.append(Paragraph("Quiz Assessment", heading_style))
-        story_content.append(Spacer(1, 20))
-        
-        # Quiz info
-        quiz_info = [
-            f"<b>Quiz Title:</b> {quiz['title']}",
-            f"<b>Description:</b> {quiz['description'] or 'No description'}",
-            f"<b>Time Limit:</b> {quiz['time_limit'] // 60} minutes",
-            f"<b>Passing Score:</b> {quiz['passing_score']}%",
-            f"<b>Total Questions:</b> {len(student_questions)}"
-        ]
-        
-        for info in quiz_info:
-            story_content.append(Paragraph(info, normal_style))
-        
-        story_content.append(Spacer(1, 30))
-        
-        # STUDENT VERSION: Quiz questions (ONLY QUESTIONS - NO ANSWERS)
-        if student_questions:
-            story_content.append(Paragraph("<b>Questions (Student Version):</b>", heading2_style))
-            story_content.append(Paragraph("<i>Answer all questions in the space provided.</i>", normal_style))
-            story_content.append(Spacer(1, 15))
-            
-            for i, question in enumerate(student_questions, 1):
-                # Get question type and normalize it
-                question_type = question.get('question_type', '').lower().strip()
-                
-                # Determine display type
-                if 'multiple' in question_type or 'choice' in question_type or question_type == 'mcq':
-                    type_display = 'Multiple Choice'
-                    is_mcq = True
-                elif 'true' in question_type or 'false' in question_type:
-                    type_display = 'True/False'
-                    is_mcq = False
-                elif 'short' in question_type or 'answer' in question_type:
-                    type_display = 'Short Answer'
-                    is_mcq = False
-                else:
-                    type_display = question.get('question_type', 'Question')
-                    is_mcq = False
-                
-                story_content.append(Paragraph(f"<b>Question {i} ({type_display}) - {question['points']} point(s):</b>", question_style))
-                
-                # Question text
-                story_content.append(Paragraph(question['question_text'], normal_style))
-                story_content.append(Spacer(1, 10))
-                
-                # Options for MCQ (show all options without indicating correct answer)
-                if is_mcq:
-                    # Check if any options exist
-                    has_options = False
-                    
-                    # Option A
-                    if question.get('option_a'):
-                        option_a = str(question['option_a']).strip()
-                        if option_a:
-                            story_content.append(Paragraph(f"A) {option_a}", option_style))
-                            has_options = True
-                    
-                    # Option B
-                    if question.get('option_b'):
-                        option_b = str(question['option_b']).strip()
-                        if option_b:
-                            story_content.append(Paragraph(f"B) {option_b}", option_style))
-                            has_options = True
-                    
-                    # Option C
-                    if question.get('option_c'):
-                        option_c = str(question['option_c']).strip()
-                        if option_c:
-                            story_content.append(Paragraph(f"C) {option_c}", option_style))
-                            has_options = True
-                    
-                    # Option D
-                    if question.get('option_d'):
-                        option_d = str(question['option_d']).strip()
-                        if option_d:
-                            story_content.append(Paragraph(f"D) {option_d}", option_style))
-                            has_options = True
-                    
-                    if has_options:
-                        story_content.append(Spacer(1, 10))
-                        story_content.append(Paragraph("Answer: __________", option_style))
-                    else:
-                        story_content.append(Paragraph("(No options provided)", option_style))
-                        story_content.append(Paragraph("Answer: __________", option_style))
-                
-                # For true/false
-                elif type_display == 'True/False':
-                    story_content.append(Paragraph("Circle one: True / False", option_style))
-                
-                # For short answer
-                elif type_display == 'Short Answer':
-                    story_content.append(Paragraph("Answer: ___________________________________", option_style))
-                    story_content.append(Paragraph("_________________________________________", option_style))
-                
-                # Add space between questions
-                if i < len(student_questions):
-                    story_content.append(Spacer(1, 20))
-                else:
-                    story_content.append(Spacer(1, 30))
-        
-        # Add answer key section (for teachers only)
-        if answer_key_questions:
-            story_content.append(PageBreak())
-            story_content.append(Paragraph("Quiz Answer Key (For Teachers Only)", heading_style))
-            story_content.append(Spacer(1, 20))
-            
-            # Answer key instructions
-            story_content.append(Paragraph("<b>Note:</b> This section contains the correct answers and explanations.", note_style))
-            story_content.append(Spacer(1, 20))
-            
-            for i, question in enumerate(answer_key_questions, 1):
-                # Get question type and normalize it
-                question_type = question.get('question_type', '').lower().strip()
-                
-                # Determine display type
-                if 'multiple' in question_type or 'choice' in question_type or question_type == 'mcq':
-                    type_display = 'Multiple Choice'
-                    is_mcq = True
-                elif 'true' in question_type or 'false' in question_type:
-                    type_display = 'True/False'
-                    is_mcq = False
-                elif 'short' in question_type or 'answer' in question_type:
-                    type_display = 'Short Answer'
-                    is_mcq = False
-                else:
-                    type_display = question.get('question_type', 'Question')
-                    is_mcq = False
-                
-                story_content.append(Paragraph(f"<b>Question {i} ({type_display}) - {question['points']} point(s):</b>", question_style))
-                
-                # Question text
-                story_content.append(Paragraph(question['question_text'], normal_style))
-                story_content.append(Spacer(1, 10))
-                
-                # Show correct answer
-                if 'correct_answer' in question and question['correct_answer']:
-                    correct_answer = str(question['correct_answer']).strip()
-                    
-                    if is_mcq:
-                        # Map correct answer to option text
-                        if correct_answer.upper() == 'A':
-                            answer_text = str(question.get('option_a', 'Option A')).strip()
-                            story_content.append(Paragraph(f"<b>Correct Answer:</b> A) {answer_text}", answer_style))
-                        elif correct_answer.upper() == 'B':
-                            answer_text = str(question.get('option_b', 'Option B')).strip()
-                            story_content.append(Paragraph(f"<b>Correct Answer:</b> B) {answer_text}", answer_style))
-                        elif correct_answer.upper() == 'C':
-                            answer_text = str(question.get('option_c', 'Option C')).strip()
-                            story_content.append(Paragraph(f"<b>Correct Answer:</b> C) {answer_text}", answer_style))
-                        elif correct_answer.upper() == 'D':
-                            answer_text = str(question.get('option_d', 'Option D')).strip()
-                            story_content.append(Paragraph(f"<b>Correct Answer:</b> D) {answer_text}", answer_style))
-                        else:
-                            story_content.append(Paragraph(f"<b>Correct Answer:</b> {correct_answer}", answer_style))
-                    else:
-                        story_content.append(Paragraph(f"<b>Correct Answer:</b> {correct_answer}", answer_style))
-                else:
-                    story_content.append(Paragraph("<b>Correct Answer:</b> Not specified", answer_style))
-                
-                # Show explanation if available
-                if 'explanation' in question and question['explanation']:
-                    explanation = str(question['explanation']).strip()
-                    if explanation:
-                        story_content.append(Paragraph(f"<b>Explanation:</b> {explanation}", explanation_style))
-                
-                # Add space between questions
-                if i < len(answer_key_questions):
-                    story_content.append(Spacer(1, 20))
-    
-    # Build PDF
-    doc.build(story_content)
-    
-    buffer.seek(0)
-    return buffer
-
 
 #=========================================================================================
 @app.route('/teacher/student/<int:student_id>')
@@ -5860,7 +6694,7 @@ def view_student_profile(student_id):
                 sp.is_completed,
                 sp.started_at,
                 sp.completed_at,
-                (SELECT COUNT(*) FROM story_pages WHERE story_id = st.id) AS total_pages
+                st.page_count AS total_pages
             FROM student_progress sp
             JOIN stories st ON sp.story_id = st.id
             WHERE sp.student_id = %s
@@ -5903,9 +6737,8 @@ def send_message(student_id):
         cur = mysql.connection.cursor()
         
         # Get teacher ID
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
-        if not teacher:
+        teacher_id = g.teacher_id
+        if not teacher_id:
             flash('Teacher record not found.', 'danger')
             return redirect(url_for('view_students'))
         
@@ -5933,7 +6766,7 @@ def send_message(student_id):
             cur.execute("""
                 INSERT INTO messages (sender_id, recipient_id, subject, body, sent_at)
                 VALUES (%s, %s, %s, %s, NOW())
-            """, (teacher['id'], student_id, subject, body))
+            """, (teacher_id, student_id, subject, body))
             mysql.connection.commit()
             
             flash('Message sent successfully!', 'success')
@@ -5953,8 +6786,7 @@ def teacher_messages():
         cur = mysql.connection.cursor()
         
         # Get teacher ID
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
+        teacher_id = g.teacher_id
         
         # Get all messages sent by this teacher
         cur.execute("""
@@ -5966,7 +6798,7 @@ def teacher_messages():
             JOIN students s ON m.recipient_id = s.id
             WHERE m.sender_id = %s
             ORDER BY m.sent_at DESC
-        """, (teacher['id'],))
+        """, (teacher_id,))
         messages = cur.fetchall()
         
         cur.close()
@@ -6016,68 +6848,70 @@ def analytics():
     try:
         cur = mysql.connection.cursor()
         
-        cur.execute("SELECT id FROM teachers WHERE user_id = %s", (session['user_id'],))
-        teacher = cur.fetchone()
-        
-        # Get overall statistics
-        cur.execute("""
-            SELECT 
-                COUNT(DISTINCT s.id) as total_stories,
-                COUNT(DISTINCT st.id) as total_students,
-                COUNT(DISTINCT sqa.id) as total_quiz_attempts,
-                AVG(sqa.score) as overall_avg_score,
-                MAX(sqa.score) as highest_score,
-                MIN(sqa.score) as lowest_score
-            FROM teachers t
-            LEFT JOIN stories s ON t.id = s.teacher_id
-            LEFT JOIN class_assignments ca ON s.id = ca.story_id
-            LEFT JOIN students st ON ca.class_level = st.class_level
-            LEFT JOIN quizzes q ON s.id = q.story_id
-            LEFT JOIN student_quiz_attempts sqa ON q.id = sqa.quiz_id
-            WHERE t.id = %s
-        """, (teacher['id'],))
-        
-        overall_stats = cur.fetchone()
+        teacher_id = g.teacher_id
+        
+        # Get overall statistics (from the rollup tables)
+        teacher_stats = get_teacher_stats(cur, teacher_id)
+        class_totals = get_teacher_class_totals(cur, teacher_id)
+        overall_stats = {
+            'total_stories': teacher_stats['total_stories'],
+            'total_students': class_totals['total_students'],
+            'total_quiz_attempts': teacher_stats['quiz_attempts'],
+            'overall_avg_score': teacher_stats['avg_quiz_score'],
+            'highest_score': teacher_stats['quiz_score_max'],
+            'lowest_score': teacher_stats['quiz_score_min']
+        }
         
         # Get story-wise analytics
         cur.execute("""
             SELECT 
                 s.id,
                 s.title,
-                COUNT(DISTINCT sp.student_id) as students_assigned,
-                COUNT(DISTINCT CASE WHEN sp.is_completed THEN sp.student_id END) as students_completed,
-                COUNT(DISTINCT sqa.id) as quiz_attempts,
-                AVG(sqa.score) as avg_quiz_score,
-                COUNT(DISTINCT CASE WHEN sqa.score >= q.passing_score THEN sqa.student_id END) as students_passed
+                COALESCE(ss.students_started, 0) as students_assigned,
+                COALESCE(ss.students_completed, 0) as students_completed,
+                COALESCE(ss.quiz_attempts, 0) as quiz_attempts,
+                ss.quiz_score_sum / NULLIF(ss.quiz_attempts, 0) as avg_quiz_score,
+                COALESCE(ss.students_passed, 0) as students_passed
             FROM stories s
-            LEFT JOIN student_progress sp ON s.id = sp.story_id
-            LEFT JOIN quizzes q ON s.id = q.story_id
-            LEFT JOIN student_quiz_attempts sqa ON q.id = sqa.quiz_id
+            LEFT JOIN story_stats ss ON ss.story_id = s.id
             WHERE s.teacher_id = %s
-            GROUP BY s.id, s.title
             ORDER BY s.created_at DESC
-        """, (teacher['id'],))
+        """, (teacher_id,))
         
         story_analytics = cur.fetchall()
         
-        # Get class-wise performance
+        # Get class-wise performance, for the classes this teacher's stories are assigned to
         cur.execute("""
             SELECT 
-                st.class_level,
-                COUNT(DISTINCT st.id) as total_students,
-                COUNT(DISTINCT sp.story_id) as total_stories_assigned,
-                AVG(CASE WHEN sp.is_completed THEN 1 ELSE 0 END) * 100 as completion_rate,
-                AVG(sqa.score) as avg_quiz_score
-            FROM students st
-            LEFT JOIN class_assignments ca ON st.class_level = ca.class_level
-            LEFT JOIN student_progress sp ON st.id = sp.student_id AND ca.story_id = sp.story_id
-            LEFT JOIN quizzes q ON ca.story_id = q.story_id
-            LEFT JOIN student_quiz_attempts sqa ON q.id = sqa.quiz_id AND st.id = sqa.student_id
-            GROUP BY st.class_level
-            ORDER BY st.class_level
-        """)
+                c.class_level,
+                (SELECT COUNT(*) FROM students st WHERE st.class_level = c.class_level) as total_students,
+                c.total_stories_assigned,
+                c.students_completed,
+                c.quiz_score_sum / NULLIF(c.quiz_attempts, 0) as avg_quiz_score
+            FROM (
+                SELECT 
+                    ca.class_level,
+                    COUNT(*) as total_stories_assigned,
+                    COALESCE(SUM(css.students_completed), 0) as students_completed,
+                    COALESCE(SUM(css.quiz_attempts), 0) as quiz_attempts,
+                    COALESCE(SUM(css.quiz_score_sum), 0) as quiz_score_sum
+                FROM class_assignments ca
+                JOIN stories s ON s.id = ca.story_id
+                LEFT JOIN class_story_stats css 
+                       ON css.story_id = ca.story_id AND css.class_level = ca.class_level
+                WHERE s.teacher_id = %s
+                GROUP BY ca.class_level
+            ) c
+            ORDER BY c.class_level
+        """, (teacher_id,))
         
         class_analytics = cur.fetchall()
+        for class_stat in class_analytics:
+            # Share of (student, assigned story) pairs that are completed
+            readings = class_stat['total_students'] * class_stat['total_stories_assigned']
+            class_stat['completion_rate'] = (
+                min(100.0, float(class_stat['students_completed']) * 100 / readings) if readings else 0.0
+            )
         
         # Get recent quiz performance
         cur.execute("""
@@ -6095,7 +6929,7 @@ def analytics():
             JOIN students st ON sqa.student_id = st.id
             WHERE s.teacher_id = %s
             ORDER BY sqa.submitted_at DESC
-        """, (teacher['id'],))
+        """, (teacher_id,))
         
         recent_quiz_results = cur.fetchall()
 
@@ -6118,9 +6952,13 @@ def analytics():
             HAVING quiz_count >= 2
             ORDER BY avg_score DESC
             LIMIT 5
-        """, (teacher['id'],))
+        """, (teacher_id,))
         top_performers = cur.fetchall()
         
+        # Question difficulty and discrimination, for quizzes that have been taken
+        item_analyses = [quiz for quiz in get_quiz_item_analyses(cur, teacher_id)
+                         if quiz['analysis']['attempts']]
+        
         cur.close()
         
         return render_template('teacher/analytics.html', 
@@ -6128,7 +6966,8 @@ def analytics():
                              story_analytics=story_analytics,
                              class_analytics=class_analytics,
                              recent_quiz_results=recent_quiz_results,
-                             top_performers=top_performers)
+                             top_performers=top_performers,
+                             item_analyses=item_analyses)
     except Exception as e:
         flash(f'Error loading analytics: {str(e)}', 'danger')
         return redirect(url_for('teacher_dashboard'))
@@ -6173,9 +7012,7 @@ def get_student_progress(story_id):
         cur = mysql.connection.cursor()
         
         # Get total pages for this story
-        cur.execute("SELECT COUNT(*) as total_pages FROM story_pages WHERE story_id = %s", (story_id,))
-        total_pages_result = cur.fetchone()
-        total_pages = total_pages_result['total_pages'] if total_pages_result else 0
+        total_pages = get_story_page_count(story_id)
         
         cur.execute("""
             SELECT 
@@ -6229,31 +7066,39 @@ def mark_story_completed():
         
         cur = mysql.connection.cursor()
         
-        # Get student ID
-        cur.execute("SELECT id FROM students WHERE user_id = %s", (session['user_id'],))
-        student = cur.fetchone()
+        student_id = g.student_id
         
         # Get total pages
-        cur.execute("SELECT COUNT(*) as total_pages FROM story_pages WHERE story_id = %s", (story_id,))
-        total_pages_result = cur.fetchone()
-        total_pages = total_pages_result['total_pages'] if total_pages_result else 0
+        total_pages = get_story_page_count(story_id)
         
-        # Mark as completed
         cur.execute("""
-            UPDATE student_progress 
-            SET is_completed = TRUE, 
-                completed_at = NOW(),
-                current_page = %s
+            SELECT is_completed FROM student_progress
             WHERE student_id = %s AND story_id = %s
-        """, (total_pages, student['id'], story_id))
+            FOR UPDATE
+        """, (student_id, story_id))
+        existing_progress = cur.fetchone()
         
-        # If no rows affected, insert new record
-        if cur.rowcount == 0:
+        # Mark as completed
+        if existing_progress:
+            cur.execute("""
+                UPDATE student_progress 
+                SET is_completed = TRUE, 
+                    completed_at = NOW(),
+                    current_page = %s
+                WHERE student_id = %s AND story_id = %s
+            """, (total_pages, student_id, story_id))
+        else:
             cur.execute("""
                 INSERT INTO student_progress 
                 (student_id, story_id, current_page, is_completed, started_at, completed_at)
                 VALUES (%s, %s, %s, TRUE, NOW(), NOW())
-            """, (student['id'], story_id, total_pages))
+            """, (student_id, story_id, total_pages))
+        
+        record_story_progress(
+            cur, story_id, g.class_level,
+            started=0 if existing_progress else 1,
+            completed=0 if existing_progress and existing_progress['is_completed'] else 1
+        )
         
         mysql.connection.commit()
         cur.close()
@@ -6268,32 +7113,44 @@ def get_quiz_statistics(quiz_id):
     try:
         cur = mysql.connection.cursor()
         
-        # Get detailed statistics
+        # Get detailed statistics (counters kept by record_quiz_answers)
         cur.execute("""
             SELECT 
+                q.id,
                 q.question_text,
                 q.question_type,
                 q.correct_answer,
-                COUNT(sqa.id) as total_answers,
-                SUM(CASE WHEN sqa.is_correct THEN 1 ELSE 0 END) as correct_answers,
-                GROUP_CONCAT(DISTINCT s.student_answer) as sample_answers
+                COALESCE(qs.total_answers, 0) as total_answers,
+                COALESCE(qs.correct_answers, 0) as correct_answers
             FROM quiz_questions q
-            LEFT JOIN student_quiz_answers s ON q.id = s.question_id
+            LEFT JOIN quiz_question_stats qs ON qs.question_id = q.id
             WHERE q.quiz_id = %s
-            GROUP BY q.id
+            ORDER BY q.id
         """, (quiz_id,))
         
         question_stats = cur.fetchall()
         
+        # Most common answers per question, each read off the (question_id, answer_count) index
+        top_answers = {}
+        if question_stats:
+            cur.execute(" UNION ALL ".join(
+                """(SELECT question_id, answer, answer_count FROM quiz_answer_counts
+                    WHERE question_id = %s ORDER BY answer_count DESC LIMIT %s)"""
+                for _ in question_stats
+            ), [arg for q in question_stats for arg in (q['id'], TOP_ANSWERS_PER_QUESTION)])
+            for row in cur.fetchall():
+                top_answers.setdefault(row['question_id'], []).append(
+                    {'answer': row['answer'], 'count': row['answer_count']})
+        for question in question_stats:
+            question['top_answers'] = top_answers.get(question['id'], [])
+            question['sample_answers'] = ','.join(a['answer'] for a in question['top_answers'])
+        
         # Get score distribution
         cur.execute("""
-            SELECT 
-                FLOOR(score/10)*10 as score_range,
-                COUNT(*) as student_count
-            FROM student_quiz_attempts
+            SELECT bucket as score_range, attempt_count as student_count
+            FROM quiz_score_buckets
             WHERE quiz_id = %s
-            GROUP BY FLOOR(score/10)*10
-            ORDER BY score_range
+            ORDER BY bucket
         """, (quiz_id,))
         
         score_distribution = cur.fetchall()
@@ -6307,6 +7164,43 @@ def get_quiz_statistics(quiz_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/quiz_item_analysis/<int:quiz_id>')
+@teacher_required
+def get_quiz_item_analysis(quiz_id):
+    try:
+        cur = mysql.connection.cursor()
+        quizzes = get_quiz_item_analyses(cur, g.teacher_id, quiz_id)
+        cur.close()
+        
+        if not quizzes:
+            return jsonify({'error': 'Quiz not found'}), 404
+        
+        return jsonify(quizzes[0])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/health/db')
+def db_health():
+    """Database health check with connection pool statistics for this worker"""
+    healthy = check_db_connection()
+    return jsonify({'healthy': healthy, 'pool': mysql.stats()}), 200 if healthy else 503
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape target, merged across workers; needs the METRICS_TOKEN bearer token"""
+    if metrics is None:
+        abort(404)
+    token = app.config['METRICS_TOKEN']
+    supplied = request.headers.get('Authorization', '').encode('utf-8')
+    if not token or not hmac.compare_digest(supplied, f'Bearer {token}'.encode('utf-8')):
+        response = make_response('Unauthorized\n', 401)
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 # Error handlers
 @app.errorhandler(404)
 def page_not_found(e):
@@ -6320,8 +7214,31 @@ def internal_server_error(e):
 
 @app.before_request
 def before_request():
-    """Log all requests"""
+    """Log all requests (and start timing them when metrics are enabled)"""
     logger.debug(f"{request.method} {request.path}")
+    if metrics is not None:
+        g.metrics_started = time.perf_counter()
+        g.metrics_stats = start_request()
+
+@app.after_request
+def record_request_metrics(response):
+    """Record latency and SQL stats per endpoint; log the slowest statement of slow requests"""
+    if metrics is not None and 'metrics_started' in g:
+        duration = time.perf_counter() - g.metrics_started
+        stats = g.metrics_stats
+        metrics.record_request(request.endpoint or 'unmatched', request.method,
+                               response.status_code, duration, stats)
+        if duration * 1000 >= app.config['METRICS_SLOW_REQUEST_MS']:
+            logger.warning(f"Slow request {request.method} {request.path}: {duration * 1000:.0f} ms, "
+                           f"{stats.queries} queries, {stats.db_time * 1000:.0f} ms in SQL, "
+                           f"{stats.rows} rows; slowest ({stats.slowest_time * 1000:.0f} ms): "
+                           f"{stats.slowest_statement()}")
+    return response
+
+@app.teardown_request
+def end_request_metrics(exception):
+    if metrics is not None:
+        end_request()
 
 @app.teardown_appcontext
 def teardown_db(exception):
@@ -0,0 +1,279 @@
+# blobs.py
+"""Content-addressed storage for uploaded files, with references and garbage collection.
+
+Uploads are stored under the key <folder>/<sha256><.ext> (see storage.py):
+the hash is computed while the file is written to a temporary file in
+UPLOAD_FOLDER, and if that key is already stored the new copy is dropped
+at once. The same image uploaded twice, or posted again by every story
+edit, is one file. The filename columns (stories.cover_image,
+story_pages.image_url, the profile_photo columns) hold the blob name, so
+/media URLs, image derivatives and PDFs work unchanged; files saved before
+the blob store keep their names.
+
+`blobs` has a row per stored file and `blob_refs` records which owner row
+uses it (story cover, story page, student or teacher profile photo; one
+blob per owner), written in the owner row's transaction. collect_garbage()
+deletes blobs that have had no reference for the grace period. A blob's
+touched_at is reset when it is saved again or loses a reference, which
+covers files saved before their owner row commits and finished upload
+sessions not yet attached to a story. Candidates are also checked against
+the owner columns themselves, so a missing ref never costs a file.
+"""
+import os
+import uuid
+import hashlib
+import logging
+
+from werkzeug.utils import secure_filename
+
+from images import derived_key
+from uploads import UPLOAD_PURPOSES
+
+logger = logging.getLogger(__name__)
+
+# owner type -> (folder in the store, table, id column, file column)
+OWNERS = {
+    'story_cover': ('stories', 'stories', 'id', 'cover_image'),
+    'story_page': ('story_pages', 'story_pages', 'id', 'image_url'),
+    'student_profile': ('profiles', 'students', 'id', 'profile_photo'),
+    'teacher_profile': ('profiles', 'teachers', 'id', 'profile_photo'),
+}
+
+PLACEHOLDER_FILES = ('default_page_image.jpg',)  # stored in file columns, never on disk
+HIDDEN_SUFFIXES = ('.part', '.tmp')  # uploads and saves still being written
+COPY_BLOCK = 64 * 1024
+
+
+def blob_name(sha256, original_filename):
+    """<sha256><.ext>; the extension is kept so content types still work"""
+    _, ext = os.path.splitext(secure_filename(original_filename or ''))
+    return f'{sha256}{ext.lower()}'
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+class BlobStore:
+    """Stored files named by content, tracked in `blobs` and `blob_refs`"""
+
+    def __init__(self, storage, staging_folder, grace_hours=24):
+        self.storage = storage
+        self.staging_folder = staging_folder  # local scratch space for files being hashed
+        self.grace_hours = grace_hours
+
+    # --------------------------------------------------------------- saving
+    def save(self, cur, folder, stream, original_filename):
+        """Store a stream's bytes; returns (filename, duplicate). The caller commits"""
+        directory = os.path.join(self.staging_folder, folder)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f'{uuid.uuid4().hex}.tmp')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for block in iter(lambda: stream.read(COPY_BLOCK), b''):
+                    f.write(block)
+                    digest.update(block)
+                    size += len(block)
+            return self.adopt(cur, folder, tmp_path, digest.hexdigest(), size, original_filename)
+        finally:
+            self._remove(tmp_path)
+
+    def adopt(self, cur, folder, path, sha256, size, original_filename):
+        """Take over a written local file whose hash is known: it is stored under
+        its blob name, or deleted if that blob is already stored. Returns
+        (filename, duplicate)
+        """
+        filename = blob_name(sha256, original_filename)
+        # The row lock (held until the caller commits) keeps collect_garbage
+        # from deleting a blob that is being reused
+        cur.execute("""
+            INSERT INTO blobs (folder, filename, sha256, size_bytes)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE touched_at = NOW()
+        """, (folder, filename, sha256, size))
+        key = f'{folder}/{filename}'
+        duplicate = self.storage.exists(key)
+        if duplicate:
+            self._remove(path)
+        else:
+            self.storage.put_file(key, path)
+        return filename, duplicate
+
+    def reuse(self, cur, folder, sha256, size, original_filename):
+        """Name of a stored blob with this content, kept for another grace period; or None"""
+        filename = blob_name(sha256, original_filename)
+        cur.execute("""
+            SELECT size_bytes FROM blobs
+            WHERE folder = %s AND filename = %s
+            FOR UPDATE
+        """, (folder, filename))
+        blob = cur.fetchone()
+        if not blob or blob['size_bytes'] != size or not self.storage.exists(f'{folder}/{filename}'):
+            return None
+        cur.execute("UPDATE blobs SET touched_at = NOW() WHERE folder = %s AND filename = %s",
+                    (folder, filename))
+        return filename
+
+    # ----------------------------------------------------------- references
+    def set_refs(self, cur, owner_type, refs):
+        """Point owners at blobs: refs are (owner_id, filename or None) pairs.
+
+        Runs in the owner rows' transaction. Blobs that lose a reference
+        start a new grace period.
+        """
+        refs = list(refs)
+        if not refs:
+            return
+        self.drop_refs(cur, owner_type, [owner_id for owner_id, _ in refs])
+        folder = OWNERS[owner_type][0]
+        rows = [(owner_type, owner_id, folder, filename) for owner_id, filename in refs
+                if filename and filename not in PLACEHOLDER_FILES]
+        if rows:
+            cur.executemany("""
+                INSERT INTO blob_refs (owner_type, owner_id, folder, filename)
+                VALUES (%s, %s, %s, %s)
+            """, rows)
+
+    def drop_refs(self, cur, owner_type, owner_ids):
+        """Forget the blobs of owners that are deleted (or about to get new ones)"""
+        owner_ids = list(owner_ids)
+        if not owner_ids:
+            return
+        placeholders = _placeholders(owner_ids)
+        cur.execute(f"""
+            UPDATE blobs b
+            JOIN blob_refs r ON r.folder = b.folder AND r.filename = b.filename
+            SET b.touched_at = NOW()
+            WHERE r.owner_type = %s AND r.owner_id IN ({placeholders})
+        """, [owner_type] + owner_ids)
+        cur.execute(f"DELETE FROM blob_refs WHERE owner_type = %s AND owner_id IN ({placeholders})",
+                    [owner_type] + owner_ids)
+
+    def rebuild_refs(self, cur):
+        """Recompute blob_refs from the owner columns; returns the number of refs"""
+        total = 0
+        for owner_type, (folder, table, id_column, file_column) in OWNERS.items():
+            cur.execute("SELECT owner_id FROM blob_refs WHERE owner_type = %s", (owner_type,))
+            self.drop_refs(cur, owner_type, [row['owner_id'] for row in cur.fetchall()])
+            cur.execute(f"""
+                INSERT INTO blob_refs (owner_type, owner_id, folder, filename)
+                SELECT %s, {id_column}, %s, {file_column}
+                FROM {table}
+                WHERE {file_column} IS NOT NULL AND {file_column} != ''
+                  AND {file_column} NOT IN ({_placeholders(PLACEHOLDER_FILES)})
+            """, [owner_type, folder] + list(PLACEHOLDER_FILES))
+            total += cur.rowcount
+        return total
+
+    def register_files(self, cur):
+        """Add a blobs row for each stored file without one (e.g. saved before
+        the blob store), starting its grace period; returns the number added
+        """
+        added = 0
+        for folder in sorted({owner[0] for owner in OWNERS.values()}):
+            cur.execute("SELECT filename FROM blobs WHERE folder = %s", (folder,))
+            known = {row['filename'] for row in cur.fetchall()}
+            for name, size in self.storage.list(folder):
+                if name in known or name.endswith(HIDDEN_SUFFIXES):
+                    continue
+                cur.execute("""
+                    INSERT IGNORE INTO blobs (folder, filename, sha256, size_bytes)
+                    VALUES (%s, %s, %s, %s)
+                """, (folder, name, self._hash_key(f'{folder}/{name}'), size))
+                added += cur.rowcount
+        return added
+
+    # ---------------------------------------------------- garbage collection
+    def collect_garbage(self, cur, dry_run=False, grace_hours=None):
+        """Delete blobs with no reference for the grace period, with their derivatives.
+
+        Returns (removed, untracked): the blob rows deleted (or that would be,
+        with dry_run) and (folder, filename, owner) for candidates still named
+        by an owner column or upload session, which are kept (and their
+        missing refs restored). The caller commits.
+        """
+        grace_hours = self.grace_hours if grace_hours is None else grace_hours
+        cur.execute(f"""
+            SELECT b.folder, b.filename, b.size_bytes
+            FROM blobs b
+            WHERE b.touched_at < NOW() - INTERVAL %s HOUR
+              AND NOT EXISTS (SELECT 1 FROM blob_refs r
+                              WHERE r.folder = b.folder AND r.filename = b.filename)
+            ORDER BY b.folder, b.filename
+            {'' if dry_run else 'FOR UPDATE'}
+        """, (grace_hours,))
+        candidates = cur.fetchall()
+
+        untracked = self._find_users(cur, candidates)
+        if not dry_run:
+            for owner_type in OWNERS:
+                self.set_refs(cur, owner_type, [(owner_id, filename)
+                                                for _, filename, (kind, owner_id) in untracked
+                                                if kind == owner_type])
+
+        in_use = {(folder, filename) for folder, filename, _ in untracked}
+        removed = []
+        for blob in candidates:
+            key = (blob['folder'], blob['filename'])
+            if key in in_use:
+                continue
+            removed.append(blob)
+            if dry_run:
+                continue
+            cur.execute("DELETE FROM blobs WHERE folder = %s AND filename = %s", key)
+            self.storage.delete(f'{key[0]}/{key[1]}')
+            self.storage.delete_tree(derived_key(*key))
+        if removed and not dry_run:
+            logger.info(f"Removed {len(removed)} unreferenced blob(s), "
+                        f"{sum(blob['size_bytes'] for blob in removed)} bytes")
+        return removed, untracked
+
+    def _find_users(self, cur, blobs):
+        """(folder, filename, (owner type, id)) for blobs still named in an owner
+        column or by a finished upload session (owner type 'upload')"""
+        by_folder = {}
+        for blob in blobs:
+            by_folder.setdefault(blob['folder'], []).append(blob['filename'])
+
+        users = []
+        for folder, filenames in by_folder.items():
+            placeholders = _placeholders(filenames)
+            for owner_type, (owner_folder, table, id_column, file_column) in OWNERS.items():
+                if owner_folder != folder:
+                    continue
+                cur.execute(f"""
+                    SELECT {id_column} AS id, {file_column} AS filename FROM {table}
+                    WHERE {file_column} IN ({placeholders})
+                """, filenames)
+                users.extend((folder, row['filename'], (owner_type, row['id'])) for row in cur.fetchall())
+
+            purposes = [purpose for purpose, (purpose_folder, _) in UPLOAD_PURPOSES.items()
+                        if purpose_folder == folder]
+            if purposes:
+                cur.execute(f"""
+                    SELECT id, stored_name FROM uploads
+                    WHERE status = 'complete'
+                      AND purpose IN ({_placeholders(purposes)})
+                      AND stored_name IN ({placeholders})
+                """, purposes + filenames)
+                users.extend((folder, row['stored_name'], ('upload', row['id'])) for row in cur.fetchall())
+        return users
+
+    def _hash_key(self, key):
+        digest = hashlib.sha256()
+        stream = self.storage.open(key)
+        try:
+            for block in iter(lambda: stream.read(COPY_BLOCK), b''):
+                digest.update(block)
+        finally:
+            stream.close()
+        return digest.hexdigest()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Script to build resized derivatives for images uploaded before they existed
+
+New uploads get their derivatives in the background as they are saved; this
+walks the existing story covers and page images and builds any missing sets.
+Usage: python build_image_derivatives.py [--force]
+"""
+
+import sys
+
+from app import app, image_derivatives, storage
+
+IMAGE_FOLDERS = ('stories', 'story_pages')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+
+def build_missing_derivatives(force=False):
+    """Build derivative sets for every upload lacking one; returns (built, failed)"""
+    built = failed = 0
+    for folder in IMAGE_FOLDERS:
+        for filename in sorted(name for name, _ in storage.list(folder)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            if not force and image_derivatives.manifest(folder, filename) is not None:
+                continue
+            if image_derivatives.build(folder, filename) is None:
+                failed += 1
+                print(f"  ✗ {folder}/{filename}")
+            else:
+                built += 1
+    return built, failed
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        built, failed = build_missing_derivatives(force='--force' in sys.argv)
+    print(f"✓ Built derivatives for {built} image(s)")
+    if failed:
+        print(f"✗ {failed} image(s) could not be processed")
+        raise SystemExit(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Script to check that the configured upload storage works end to end
+
+Writes test files through STORAGE_BACKEND (streamed, and from a local file),
+reads them back, lists them, downloads one through its direct URL and
+deletes them again. To try the S3 driver without AWS, run a MinIO server and
+point the app at it:
+    docker run -p 9000:9000 minio/minio server /data
+    STORAGE_BACKEND=s3 S3_ENDPOINT_URL=http://localhost:9000 S3_BUCKET=comic-test \\
+        S3_ACCESS_KEY=minioadmin S3_SECRET_KEY=minioadmin python check_storage.py --create-bucket
+Usage: python check_storage.py [--create-bucket]
+"""
+
+import io
+import os
+import sys
+import uuid
+import tempfile
+import urllib.request
+
+from app import app, storage
+
+
+def read(key):
+    stream = storage.open(key)
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+
+def check(name, ok, detail=''):
+    print(f"  {'✓' if ok else '✗'} {name}{f' ({detail})' if detail else ''}")
+    return ok
+
+
+if __name__ == '__main__':
+    backend = app.config['STORAGE_BACKEND']
+    try:
+        if '--create-bucket' in sys.argv and not storage.local:
+            try:
+                storage.client.head_bucket(Bucket=storage.bucket)
+            except Exception:
+                storage.client.create_bucket(Bucket=storage.bucket)
+                print(f"✓ Created bucket {storage.bucket}")
+
+        prefix = f'storage-check/{uuid.uuid4().hex}'
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        results = []
+
+        streamed = f'{prefix}/streamed.bin'
+        storage.save(streamed, io.BytesIO(content))
+        results.append(check('Streamed write and read', read(streamed) == content))
+
+        fd, local_file = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content[:1000])
+        uploaded = f'{prefix}/from_file.bin'
+        storage.put_file(uploaded, local_file)
+        results.append(check('Write from a local file', read(uploaded) == content[:1000]
+                             and not os.path.exists(local_file)))
+
+        names = sorted(name for name, _ in storage.list(prefix))
+        results.append(check('List', names == ['from_file.bin', 'streamed.bin'], ', '.join(names)))
+
+        path = storage.local_path(streamed)
+        with open(path, 'rb') as f:
+            results.append(check('Local copy for the PDF renderer', f.read() == content, path))
+
+        url = storage.url(streamed)
+        if url is None:
+            print("  - No direct URL (files are served by /media)")
+        else:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                results.append(check('Direct download URL', response.read() == content))
+
+        storage.delete(streamed)
+        results.append(check('Delete', not storage.exists(streamed) and storage.local_path(streamed) is None))
+        storage.delete_tree(prefix)
+        results.append(check('Delete prefix', storage.list(prefix) == []))
+
+        if all(results):
+            print(f"✓ {backend} storage works")
+        else:
+            print(f"✗ {results.count(False)} {backend} storage check(s) failed")
+            raise SystemExit(1)
+    except SystemExit:
+        raise
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
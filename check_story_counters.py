@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Script to compare stories.page_count/has_quiz/question_count with the base tables
+
+Reports every story whose stored counters have drifted from story_pages,
+quizzes and quiz_questions (e.g. after editing those tables by hand). With
+--fix it recomputes the counters for all stories, which is also how they are
+filled in after adding the columns from database/schema.sql.
+Usage: python check_story_counters.py [--fix]
+"""
+
+import sys
+
+from app import app, mysql, find_story_counter_drift, refresh_story_counters
+
+
+if __name__ == '__main__':
+    fix = '--fix' in sys.argv
+    try:
+        with app.app_context():
+            cursor = mysql.connection.cursor()
+            drift = find_story_counter_drift(cursor)
+            for story in drift:
+                print(f"  ✗ story {story['id']} ({story['title']}): "
+                      f"pages {story['page_count']} vs {story['actual_page_count']}, "
+                      f"has_quiz {bool(story['has_quiz'])} vs {bool(story['actual_has_quiz'])}, "
+                      f"questions {story['question_count']} vs {story['actual_question_count']}")
+
+            if fix:
+                refresh_story_counters(cursor)
+                mysql.connection.commit()
+            cursor.close()
+
+            if not drift:
+                print("✓ Story counters match the base tables")
+            elif fix:
+                print(f"✓ Fixed counters for {len(drift)} story(ies)")
+            else:
+                print(f"✗ {len(drift)} story(ies) with stale counters (run with --fix)")
+                raise SystemExit(1)
+    except SystemExit:
+        raise
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
@@ -18,6 +18,65 @@ class Config:
     
     # Database connection pool settings
     MYSQL_CONNECTION_TIMEOUT = int(os.environ.get('MYSQL_CONNECTION_TIMEOUT', 30))
+    # Pool sizes are per worker process; gunicorn.conf.py sizes them from the thread count
+    MYSQL_POOL_SIZE = int(os.environ.get('MYSQL_POOL_SIZE', 4))
+    MYSQL_POOL_MAX_OVERFLOW = int(os.environ.get('MYSQL_POOL_MAX_OVERFLOW', 4))
+    MYSQL_POOL_TIMEOUT = int(os.environ.get('MYSQL_POOL_TIMEOUT', 10))  # seconds to wait for a free connection
+    MYSQL_POOL_RECYCLE = int(os.environ.get('MYSQL_POOL_RECYCLE', 3600))  # below MySQL's wait_timeout
+    MYSQL_POOL_PING_INTERVAL = int(os.environ.get('MYSQL_POOL_PING_INTERVAL', 30))  # ping on checkout if idle longer
+    
+    # Chat push events (SSE with long-poll fallback)
+    EVENTS_SPOOL_DIR = os.environ.get('EVENTS_SPOOL_DIR', '/tmp/comic_app_events')  # worker sockets for cross-worker fan-out
+    EVENTS_HEARTBEAT = int(os.environ.get('EVENTS_HEARTBEAT', 15))  # seconds between keep-alive comments
+    EVENTS_STREAM_MAX_AGE = int(os.environ.get('EVENTS_STREAM_MAX_AGE', 300))  # client reconnects after this
+    EVENTS_LONG_POLL_TIMEOUT = int(os.environ.get('EVENTS_LONG_POLL_TIMEOUT', 25))
+    # Open streams + long-polls per worker (each holds a thread); gunicorn.conf.py sizes it
+    # from the thread count. Clients beyond it poll without waiting, every EVENTS_BUSY_RETRY
+    EVENTS_MAX_WAITERS = int(os.environ.get('EVENTS_MAX_WAITERS', 15))
+    EVENTS_BUSY_RETRY = int(os.environ.get('EVENTS_BUSY_RETRY', 20))  # seconds
+    
+    # Chat history pagination
+    CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', 50))
+    CHAT_PAGE_SIZE_MAX = int(os.environ.get('CHAT_PAGE_SIZE_MAX', 200))
+    
+    # Reading progress writes: 'direct' commits every page turn; 'buffered' merges turns per
+    # (student, story) in memory and flushes them in batches (unflushed turns are lost on a crash)
+    PROGRESS_WRITE_MODE = os.environ.get('PROGRESS_WRITE_MODE', 'direct')
+    PROGRESS_FLUSH_INTERVAL = float(os.environ.get('PROGRESS_FLUSH_INTERVAL', 2.0))  # seconds between flushes
+    PROGRESS_FLUSH_MAX = int(os.environ.get('PROGRESS_FLUSH_MAX', 500))  # flush early once this many are pending
+    PROGRESS_SYNC_COMPLETION = os.environ.get('PROGRESS_SYNC_COMPLETION', 'true').lower() == 'true'  # completions always commit before responding
+    
+    # Background puzzle generation threads per worker
+    PUZZLE_WORKERS = int(os.environ.get('PUZZLE_WORKERS', 2))
+    
+    # Background image derivative threads per worker (see images.py)
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+    
+    # Background job queue (see jobs.py). When enabled, PDF renders, puzzle generation and image
+    # derivatives go into the jobs table and run in job_worker.py processes, not in web workers
+    JOB_QUEUE_ENABLED = os.environ.get('JOB_QUEUE_ENABLED', 'false').lower() == 'true'
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # processes started by job_worker.py
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))  # seconds an idle worker waits
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY', 30))  # seconds before the first retry, doubling after
+    JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 900))  # running longer means the worker died
+    JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))  # finished jobs are deleted after this
+    
+    # Request latency and SQL metrics, served to Prometheus at /metrics (see metrics.py); off by default
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # scrapers send "Authorization: Bearer <token>"
+    METRICS_DIR = os.environ.get('METRICS_DIR', '/tmp/comic_app_metrics')  # per-worker snapshots merged by /metrics
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5.0))  # seconds between snapshots
+    METRICS_SLOW_REQUEST_MS = int(os.environ.get('METRICS_SLOW_REQUEST_MS', 1000))  # log SQL stats above this
+    
+    # Generated story PDF cache (not under static/: PDFs include answer keys)
+    PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', 'cache/pdf')
+    PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+    
+    # Student drawings (private, so kept outside static/)
+    DRAWINGS_FOLDER = os.environ.get('DRAWINGS_FOLDER', 'data/drawings')
+    DRAWING_MAX_BYTES = int(os.environ.get('DRAWING_MAX_BYTES', 10 * 1024 * 1024))  # largest PNG snapshot accepted
+    DRAWING_LOG_COMPACT_BYTES = int(os.environ.get('DRAWING_LOG_COMPACT_BYTES', 256 * 1024))  # ask client for a snapshot past this
     
     # Session configuration
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
@@ -33,6 +92,34 @@ class Config:
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     ALLOWED_AUDIO_EXTENSIONS = {'mp3', 'wav', 'ogg'}
     
+    # Where uploaded files are kept (see storage.py): 'local' (UPLOAD_FOLDER) or 's3' for any
+    # S3-compatible service, shared by every app node. UPLOAD_FOLDER then only stages uploads.
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    S3_BUCKET = os.environ.get('S3_BUCKET', '')
+    S3_PREFIX = os.environ.get('S3_PREFIX', '')  # key prefix inside the bucket
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.environ.get('S3_REGION') or None
+    S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY') or None  # unset: boto3's usual credential lookup
+    S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY') or None
+    S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL', '')  # public bucket/CDN base URL; presigned URLs if unset
+    S3_URL_EXPIRY = int(os.environ.get('S3_URL_EXPIRY', 3600))  # seconds a presigned download URL is valid
+    STORAGE_CACHE_DIR = os.environ.get('STORAGE_CACHE_DIR', 'cache/storage')  # local copies for PDFs and resizing
+    STORAGE_CACHE_MAX_MB = int(os.environ.get('STORAGE_CACHE_MAX_MB', 1024))
+    
+    # Uploads are served by /media (see media.py). MEDIA_OFFLOAD lets the front server send the bytes:
+    # 'x-accel' (nginx internal location at MEDIA_ACCEL_PREFIX aliasing UPLOAD_FOLDER) or 'x-sendfile'
+    MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD', '')
+    MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media')
+    
+    # Resumable chunked uploads for story media (see uploads.py)
+    UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', 4 * 1024 * 1024))  # largest chunk per request
+    UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 100 * 1024 * 1024))  # largest file per upload
+    UPLOAD_SESSION_HOURS = int(os.environ.get('UPLOAD_SESSION_HOURS', 24))  # unfinished/unused uploads deleted after
+    
+    # Uploads are stored once per content hash (see blobs.py); gc_blobs.py deletes
+    # files that nothing has referred to for this long
+    BLOB_GC_GRACE_HOURS = int(os.environ.get('BLOB_GC_GRACE_HOURS', 48))
+    
     # Security
     SECURITY_PASSWORD_SALT = os.environ.get('SECURITY_PASSWORD_SALT') or 'password-salt'
     WTF_CSRF_ENABLED = True
@@ -65,12 +65,22 @@ CREATE TABLE stories (
     description TEXT,
     cover_image VARCHAR(255),
     is_published BOOLEAN DEFAULT FALSE,
+    -- Copies of counts over story_pages/quizzes/quiz_questions, kept by the app
+    page_count INT NOT NULL DEFAULT 0,
+    has_quiz BOOLEAN NOT NULL DEFAULT FALSE,
+    question_count INT NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     FOREIGN KEY (teacher_id) REFERENCES teachers(id) ON DELETE CASCADE,
     INDEX idx_teacher_id (teacher_id),
     INDEX idx_is_published (is_published)
 );
+-- -- Denormalized story counters (fill them with: python check_story_counters.py --fix)
+-- ALTER TABLE stories
+-- ADD COLUMN page_count INT NOT NULL DEFAULT 0 AFTER is_published,
+-- ADD COLUMN has_quiz BOOLEAN NOT NULL DEFAULT FALSE AFTER page_count,
+-- ADD COLUMN question_count INT NOT NULL DEFAULT 0 AFTER has_quiz;
+
 -- ALTER TABLE stories 
 -- ADD COLUMN story_video VARCHAR(255) NULL AFTER cover_image;
 
@@ -111,10 +121,13 @@ CREATE TABLE quizzes (
     description TEXT,
     time_limit INT DEFAULT 600, -- in seconds
     passing_score INT DEFAULT 60, -- percentage
+    version INT NOT NULL DEFAULT 1, -- bumped on every save; keys cached item analysis
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (story_id) REFERENCES stories(id) ON DELETE CASCADE,
     INDEX idx_story_id (story_id)
 );
+-- ALTER TABLE quizzes
+-- ADD COLUMN version INT NOT NULL DEFAULT 1 AFTER passing_score;
 
 -- Quiz questions table
 CREATE TABLE quiz_questions (
@@ -191,6 +204,85 @@ CREATE TABLE class_assignments (
     INDEX idx_class_level (class_level)
 );
 
+-- Dashboard/analytics rollups, maintained by the progress and quiz write paths
+-- (python rebuild_rollups.py recomputes them, e.g. after creating these tables)
+CREATE TABLE IF NOT EXISTS story_stats (
+    story_id INT PRIMARY KEY,
+    students_started INT NOT NULL DEFAULT 0,
+    students_completed INT NOT NULL DEFAULT 0,
+    quiz_attempts INT NOT NULL DEFAULT 0,
+    quiz_score_sum DECIMAL(12,2) NOT NULL DEFAULT 0,
+    quiz_score_min DECIMAL(5,2) NULL,
+    quiz_score_max DECIMAL(5,2) NULL,
+    students_passed INT NOT NULL DEFAULT 0, -- distinct students with a passing attempt
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (story_id) REFERENCES stories(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS class_story_stats (
+    story_id INT NOT NULL,
+    class_level VARCHAR(50) NOT NULL, -- the student's class when the activity happened
+    students_started INT NOT NULL DEFAULT 0,
+    students_completed INT NOT NULL DEFAULT 0,
+    quiz_attempts INT NOT NULL DEFAULT 0,
+    quiz_score_sum DECIMAL(12,2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (story_id, class_level),
+    FOREIGN KEY (story_id) REFERENCES stories(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS teacher_stats (
+    teacher_id INT PRIMARY KEY,
+    total_stories INT NOT NULL DEFAULT 0,
+    published_stories INT NOT NULL DEFAULT 0,
+    quiz_attempts INT NOT NULL DEFAULT 0,
+    quiz_score_sum DECIMAL(12,2) NOT NULL DEFAULT 0,
+    quiz_score_min DECIMAL(5,2) NULL,
+    quiz_score_max DECIMAL(5,2) NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (teacher_id) REFERENCES teachers(id) ON DELETE CASCADE
+);
+
+-- Class stats shown on the quiz result page; passed/failed count attempts
+-- against the quiz's current passing_score
+CREATE TABLE IF NOT EXISTS quiz_stats (
+    quiz_id INT PRIMARY KEY,
+    total_attempts INT NOT NULL DEFAULT 0,
+    score_sum DECIMAL(12,2) NOT NULL DEFAULT 0,
+    passed_count INT NOT NULL DEFAULT 0,
+    failed_count INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (quiz_id) REFERENCES quizzes(id) ON DELETE CASCADE
+);
+
+-- Item statistics for /api/quiz_statistics, written with each quiz submission
+-- (python rebuild_quiz_statistics.py backfills them from existing answers)
+CREATE TABLE IF NOT EXISTS quiz_question_stats (
+    question_id INT PRIMARY KEY,
+    quiz_id INT NOT NULL,
+    total_answers INT NOT NULL DEFAULT 0,
+    correct_answers INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (question_id) REFERENCES quiz_questions(id) ON DELETE CASCADE,
+    INDEX idx_quiz_id (quiz_id)
+);
+
+CREATE TABLE IF NOT EXISTS quiz_answer_counts (
+    question_id INT NOT NULL,
+    answer VARCHAR(191) NOT NULL, -- trimmed, first 191 characters
+    answer_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (question_id, answer),
+    FOREIGN KEY (question_id) REFERENCES quiz_questions(id) ON DELETE CASCADE,
+    INDEX idx_question_count (question_id, answer_count)
+);
+
+CREATE TABLE IF NOT EXISTS quiz_score_buckets (
+    quiz_id INT NOT NULL,
+    bucket INT NOT NULL, -- FLOOR(score/10)*10
+    attempt_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (quiz_id, bucket),
+    FOREIGN KEY (quiz_id) REFERENCES quizzes(id) ON DELETE CASCADE
+);
+
 -- Audit log table
 CREATE TABLE audit_log (
     id INT PRIMARY KEY AUTO_INCREMENT,
@@ -204,6 +296,72 @@ CREATE TABLE audit_log (
     INDEX idx_created_at (created_at)
 );
 
+-- Resumable chunked uploads (uploads.py); story forms refer to finished uploads by id
+CREATE TABLE IF NOT EXISTS uploads (
+    id CHAR(32) PRIMARY KEY, -- random hex, also what the client resumes with
+    created_by INT NOT NULL, -- users.id
+    purpose VARCHAR(32) NOT NULL, -- 'story_cover' or 'story_page'
+    original_name VARCHAR(255) NOT NULL,
+    stored_name VARCHAR(255) NOT NULL, -- file name in the purpose's upload folder
+    total_bytes BIGINT NOT NULL,
+    received_bytes BIGINT NOT NULL DEFAULT 0,
+    expected_sha256 CHAR(64) NULL, -- sent by the client, checked on the last chunk
+    sha256 CHAR(64) NULL, -- computed as the chunks arrived
+    status ENUM('uploading', 'complete', 'attached', 'failed') NOT NULL DEFAULT 'uploading',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_created_by (created_by),
+    INDEX idx_status_updated (status, updated_at)
+);
+
+-- Uploaded files stored under their content hash (blobs.py), one row per file on disk
+CREATE TABLE IF NOT EXISTS blobs (
+    folder VARCHAR(32) NOT NULL, -- under UPLOAD_FOLDER: 'stories', 'story_pages', 'profiles'
+    filename VARCHAR(255) NOT NULL, -- <sha256><.ext> (files saved earlier keep their names)
+    sha256 CHAR(64) NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    touched_at DATETIME DEFAULT CURRENT_TIMESTAMP, -- last saved again or lost a reference; GC waits from here
+    PRIMARY KEY (folder, filename),
+    INDEX idx_sha256 (sha256),
+    INDEX idx_touched (touched_at)
+);
+
+-- Which row uses which blob; gc_blobs.py deletes blobs with none left
+CREATE TABLE IF NOT EXISTS blob_refs (
+    owner_type VARCHAR(32) NOT NULL, -- 'story_cover', 'story_page', 'student_profile', 'teacher_profile'
+    owner_id INT NOT NULL, -- id in the owner's table
+    folder VARCHAR(32) NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (owner_type, owner_id),
+    INDEX idx_blob (folder, filename)
+);
+
+-- Background jobs (jobs.py), run by job_worker.py processes in priority order
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGINT PRIMARY KEY AUTO_INCREMENT,
+    kind VARCHAR(64) NOT NULL, -- handler name, e.g. 'story_pdf'
+    payload TEXT NOT NULL, -- JSON keyword arguments for the handler
+    priority INT NOT NULL DEFAULT 10, -- higher runs first
+    status ENUM('queued', 'running', 'succeeded', 'failed') NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 3,
+    run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, -- pushed back between retries
+    dedupe_key VARCHAR(191) NULL, -- only set while queued, so repeat requests share the job
+    created_by INT NULL, -- users.id allowed to poll the job
+    locked_by VARCHAR(128) NULL, -- worker running the job
+    locked_at DATETIME NULL,
+    result TEXT NULL, -- JSON
+    error TEXT NULL, -- last failure
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    finished_at DATETIME NULL,
+    UNIQUE KEY uniq_dedupe_key (dedupe_key),
+    INDEX idx_claim (status, priority, id),
+    INDEX idx_created_by (created_by, id),
+    INDEX idx_finished (status, finished_at)
+);
+
 -- Puzzle types table
 CREATE TABLE puzzle_types (
     id INT PRIMARY KEY AUTO_INCREMENT,
@@ -259,17 +417,53 @@ CREATE TABLE student_puzzle_progress (
     INDEX idx_puzzle (puzzle_id)
 );
 
+-- Students' private drawings. Only metadata lives here; the PNG snapshot and the
+-- stroke log drawn since it are files under DRAWINGS_FOLDER named by generation
+CREATE TABLE IF NOT EXISTS student_drawings (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    story_id INT NOT NULL,
+    student_id INT NOT NULL,
+    generation INT NOT NULL DEFAULT 0, -- bumped by every snapshot and clear
+    has_snapshot BOOLEAN NOT NULL DEFAULT FALSE,
+    log_bytes INT NOT NULL DEFAULT 0, -- committed length of the stroke log
+    stroke_count INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (story_id) REFERENCES stories(id) ON DELETE CASCADE,
+    FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+    UNIQUE KEY unique_student_drawing (story_id, student_id)
+);
+
+-- -- File-backed drawings for existing databases (base64 data URLs in drawing_data)
+-- ALTER TABLE student_drawings
+-- ADD COLUMN generation INT NOT NULL DEFAULT 0 AFTER student_id,
+-- ADD COLUMN has_snapshot BOOLEAN NOT NULL DEFAULT FALSE AFTER generation,
+-- ADD COLUMN log_bytes INT NOT NULL DEFAULT 0 AFTER has_snapshot,
+-- ADD COLUMN stroke_count INT NOT NULL DEFAULT 0 AFTER log_bytes;
+-- -- then run: python migrate_student_drawings.py
+-- ALTER TABLE student_drawings DROP COLUMN drawing_data;
+
 -- Chat conversations (teacher <-> student)
 CREATE TABLE chat_conversations (
     id INT PRIMARY KEY AUTO_INCREMENT,
     teacher_id INT NOT NULL,
     student_id INT NOT NULL,
+    teacher_unread INT NOT NULL DEFAULT 0, -- unread messages from the student
+    student_unread INT NOT NULL DEFAULT 0, -- unread messages from the teacher
+    last_message_at TIMESTAMP NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE KEY unique_teacher_student (teacher_id, student_id),
     FOREIGN KEY (teacher_id) REFERENCES teachers(id) ON DELETE CASCADE,
     FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE
 );
 
+-- -- Materialized unread counters for existing databases
+-- -- (then run: python repair_unread_counters.py)
+-- ALTER TABLE chat_conversations
+-- ADD COLUMN teacher_unread INT NOT NULL DEFAULT 0 AFTER student_id,
+-- ADD COLUMN student_unread INT NOT NULL DEFAULT 0 AFTER teacher_unread,
+-- ADD COLUMN last_message_at TIMESTAMP NULL AFTER student_unread;
+
 -- Chat messages
 CREATE TABLE chat_messages (
     id INT PRIMARY KEY AUTO_INCREMENT,
@@ -280,15 +474,22 @@ CREATE TABLE chat_messages (
     is_read BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (conversation_id) REFERENCES chat_conversations(id) ON DELETE CASCADE,
-    INDEX idx_conversation (conversation_id),
+    INDEX idx_conversation_message (conversation_id, id),
     INDEX idx_created_at (created_at)
 );
 
+-- -- Keyset pagination index for existing databases (replaces idx_conversation)
+-- ALTER TABLE chat_messages
+-- ADD INDEX idx_conversation_message (conversation_id, id),
+-- DROP INDEX idx_conversation;
+
 -- Student-to-student chat tables (make sure these exist)
 CREATE TABLE IF NOT EXISTS student_conversations (
     id INT PRIMARY KEY AUTO_INCREMENT,
     student1_id INT NOT NULL,
     student2_id INT NOT NULL,
+    student1_unread INT NOT NULL DEFAULT 0, -- unread messages from student2
+    student2_unread INT NOT NULL DEFAULT 0, -- unread messages from student1
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE KEY unique_student_pair (student1_id, student2_id),
     FOREIGN KEY (student1_id) REFERENCES students(id) ON DELETE CASCADE,
@@ -297,6 +498,11 @@ CREATE TABLE IF NOT EXISTS student_conversations (
     INDEX idx_student2 (student2_id)
 );
 
+-- -- Materialized unread counters for existing databases
+-- ALTER TABLE student_conversations
+-- ADD COLUMN student1_unread INT NOT NULL DEFAULT 0 AFTER student2_id,
+-- ADD COLUMN student2_unread INT NOT NULL DEFAULT 0 AFTER student1_unread;
+
 CREATE TABLE IF NOT EXISTS student_messages (
     id INT PRIMARY KEY AUTO_INCREMENT,
     conversation_id INT NOT NULL,
@@ -306,12 +512,28 @@ CREATE TABLE IF NOT EXISTS student_messages (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (conversation_id) REFERENCES student_conversations(id) ON DELETE CASCADE,
     FOREIGN KEY (sender_id) REFERENCES students(id) ON DELETE CASCADE,
-    INDEX idx_conversation (conversation_id),
+    INDEX idx_conversation_message (conversation_id, id),
     INDEX idx_sender (sender_id),
     INDEX idx_created_at (created_at),
     INDEX idx_is_read (is_read)
 );
 
+-- -- Keyset pagination index for existing databases (replaces idx_conversation)
+-- ALTER TABLE student_messages
+-- ADD INDEX idx_conversation_message (conversation_id, id),
+-- DROP INDEX idx_conversation;
+
+-- Unread message totals per participant, kept in step with the per-conversation
+-- counters by the chat send/mark-read endpoints (repair_unread_counters.py rebuilds them)
+CREATE TABLE IF NOT EXISTS chat_unread_counters (
+    participant_type ENUM('teacher','student') NOT NULL,
+    participant_id INT NOT NULL, -- teachers.id or students.id
+    chat_unread INT NOT NULL DEFAULT 0, -- teacher<->student chat
+    student_chat_unread INT NOT NULL DEFAULT 0, -- student<->student chat
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (participant_type, participant_id)
+);
+
 CREATE TABLE IF NOT EXISTS messages (
     id INT AUTO_INCREMENT PRIMARY KEY,
     sender_id INT NOT NULL,
@@ -0,0 +1,302 @@
+# db_pool.py
+"""Pooled MySQL connections for the Flask app.
+
+Drop-in replacement for ``flask_mysqldb.MySQL``: ``mysql.connection`` still
+returns a MySQLdb connection bound to the current app context, but the
+connection is checked out of a per-process pool and handed back on teardown
+instead of being opened and closed for every request.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import MySQLdb
+from MySQLdb import cursors
+from flask import g
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within MYSQL_POOL_TIMEOUT"""
+
+
+class _PooledConnection:
+    """Bookkeeping wrapper around a raw MySQLdb connection"""
+
+    __slots__ = ('raw', 'created_at', 'last_used')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """Thread-safe, fork-aware pool of MySQLdb connections"""
+
+    def __init__(self, connect_kwargs, size=4, max_overflow=4, timeout=10,
+                 recycle=3600, ping_interval=30):
+        self.connect_kwargs = connect_kwargs
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._checked_out = 0
+        self._stats = {
+            'connections_created': 0,
+            'connections_closed': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'ping_failures': 0,
+            'recycled': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'timeouts': 0,
+        }
+
+    # Sockets inherited from a parent process must never be closed by the
+    # child (that would send COM_QUIT on the parent's connection), so they
+    # are parked here for the lifetime of the process.
+    _orphans = []
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            ConnectionPool._orphans.extend(self._idle)
+            logger.info(f"Process forked, dropping {len(self._idle)} inherited MySQL connections")
+            self._reset_state()
+
+    def _connect(self):
+        conn = _PooledConnection(MySQLdb.connect(**self.connect_kwargs))
+        self._stats['connections_created'] += 1
+        return conn
+
+    def _close(self, conn):
+        self._stats['connections_closed'] += 1
+        try:
+            conn.raw.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn):
+        now = time.monotonic()
+        if self.recycle and now - conn.created_at > self.recycle:
+            self._stats['recycled'] += 1
+            return False
+        if now - conn.last_used < self.ping_interval:
+            return True
+        try:
+            conn.raw.ping()
+            return True
+        except MySQLdb.Error as e:
+            self._stats['ping_failures'] += 1
+            logger.warning(f"Discarding dead pooled MySQL connection: {str(e)}")
+            return False
+
+    @property
+    def capacity(self):
+        return self.size + self.max_overflow
+
+    def acquire(self):
+        """Check out a healthy connection, opening a new one if the pool is empty"""
+        deadline = None
+        with self._cond:
+            self._check_fork()
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if self._is_healthy(conn):
+                        self._checked_out += 1
+                        self._stats['checkouts'] += 1
+                        self._stats['reused'] += 1
+                        return conn
+                    self._close(conn)
+
+                if self._checked_out < self.capacity:
+                    # Reserve the slot before releasing the lock to connect
+                    self._checked_out += 1
+                    break
+
+                if deadline is None:
+                    deadline = time.monotonic() + self.timeout
+                    self._stats['waits'] += 1
+                    wait_started = time.monotonic()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"No MySQL connection available after {self.timeout}s "
+                        f"({self._checked_out} checked out)"
+                    )
+                self._cond.wait(remaining)
+                self._stats['wait_time_ms'] += (time.monotonic() - wait_started) * 1000
+                wait_started = time.monotonic()
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats['checkouts'] += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection; overflow and broken connections are closed"""
+        with self._cond:
+            if self._pid != os.getpid():
+                # Checked out before a fork; not ours to keep or close
+                return
+            self._checked_out -= 1
+            if not discard:
+                try:
+                    # Never hand an open transaction to the next request
+                    conn.raw.rollback()
+                except MySQLdb.Error:
+                    discard = True
+            if discard or len(self._idle) >= self.size:
+                self._close(conn)
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def prewarm(self, count=None):
+        """Open idle connections up front so the first requests skip the handshake"""
+        count = self.size if count is None else min(count, self.size)
+        opened = 0
+        with self._cond:
+            self._check_fork()
+            missing = count - len(self._idle) - self._checked_out
+        for _ in range(max(missing, 0)):
+            try:
+                conn = self._connect()
+            except MySQLdb.Error as e:
+                logger.warning(f"MySQL pool prewarm stopped early: {str(e)}")
+                break
+            with self._cond:
+                self._idle.append(conn)
+            opened += 1
+        logger.info(f"MySQL pool prewarmed with {opened} connection(s) in pid {os.getpid()}")
+        return opened
+
+    def dispose(self):
+        """Close every idle connection (checked-out ones close on release)"""
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop())
+
+    def stats(self):
+        with self._cond:
+            self._check_fork()
+            return dict(
+                self._stats,
+                pid=self._pid,
+                size=self.size,
+                max_overflow=self.max_overflow,
+                idle=len(self._idle),
+                checked_out=self._checked_out,
+            )
+
+
+class MySQL:
+    """Flask extension exposing a pooled ``connection`` per app context"""
+
+    def __init__(self, app=None):
+        self.pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MYSQL_HOST', 'localhost')
+        app.config.setdefault('MYSQL_USER', None)
+        app.config.setdefault('MYSQL_PASSWORD', None)
+        app.config.setdefault('MYSQL_DB', None)
+        app.config.setdefault('MYSQL_PORT', 3306)
+        app.config.setdefault('MYSQL_UNIX_SOCKET', None)
+        app.config.setdefault('MYSQL_CONNECTION_TIMEOUT', None)
+        app.config.setdefault('MYSQL_CHARSET', 'utf8')
+        app.config.setdefault('MYSQL_USE_UNICODE', True)
+        app.config.setdefault('MYSQL_CURSORCLASS', None)
+        app.config.setdefault('MYSQL_POOL_SIZE', 4)
+        app.config.setdefault('MYSQL_POOL_MAX_OVERFLOW', 4)
+        app.config.setdefault('MYSQL_POOL_TIMEOUT', 10)
+        app.config.setdefault('MYSQL_POOL_RECYCLE', 3600)
+        app.config.setdefault('MYSQL_POOL_PING_INTERVAL', 30)
+
+        self.pool = ConnectionPool(
+            self._connect_kwargs(app.config),
+            size=app.config['MYSQL_POOL_SIZE'],
+            max_overflow=app.config['MYSQL_POOL_MAX_OVERFLOW'],
+            timeout=app.config['MYSQL_POOL_TIMEOUT'],
+            recycle=app.config['MYSQL_POOL_RECYCLE'],
+            ping_interval=app.config['MYSQL_POOL_PING_INTERVAL'],
+        )
+        app.extensions['mysql'] = self
+        app.teardown_appcontext(self.teardown)
+
+    @staticmethod
+    def _connect_kwargs(config):
+        kwargs = {}
+        if config['MYSQL_HOST']:
+            kwargs['host'] = config['MYSQL_HOST']
+        if config['MYSQL_USER']:
+            kwargs['user'] = config['MYSQL_USER']
+        if config['MYSQL_PASSWORD']:
+            kwargs['passwd'] = config['MYSQL_PASSWORD']
+        if config['MYSQL_DB']:
+            kwargs['db'] = config['MYSQL_DB']
+        if config['MYSQL_PORT']:
+            kwargs['port'] = config['MYSQL_PORT']
+        if config['MYSQL_UNIX_SOCKET']:
+            kwargs['unix_socket'] = config['MYSQL_UNIX_SOCKET']
+        if config['MYSQL_CONNECTION_TIMEOUT']:
+            kwargs['connect_timeout'] = config['MYSQL_CONNECTION_TIMEOUT']
+        if config['MYSQL_CHARSET']:
+            kwargs['charset'] = config['MYSQL_CHARSET']
+        if config['MYSQL_USE_UNICODE']:
+            kwargs['use_unicode'] = config['MYSQL_USE_UNICODE']
+        if config['MYSQL_CURSORCLASS']:
+            kwargs['cursorclass'] = getattr(cursors, config['MYSQL_CURSORCLASS'])
+        return kwargs
+
+    @property
+    def connection(self):
+        """Connection for the current app context, checked out on first use"""
+        pooled = g.get('_mysql_pooled')
+        if pooled is None:
+            pooled = self.pool.acquire()
+            g._mysql_pooled = pooled
+        return pooled.raw
+
+    def teardown(self, exception):
+        pooled = g.pop('_mysql_pooled', None)
+        if pooled is not None:
+            discard = isinstance(exception, MySQLdb.OperationalError)
+            self.pool.release(pooled, discard=discard)
+
+    @property
+    def cursorclass(self):
+        return self.pool.connect_kwargs.get('cursorclass', cursors.Cursor)
+
+    def use_cursorclass(self, cursorclass):
+        """Open new connections with this cursor class (call before the first checkout)"""
+        self.pool.connect_kwargs['cursorclass'] = cursorclass
+
+    def prewarm(self, count=None):
+        return self.pool.prewarm(count)
+
+    def stats(self):
+        return self.pool.stats()
@@ -0,0 +1,155 @@
+# drawings.py
+"""File storage for students' private story drawings.
+
+A drawing is a PNG snapshot of the canvas plus an append-only log of the
+vector strokes drawn since that snapshot (one compact JSON object per line):
+
+    <directory>/<student_id>/<story_id>-<generation>.png
+    <directory>/<student_id>/<story_id>-<generation>.strokes
+
+The student_drawings row holds only metadata. Its generation names the
+current pair of files and is bumped by every new snapshot and by clearing,
+so a half-finished write never replaces what the row points at. log_bytes
+is the committed length of the stroke log; appends truncate to it first, so
+bytes left by a write whose transaction rolled back are overwritten.
+"""
+import os
+import re
+import json
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+STROKE_TYPES = {
+    'path': None,     # p: [x0, y0, x1, y1, ...] freehand brush/eraser
+    'line': 4,        # p: [x0, y0, x1, y1]
+    'rect': 4,        # p: [x, y, width, height]
+    'circle': 3,      # p: [cx, cy, radius]
+    'text': 2,        # p: [x, y], s: text
+}
+MAX_STROKES_PER_APPEND = 200
+MAX_POINTS_PER_STROKE = 4000
+MAX_TEXT_LENGTH = 500
+COLOR_RE = re.compile(r'^#[0-9a-fA-F]{6}$')
+GENERATION_FILE_RE = re.compile(r'^(\d+)-(\d+)\.(?:png|strokes)$')  # <story_id>-<generation>.<ext>
+
+
+def validate_strokes(strokes):
+    """Normalized copy of a client stroke list; raises ValueError if malformed"""
+    if not isinstance(strokes, list) or not strokes:
+        raise ValueError('strokes must be a non-empty list')
+    if len(strokes) > MAX_STROKES_PER_APPEND:
+        raise ValueError(f'at most {MAX_STROKES_PER_APPEND} strokes per request')
+
+    clean = []
+    for stroke in strokes:
+        if not isinstance(stroke, dict) or stroke.get('t') not in STROKE_TYPES:
+            raise ValueError('unknown stroke type')
+        kind = stroke['t']
+        color = stroke.get('c')
+        width = stroke.get('w')
+        points = stroke.get('p')
+        if not isinstance(color, str) or not COLOR_RE.match(color):
+            raise ValueError('invalid stroke color')
+        if not isinstance(width, (int, float)) or not 0 < width <= 200:
+            raise ValueError('invalid stroke width')
+        if not isinstance(points, list) or not all(isinstance(v, (int, float)) for v in points):
+            raise ValueError('invalid stroke points')
+
+        expected = STROKE_TYPES[kind]
+        if expected is None:
+            if len(points) < 2 or len(points) % 2 or len(points) > 2 * MAX_POINTS_PER_STROKE:
+                raise ValueError('invalid path points')
+        elif len(points) != expected:
+            raise ValueError(f'{kind} strokes take {expected} values')
+
+        item = {'t': kind, 'c': color, 'w': width, 'p': [round(v, 1) for v in points]}
+        if kind == 'text':
+            text = stroke.get('s')
+            if not isinstance(text, str) or not text or len(text) > MAX_TEXT_LENGTH:
+                raise ValueError('invalid text stroke')
+            item['s'] = text
+        clean.append(item)
+    return clean
+
+
+class DrawingStore:
+    """Snapshot and stroke-log files for (student, story) drawings"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _base(self, student_id, story_id, generation):
+        return os.path.join(self.directory, str(int(student_id)), f'{int(story_id)}-{int(generation)}')
+
+    def snapshot_path(self, student_id, story_id, generation):
+        return self._base(student_id, story_id, generation) + '.png'
+
+    def log_path(self, student_id, story_id, generation):
+        return self._base(student_id, story_id, generation) + '.strokes'
+
+    def write_snapshot(self, student_id, story_id, generation, data):
+        """Store PNG bytes for a generation atomically; returns the path"""
+        if not data.startswith(PNG_SIGNATURE):
+            raise ValueError('not a PNG image')
+        path = self.snapshot_path(student_id, story_id, generation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def append_strokes(self, student_id, story_id, generation, offset, strokes):
+        """Write strokes at the committed end of the log; returns the new length.
+
+        The caller holds the drawing row lock, so only one writer appends to a
+        given log at a time.
+        """
+        path = self.log_path(student_id, story_id, generation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = ''.join(json.dumps(s, separators=(',', ':')) + '\n' for s in strokes).encode('utf-8')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, offset)
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, payload)
+        finally:
+            os.close(fd)
+        return offset + len(payload)
+
+    def read_strokes(self, student_id, story_id, generation, length):
+        """Strokes in the first `length` (committed) bytes of the log"""
+        if not length:
+            return []
+        try:
+            with open(self.log_path(student_id, story_id, generation), 'rb') as f:
+                data = f.read(length)
+        except FileNotFoundError:
+            logger.warning(f"Stroke log missing for student {student_id}, story {story_id}")
+            return []
+        return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+    def discard_older_generations(self, student_id, story_id, keep):
+        """Best-effort removal of the files of generations below `keep`.
+
+        Runs after the caller has committed, when another request may already
+        be writing a later generation, so only older generations' finished
+        files are removed: never newer ones, never .tmp files being written.
+        """
+        directory = os.path.join(self.directory, str(int(student_id)))
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            match = GENERATION_FILE_RE.match(name)
+            if not match or int(match.group(1)) != int(story_id) or int(match.group(2)) >= int(keep):
+                continue
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
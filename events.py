@@ -0,0 +1,182 @@
+# events.py
+"""In-process pub/sub used to push chat events to connected browsers.
+
+Every gunicorn worker keeps its own EventBroker. Publishing delivers the event
+to local subscribers and forwards it to the other workers on this machine via
+Unix datagram sockets in a shared spool directory (a local stand-in for a real
+broker such as Redis). Events only carry ids and metadata; clients fetch the
+actual data through the normal API when they receive one.
+
+Each open stream or long-poll holds a worker thread while it waits, so the
+routes reserve a waiter slot first (acquire_waiter) and turn clients away
+once a worker's limit is reached.
+"""
+import os
+import glob
+import json
+import time
+import atexit
+import socket
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Max datagram we ever send; events are small metadata dicts
+MAX_EVENT_BYTES = 8192
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+class EventBroker:
+    """Per-process broker with a short replay buffer for reconnects and long-polls"""
+
+    def __init__(self, spool_dir=None, history=100, history_ttl=120):
+        self.spool_dir = spool_dir
+        self.history = history
+        self.history_ttl = history_ttl
+
+        self._cond = threading.Condition()
+        self._channels = {}
+        self._last_id = 0
+        self._waiters = 0
+        self._pid = None
+        self._sock = None
+        self._sock_path = None
+
+    # ------------------------------------------------------------------ ids
+    def _next_id(self):
+        # Wall-clock microseconds keep ids comparable across workers, so a
+        # long-poll cursor handed out by one worker is valid on another
+        # (and they stay below JavaScript's Number.MAX_SAFE_INTEGER).
+        with self._cond:
+            self._last_id = max(self._last_id + 1, _now_us())
+            return self._last_id
+
+    def latest_id(self):
+        """Cursor for a client that only wants events from now on"""
+        return max(self._last_id, _now_us())
+
+    # ------------------------------------------------------------- publish
+    def publish(self, channels, event_type, data):
+        """Deliver an event to every subscriber of the given channels, in all workers"""
+        self._ensure_listener()
+        event = {
+            'id': self._next_id(),
+            'type': event_type,
+            'data': data,
+            'channels': list(channels),
+            'origin': os.getpid(),
+        }
+        self._deliver(event)
+        self._fan_out(event)
+        return event['id']
+
+    def _deliver(self, event):
+        cutoff = time.monotonic() - self.history_ttl
+        with self._cond:
+            self._last_id = max(self._last_id, event['id'])
+            for channel in event['channels']:
+                buffer = self._channels.setdefault(channel, deque(maxlen=self.history))
+                buffer.append((time.monotonic(), event))
+                while buffer and buffer[0][0] < cutoff:
+                    buffer.popleft()
+            self._cond.notify_all()
+
+    # ---------------------------------------------------------- subscribe
+    def acquire_waiter(self, limit):
+        """Reserve one of `limit` blocking waits in this process; False if all are taken"""
+        with self._cond:
+            if limit and self._waiters >= limit:
+                return False
+            self._waiters += 1
+            return True
+
+    def release_waiter(self):
+        with self._cond:
+            self._waiters = max(self._waiters - 1, 0)
+
+    def wait(self, channel, cursor, timeout):
+        """Return events on a channel newer than cursor, blocking up to timeout seconds"""
+        self._ensure_listener()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                events = [
+                    {'id': e['id'], 'type': e['type'], 'data': e['data']}
+                    for _, e in self._channels.get(channel, ())
+                    if e['id'] > cursor
+                ]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self._cond.wait(remaining)
+
+    # ------------------------------------------------- cross-worker fan-out
+    def _ensure_listener(self):
+        if not self.spool_dir or not hasattr(socket, 'AF_UNIX'):
+            return
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            try:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                path = os.path.join(self.spool_dir, f'{self._pid}.sock')
+                if os.path.exists(path):
+                    os.unlink(path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.bind(path)
+            except OSError as e:
+                logger.warning(f"Event fan-out disabled, could not bind socket: {str(e)}")
+                return
+            self._sock = sock
+            self._sock_path = path
+            atexit.register(self._cleanup, path)
+            threading.Thread(target=self._listen, args=(sock,), name='event-listener', daemon=True).start()
+            logger.info(f"Event listener bound at {path}")
+
+    def _listen(self, sock):
+        while True:
+            try:
+                payload = sock.recv(MAX_EVENT_BYTES)
+                event = json.loads(payload)
+            except OSError:
+                return
+            except ValueError:
+                continue
+            if event.get('origin') != os.getpid():
+                self._deliver(event)
+
+    def _fan_out(self, event):
+        if self._sock is None:
+            return
+        payload = json.dumps(event, default=str).encode('utf-8')
+        if len(payload) > MAX_EVENT_BYTES:
+            logger.warning(f"Event {event['type']} too large to forward ({len(payload)} bytes)")
+            return
+        for path in glob.glob(os.path.join(self.spool_dir, '*.sock')):
+            if path == self._sock_path:
+                continue
+            try:
+                self._sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Worker exited without cleaning up its socket
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logger.warning(f"Failed to forward event to {path}: {str(e)}")
+
+    @staticmethod
+    def _cleanup(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
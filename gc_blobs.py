@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Script to delete uploaded files that no story, page or profile uses any more
+
+Deletes blobs (see blobs.py) that have had no reference for
+BLOB_GC_GRACE_HOURS, with their image derivatives. --rebuild-refs first
+registers files already on disk (e.g. uploaded before the blob store) and
+recomputes blob_refs from the owner columns; run it once after creating the
+blobs/blob_refs tables from database/schema.sql. With --dry-run nothing is
+changed, only listed.
+Usage: python gc_blobs.py [--dry-run] [--rebuild-refs] [--grace-hours N]
+"""
+
+import argparse
+
+from app import app, mysql, blob_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete unreferenced uploaded files')
+    parser.add_argument('--dry-run', action='store_true', help='list what would be deleted')
+    parser.add_argument('--rebuild-refs', action='store_true',
+                        help='register files on disk and recompute blob_refs first')
+    parser.add_argument('--grace-hours', type=int, default=app.config['BLOB_GC_GRACE_HOURS'])
+    args = parser.parse_args()
+
+    try:
+        with app.app_context():
+            cursor = mysql.connection.cursor()
+            if args.rebuild_refs:
+                added = blob_store.register_files(cursor)
+                refs = blob_store.rebuild_refs(cursor)
+                print(f"✓ Registered {added} existing file(s); {refs} reference(s) rebuilt")
+
+            removed, untracked = blob_store.collect_garbage(cursor, dry_run=args.dry_run,
+                                                            grace_hours=args.grace_hours)
+            for folder, filename, (owner_type, owner_id) in untracked:
+                print(f"  ✗ {folder}/{filename} is used by {owner_type} {owner_id} but had no reference; kept")
+            for blob in removed:
+                print(f"  {'would delete' if args.dry_run else 'deleted'} "
+                      f"{blob['folder']}/{blob['filename']} ({blob['size_bytes']} bytes)")
+
+            if args.dry_run:
+                mysql.connection.rollback()
+            else:
+                mysql.connection.commit()
+            cursor.close()
+
+            reclaimed = sum(blob['size_bytes'] for blob in removed)
+            verb = 'Would reclaim' if args.dry_run else 'Reclaimed'
+            print(f"✓ {verb} {reclaimed / (1024 * 1024):.1f} MB from {len(removed)} unreferenced file(s)")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
@@ -0,0 +1,57 @@
+# gunicorn.conf.py
+# Production gunicorn settings for Comic Learning App
+# Usage: gunicorn -c gunicorn.conf.py app:app
+import os
+import glob
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+# Threaded workers so open event streams (/api/events) don't block a whole
+# worker; each SSE client or long-poll holds one thread while it waits.
+# EVENTS_MAX_WAITERS caps those per worker so some threads always remain for
+# ordinary requests; clients beyond the cap poll without holding a thread.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 25))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+accesslog = '-'
+errorlog = '-'
+
+# Each worker owns its own MySQL pool. Most threads sit idle on event streams
+# without touching the database, so the idle pool is capped and bursts are
+# served from overflow, unless the pool size has been set explicitly.
+os.environ.setdefault('MYSQL_POOL_SIZE', str(min(threads, 4) + 1))
+os.environ.setdefault('MYSQL_POOL_MAX_OVERFLOW', str(max(threads - 4, 4)))
+os.environ.setdefault('EVENTS_MAX_WAITERS', str(max(threads - 10, threads // 2, 1)))
+
+
+def on_starting(server):
+    """Drop metrics snapshots left by a previous run (see metrics.py)"""
+    from config import Config
+    for path in glob.glob(os.path.join(Config.METRICS_DIR, '*.json')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def post_worker_init(worker):
+    """Open the worker's MySQL connections before it starts accepting requests"""
+    mysql = worker.wsgi.extensions.get('mysql')
+    if mysql is not None:
+        try:
+            mysql.prewarm()
+        except Exception as e:
+            worker.log.warning(f"MySQL pool prewarm failed: {e}")
+
+
+def worker_exit(server, worker):
+    """Write out buffered progress updates and metrics before the worker goes away"""
+    progress_buffer = worker.wsgi.extensions.get('progress_buffer')
+    if progress_buffer is not None:
+        try:
+            progress_buffer.flush()
+        except Exception as e:
+            worker.log.warning(f"Progress flush on exit failed: {e}")
+    metrics = worker.wsgi.extensions.get('metrics')
+    if metrics is not None:
+        metrics.flush()
@@ -0,0 +1,256 @@
+# images.py
+"""Resized derivatives of uploaded images.
+
+For an upload stored at ``<folder>/<name>`` (see storage.py) the derivatives
+are stored under ``<folder>/derived/<name>/``:
+
+    w480.jpg, w480.webp, w960.jpg, ...   fixed-width variants for srcset
+    thumb.jpg, thumb.webp                small card/list thumbnail
+    print.jpg                            print-resolution copy for PDFs
+    meta.json                            original size and the variants built
+
+meta.json is written last, so its presence means the set is complete. Until
+then (or for uploads that predate derivatives) callers fall back to the
+original file. With a remote store the set is built in a temporary
+directory and uploaded file by file, meta.json last. Pillow is imported by
+the first build, so lookups (and the web workers doing only those) never
+load it.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+VARIANT_WIDTHS = (480, 960, 1600)
+THUMB_WIDTH = 240
+PRINT_MAX_SIDE = 1800  # ~6 inches at 300 dpi
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+PRINT_QUALITY = 90
+
+MANIFEST = 'meta.json'
+MISSING_MANIFEST_TTL = 60  # seconds a remote store's missing meta.json is remembered
+
+
+def derived_key(folder, filename):
+    """Storage key prefix of an upload's derivative set"""
+    return f'{folder}/derived/{filename}'
+
+
+def _to_rgb(img):
+    """Flatten transparency onto white; JPEG has no alpha channel"""
+    from PIL import Image
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    return img.convert('RGB')
+
+
+def _resize(img, width):
+    from PIL import Image
+    if width >= img.width:
+        return img
+    height = max(1, round(img.height * width / img.width))
+    return img.resize((width, height), Image.LANCZOS)
+
+
+def build_derivatives(source_path, out_dir):
+    """Write every derivative of source_path into out_dir; returns the manifest"""
+    from PIL import Image, ImageOps, features
+
+    tmp_dir = f'{out_dir}.tmp{os.getpid()}_{threading.get_ident()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        with Image.open(source_path) as src:
+            img = _to_rgb(ImageOps.exif_transpose(src))
+
+        webp = features.check('webp')
+        widths = sorted({min(w, img.width) for w in VARIANT_WIDTHS})
+        for width in widths:
+            variant = _resize(img, width)
+            variant.save(os.path.join(tmp_dir, f'w{width}.jpg'), 'JPEG',
+                         quality=JPEG_QUALITY, optimize=True, progressive=True)
+            if webp:
+                variant.save(os.path.join(tmp_dir, f'w{width}.webp'), 'WEBP',
+                             quality=WEBP_QUALITY, method=4)
+
+        thumb = _resize(img, THUMB_WIDTH)
+        thumb.save(os.path.join(tmp_dir, 'thumb.jpg'), 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        if webp:
+            thumb.save(os.path.join(tmp_dir, 'thumb.webp'), 'WEBP', quality=WEBP_QUALITY)
+
+        printable = img.copy()
+        printable.thumbnail((PRINT_MAX_SIDE, PRINT_MAX_SIDE), Image.LANCZOS)
+        printable.save(os.path.join(tmp_dir, 'print.jpg'), 'JPEG', quality=PRINT_QUALITY)
+
+        manifest = {
+            'width': img.width,
+            'height': img.height,
+            'widths': widths,
+            'webp': webp,
+        }
+        with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        # Swap the finished set into place
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir, ignore_errors=True)
+        os.replace(tmp_dir, out_dir)
+        return manifest
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ImageDerivatives:
+    """Builds derivatives in a background pool and answers lookups for templates/PDFs"""
+
+    def __init__(self, storage, static_folder, max_workers=2, url_builder=None):
+        self.storage = storage
+        self.static_folder = os.path.abspath(static_folder)
+        # callable(storage key) -> URL; defaults to the file's /static/ URL
+        self.url_builder = url_builder
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._manifests = {}
+        # Optional callable(folder, filename) that hands builds to another
+        # process (the job queue); a falsy return builds here after all
+        self.dispatch = None
+
+    # ------------------------------------------------------------- building
+    def schedule(self, folder, filename):
+        """Queue derivative generation for an upload that was just saved"""
+        if not filename:
+            return
+        if self.dispatch is not None and self.dispatch(folder, filename):
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='images')
+        self._executor.submit(self.build, folder, filename)
+
+    def build(self, folder, filename):
+        source = self.storage.local_path(f'{folder}/{filename}')
+        if source is None:
+            return None
+        try:
+            if self.storage.local:
+                manifest = build_derivatives(source, self.storage.path(derived_key(folder, filename)))
+            else:
+                manifest = self._build_remote(source, derived_key(folder, filename))
+            logger.info(f"Built image derivatives for {folder}/{filename}")
+            return manifest
+        except Exception as e:
+            logger.error(f"Error building image derivatives for {folder}/{filename}: {str(e)}")
+            return None
+
+    def _build_remote(self, source, prefix):
+        """Build the set in a temporary directory, then upload it with meta.json last"""
+        tmp_root = tempfile.mkdtemp(prefix='derivatives')
+        try:
+            out_dir = os.path.join(tmp_root, 'set')
+            manifest = build_derivatives(source, out_dir)
+            for name in sorted(os.listdir(out_dir), key=lambda name: name == MANIFEST):
+                self.storage.put_file(f'{prefix}/{name}', os.path.join(out_dir, name))
+            self._manifests.pop(f'{prefix}/{MANIFEST}', None)
+            return manifest
+        finally:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+    # -------------------------------------------------------------- lookups
+    def manifest(self, folder, filename):
+        """Manifest of a completed derivative set, or None"""
+        if not filename:
+            return None
+        key = f'{derived_key(folder, filename)}/{MANIFEST}'
+        if not self.storage.local:
+            return self._remote_manifest(key)
+        path = self.storage.path(key)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._manifests.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._manifests[path] = (mtime, manifest)
+        return manifest
+
+    def _remote_manifest(self, key):
+        # A finished set is never rewritten, so found manifests are kept;
+        # missing ones are looked up again after a short while
+        cached = self._manifests.get(key)
+        if cached and (cached[1] is not None or time.monotonic() - cached[0] < MISSING_MANIFEST_TTL):
+            return cached[1]
+        try:
+            stream = self.storage.open(key)
+            try:
+                manifest = json.load(stream)
+            finally:
+                stream.close()
+        except (OSError, ValueError):
+            manifest = None
+        except Exception as e:
+            # Store unreachable: fall back to the original for now, ask again next time
+            logger.warning(f"Could not read {key}: {str(e)}")
+            return None
+        self._manifests[key] = (time.monotonic(), manifest)
+        return manifest
+
+    def print_path(self, folder, filename):
+        """Local path of the print derivative, or None if not built"""
+        if self.manifest(folder, filename) is None:
+            return None
+        return self.storage.local_path(f'{derived_key(folder, filename)}/print.jpg')
+
+    def _url(self, key):
+        if self.url_builder is not None:
+            return self.url_builder(key)
+        rel = os.path.relpath(self.storage.path(key), self.static_folder).replace(os.sep, '/')
+        return f'/static/{rel}'
+
+    def variants(self, folder, filename, thumb=False):
+        """URLs and dimensions for an <img>/<picture>; falls back to the original.
+
+        Returns a dict with src, srcset, webp_srcset (may be empty), width and
+        height (None when unknown).
+        """
+        original = self._url(f'{folder}/{filename}')
+        manifest = self.manifest(folder, filename)
+        if manifest is None:
+            return {'src': original, 'srcset': '', 'webp_srcset': '', 'width': None, 'height': None}
+
+        base = derived_key(folder, filename)
+        if thumb:
+            width = min(THUMB_WIDTH, manifest['width'])
+            # Thumbnail plus the next size up for high-density screens
+            names = [('thumb', width)] + [(f"w{w}", w) for w in manifest['widths'] if w > width][:1]
+        else:
+            names = [(f"w{w}", w) for w in manifest['widths']]
+
+        def srcset(ext):
+            return ', '.join(f"{self._url(f'{base}/{name}.{ext}')} {w}w" for name, w in names)
+
+        src_name = names[min(1, len(names) - 1)][0]
+        return {
+            'src': self._url(f'{base}/{src_name}.jpg'),
+            'srcset': srcset('jpg'),
+            'webp_srcset': srcset('webp') if manifest.get('webp') else '',
+            'width': manifest['width'],
+            'height': manifest['height'],
+        }
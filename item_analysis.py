@@ -0,0 +1,155 @@
+# item_analysis.py
+"""Classical item analysis for quizzes.
+
+The answers to a quiz are loaded once into a student x question matrix of
+0/1 correctness, and every statistic comes out of whole-array operations on
+it:
+
+    p-value         share of attempts answering the question correctly
+    discrimination  point-biserial correlation between the question and the
+                    rest of the quiz (total score minus that question)
+    distractors     how often each distinct answer was chosen
+    KR-20           reliability of the quiz as a whole
+
+Results depend only on the quiz's questions and attempts, so they are cached
+per (quiz_id, version, attempt count). numpy is imported on the first
+analysis rather than with the app.
+"""
+import math
+import threading
+from collections import OrderedDict
+
+HARD_P_VALUE = 0.3          # fewer than this share correct: too hard
+EASY_P_VALUE = 0.9          # more than this share correct: too easy
+LOW_DISCRIMINATION = 0.2    # point-biserial below this: doesn't separate readers
+MIN_ATTEMPTS_FOR_FLAGS = 5  # too few attempts to call a question anything
+MAX_DISTRACTORS = 5         # most frequent answers reported per question
+
+
+def _float(value):
+    return None if value is None or math.isnan(value) else round(float(value), 3)
+
+
+def _flag(p_value, discrimination, attempts):
+    if attempts < MIN_ATTEMPTS_FOR_FLAGS or p_value is None:
+        return None
+    if p_value < HARD_P_VALUE:
+        return 'too_hard'
+    if p_value > EASY_P_VALUE:
+        return 'too_easy'
+    if discrimination is not None and discrimination < LOW_DISCRIMINATION:
+        return 'low_discrimination'
+    return None
+
+
+def _question_result(question, p_value, discrimination, attempts, distractors):
+    correct_answer = (question['correct_answer'] or '').strip().lower()
+    return {
+        'question_id': question['id'],
+        'question_text': question['question_text'],
+        'question_type': question['question_type'],
+        'p_value': p_value,
+        'discrimination': discrimination,
+        'flag': _flag(p_value, discrimination, attempts),
+        'distractors': [
+            {
+                'answer': answer,
+                'count': count,
+                'share': round(count / attempts, 3),
+                'is_correct': answer.lower() == correct_answer
+            }
+            for count, answer in distractors
+        ]
+    }
+
+
+def analyze_quiz(questions, answers):
+    """Item statistics for one quiz.
+
+    questions: dicts with id, question_text, question_type and correct_answer.
+    answers: (attempt_id, question_id, is_correct, student_answer) rows.
+    A question an attempt has no answer row for counts as incorrect; rows for
+    questions not in `questions` (e.g. since replaced) are ignored.
+    """
+    import numpy as np
+
+    k = len(questions)
+    if not answers or not k:
+        return {
+            'attempts': 0,
+            'kr20': None,
+            'questions': [_question_result(q, None, None, 0, []) for q in questions]
+        }
+
+    attempt_ids, question_ids, correct, answer_text = zip(*answers)
+    column_of = {q['id']: index for index, q in enumerate(questions)}
+    cols = np.array([column_of.get(qid, -1) for qid in question_ids], dtype=np.int64)
+    known = cols >= 0
+    _, rows = np.unique(np.array(attempt_ids, dtype=np.int64), return_inverse=True)
+    n = int(rows.max()) + 1
+
+    matrix = np.zeros((n, k), dtype=np.float64)
+    matrix[rows[known], cols[known]] = np.array(correct, dtype=np.float64)[known]
+
+    totals = matrix.sum(axis=1)
+    p_values = matrix.mean(axis=0)
+
+    # Item-rest point-biserial: correlate each column with the total without it
+    rest = totals[:, None] - matrix
+    item_dev = matrix - p_values
+    rest_dev = rest - rest.mean(axis=0)
+    numerator = (item_dev * rest_dev).sum(axis=0)
+    denominator = np.sqrt((item_dev ** 2).sum(axis=0) * (rest_dev ** 2).sum(axis=0))
+    discrimination = np.divide(numerator, denominator, out=np.full(k, np.nan), where=denominator > 0)
+
+    kr20 = None
+    total_variance = totals.var()
+    if k > 1 and total_variance > 0:
+        kr20 = (k / (k - 1)) * (1 - (p_values * (1 - p_values)).sum() / total_variance)
+
+    # Distractors: answers are coded to integers once, then counted per question in one pass
+    codes = {}
+    answer_codes = np.array([codes.setdefault((a or '').strip(), len(codes)) for a in answer_text],
+                            dtype=np.int64)
+    labels = list(codes)
+    keys, counts = np.unique(cols[known] * len(labels) + answer_codes[known], return_counts=True)
+    distractors = [[] for _ in range(k)]
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        column, code = divmod(key, len(labels))
+        distractors[column].append((count, labels[code]))
+
+    return {
+        'attempts': n,
+        'kr20': _float(kr20),
+        'questions': [
+            _question_result(
+                question, _float(p_values[index]), _float(discrimination[index]), n,
+                sorted(distractors[index], key=lambda item: -item[0])[:MAX_DISTRACTORS]
+            )
+            for index, question in enumerate(questions)
+        ]
+    }
+
+
+class AnalysisCache:
+    """Per-process LRU of analysis results keyed by (quiz_id, version, attempts)"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, quiz_id, version):
+        with self._lock:
+            entry = self._entries.get(quiz_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(quiz_id)
+            return entry[1]
+
+    def put(self, quiz_id, version, result):
+        with self._lock:
+            self._entries[quiz_id] = (version, result)
+            self._entries.move_to_end(quiz_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Script to run queued background jobs (PDF renders, puzzle generation, image derivatives)
+
+Starts JOB_WORKERS worker processes that claim jobs from the jobs table,
+highest priority first, and restarts any that die. The web app only queues
+jobs with JOB_QUEUE_ENABLED=true; run this alongside gunicorn, with access to
+the same upload and PDF cache directories. SIGTERM/Ctrl-C let running jobs
+finish before exiting.
+Usage: python job_worker.py [--processes N] [--kinds story_pdf,story_puzzles,...]
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+
+from app import app, mysql, job_queue
+
+RESTART_CHECK_INTERVAL = 5  # seconds between checks for dead worker processes
+
+
+def worker_process(index, kinds, stop):
+    # The parent turns signals into `stop`, so a job is never cut off mid-run
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    job_queue.run_worker(app, mysql, worker_id, stop, kinds=kinds,
+                         poll_interval=app.config['JOB_POLL_INTERVAL'])
+
+
+def start_worker(index, kinds, stop):
+    process = multiprocessing.Process(target=worker_process, args=(index, kinds, stop),
+                                      name=f'job-worker-{index}')
+    process.start()
+    return process
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run background jobs from the jobs table')
+    parser.add_argument('--processes', type=int, default=app.config['JOB_WORKERS'])
+    parser.add_argument('--kinds', help='comma-separated job kinds to run (default: all)')
+    args = parser.parse_args()
+
+    kinds = [kind.strip() for kind in args.kinds.split(',')] if args.kinds else None
+    unknown = [kind for kind in kinds or () if kind not in job_queue.handlers]
+    if unknown:
+        print(f"✗ Unknown job kind(s): {', '.join(unknown)} "
+              f"(known: {', '.join(sorted(job_queue.handlers))})")
+        raise SystemExit(1)
+
+    stop = multiprocessing.Event()
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    workers = {index: start_worker(index, kinds, stop) for index in range(args.processes)}
+    print(f"✓ Started {args.processes} job worker(s) for "
+          f"{', '.join(kinds or sorted(job_queue.handlers))}")
+
+    while not stop.is_set():
+        stop.wait(RESTART_CHECK_INTERVAL)
+        for index, process in list(workers.items()):
+            if not stop.is_set() and not process.is_alive():
+                print(f"✗ Job worker {index} exited with code {process.exitcode}; restarting")
+                workers[index] = start_worker(index, kinds, stop)
+
+    print("Waiting for running jobs to finish...")
+    for process in workers.values():
+        process.join()
+    print("✓ Job workers stopped")
@@ -0,0 +1,244 @@
+# jobs.py
+"""Durable background jobs, stored in the MySQL `jobs` table.
+
+Web requests enqueue a row and return straight away; job_worker.py runs a
+pool of worker processes that claim queued rows (highest priority first,
+then oldest), call the handler registered for the row's kind and record the
+result. A handler that raises is retried after a delay that doubles with
+every attempt, until max_attempts is reached and the job is marked failed.
+
+Claiming is a conditional UPDATE (status 'queued' -> 'running'), so it works
+without SELECT ... SKIP LOCKED on older MySQL/MariaDB. A worker that dies
+mid-job leaves its row 'running'; once the lease expires another worker puts
+it back in the queue. Handlers can therefore run more than once for the same
+job and must be idempotent.
+
+While a job is queued its dedupe_key is unique, so repeat requests for the
+same work (the same PDF, the same story's puzzles) share one job. The key is
+cleared when the job is claimed: work requested while it runs gets a fresh
+job and sees the newer data.
+"""
+import json
+import time
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+PRIORITY_INTERACTIVE = 20  # someone is waiting on the result
+PRIORITY_DEFAULT = 10
+PRIORITY_BULK = 0          # nothing breaks while it waits
+
+CLAIM_CANDIDATES = 5       # rows looked at per claim, in case other workers win the first
+MAINTENANCE_INTERVAL = 60  # seconds between expired-lease and retention sweeps per worker
+MAX_ERROR_LENGTH = 4000
+
+
+class UnknownJobKind(Exception):
+    """Raised when a job's kind has no registered handler"""
+
+
+class JobQueue:
+    """Enqueue/claim/complete operations on the jobs table, plus the handler registry"""
+
+    def __init__(self, max_attempts=3, retry_delay=30, lease_seconds=900, retention_days=7):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.retention_days = retention_days
+        self.handlers = {}
+
+    def handler(self, kind):
+        """Decorator registering fn(**payload) as the handler for a job kind"""
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    # ------------------------------------------------------------ producers
+    def enqueue(self, cur, kind, payload=None, priority=PRIORITY_DEFAULT, dedupe_key=None,
+                max_attempts=None, created_by=None):
+        """Insert a job (part of the caller's transaction) and return its id.
+
+        With a dedupe_key matching a job that is still queued, that job's id
+        is returned instead (its priority raised if this request's is higher).
+        """
+        if kind not in self.handlers:
+            raise UnknownJobKind(kind)
+        cur.execute("""
+            INSERT INTO jobs (kind, payload, priority, max_attempts, dedupe_key, created_by)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id),
+                                    priority = GREATEST(priority, VALUES(priority))
+        """, (kind, json.dumps(payload or {}), priority,
+              max_attempts or self.max_attempts, dedupe_key, created_by))
+        return cur.lastrowid
+
+    def get(self, cur, job_id):
+        """A job row with payload/result decoded, or None"""
+        cur.execute("SELECT * FROM jobs WHERE id = %s", (job_id,))
+        return self._decode(cur.fetchone())
+
+    def recent(self, cur, created_by, status=None, limit=20):
+        """Newest jobs queued by a user, optionally only those with a given status"""
+        status_filter = 'AND status = %s' if status else ''
+        args = [created_by] + ([status] if status else []) + [limit]
+        cur.execute(f"""
+            SELECT * FROM jobs
+            WHERE created_by = %s {status_filter}
+            ORDER BY id DESC
+            LIMIT %s
+        """, args)
+        return [self._decode(row) for row in cur.fetchall()]
+
+    # ------------------------------------------------------------ consumers
+    def claim(self, cur, worker_id, kinds=None):
+        """Mark the next runnable job as running for this worker and return it, or None"""
+        kind_filter = ''
+        args = []
+        if kinds:
+            kind_filter = f"AND kind IN ({', '.join(['%s'] * len(kinds))})"
+            args.extend(kinds)
+        cur.execute(f"""
+            SELECT id FROM jobs
+            WHERE status = %s AND run_after <= NOW() {kind_filter}
+            ORDER BY priority DESC, id
+            LIMIT %s
+        """, [QUEUED] + args + [CLAIM_CANDIDATES])
+        for row in cur.fetchall():
+            cur.execute("""
+                UPDATE jobs
+                SET status = %s, attempts = attempts + 1, locked_by = %s, locked_at = NOW(),
+                    dedupe_key = NULL
+                WHERE id = %s AND status = %s
+            """, (RUNNING, worker_id, row['id'], QUEUED))
+            if cur.rowcount == 1:
+                return self.get(cur, row['id'])
+        return None
+
+    def complete(self, cur, job_id, result=None):
+        cur.execute("""
+            UPDATE jobs
+            SET status = %s, result = %s, error = NULL, finished_at = NOW(),
+                locked_by = NULL, locked_at = NULL
+            WHERE id = %s
+        """, (SUCCEEDED, json.dumps(result), job_id))
+
+    def fail(self, cur, job, error, retry=True):
+        """Record a failed attempt: back in the queue after a delay, or failed for good"""
+        error = error[-MAX_ERROR_LENGTH:]
+        if retry and job['attempts'] < job['max_attempts']:
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            cur.execute("""
+                UPDATE jobs
+                SET status = %s, error = %s, run_after = NOW() + INTERVAL %s SECOND,
+                    locked_by = NULL, locked_at = NULL
+                WHERE id = %s
+            """, (QUEUED, error, delay, job['id']))
+            return False
+        cur.execute("""
+            UPDATE jobs
+            SET status = %s, error = %s, finished_at = NOW(), locked_by = NULL, locked_at = NULL
+            WHERE id = %s
+        """, (FAILED, error, job['id']))
+        return True
+
+    def requeue_expired(self, cur):
+        """Put jobs whose worker lease ran out back in the queue (or fail them); returns the count"""
+        cur.execute("""
+            UPDATE jobs
+            SET finished_at = IF(attempts < max_attempts, NULL, NOW()),
+                status = IF(attempts < max_attempts, %s, %s),
+                error = 'Worker lease expired',
+                locked_by = NULL, locked_at = NULL
+            WHERE status = %s AND locked_at < NOW() - INTERVAL %s SECOND
+        """, (QUEUED, FAILED, RUNNING, self.lease_seconds))
+        return cur.rowcount
+
+    def purge(self, cur):
+        """Delete finished jobs older than the retention period; returns the count"""
+        cur.execute("""
+            DELETE FROM jobs
+            WHERE status IN (%s, %s) AND finished_at < NOW() - INTERVAL %s DAY
+        """, (SUCCEEDED, FAILED, self.retention_days))
+        return cur.rowcount
+
+    # --------------------------------------------------------------- worker
+    def run_worker(self, app, mysql, worker_id, stop, kinds=None, poll_interval=1.0):
+        """Claim and run jobs until `stop` (a threading/multiprocessing Event) is set"""
+        last_maintenance = None
+        while not stop.is_set():
+            job = None
+            with app.app_context():
+                cur = mysql.connection.cursor()
+                try:
+                    if last_maintenance is None or time.monotonic() - last_maintenance > MAINTENANCE_INTERVAL:
+                        requeued = self.requeue_expired(cur)
+                        if requeued:
+                            logger.warning(f"Requeued {requeued} job(s) with an expired lease")
+                        self.purge(cur)
+                        mysql.connection.commit()
+                        last_maintenance = time.monotonic()
+                    job = self.claim(cur, worker_id, kinds)
+                    mysql.connection.commit()
+                except Exception as e:
+                    logger.error(f"Job worker {worker_id} could not claim a job: {str(e)}")
+                    try:
+                        mysql.connection.rollback()
+                    except Exception:
+                        pass
+                finally:
+                    cur.close()
+
+            if job is None:
+                stop.wait(poll_interval)
+                continue
+            self._execute(app, mysql, job)
+
+    def _execute(self, app, mysql, job):
+        started = time.monotonic()
+        with app.app_context():
+            handler = self.handlers.get(job['kind'])
+            error = None
+            try:
+                if handler is None:
+                    raise UnknownJobKind(job['kind'])
+                result = handler(**job['payload'])
+            except Exception:
+                error = traceback.format_exc()
+
+            cur = mysql.connection.cursor()
+            try:
+                # Drop anything the handler left uncommitted
+                mysql.connection.rollback()
+                elapsed = time.monotonic() - started
+                if error is None:
+                    self.complete(cur, job['id'], result)
+                    logger.info(f"Job {job['id']} ({job['kind']}) done in {elapsed:.1f}s")
+                else:
+                    final = self.fail(cur, job, error, retry=handler is not None)
+                    logger.error(f"Job {job['id']} ({job['kind']}) attempt {job['attempts']} "
+                                 f"failed{' for good' if final else ''}: {error.strip().splitlines()[-1]}")
+                mysql.connection.commit()
+            except Exception as e:
+                # The lease will expire and the job will be retried
+                logger.error(f"Could not record the outcome of job {job['id']}: {str(e)}")
+                try:
+                    mysql.connection.rollback()
+                except Exception:
+                    pass
+            finally:
+                cur.close()
+
+    @staticmethod
+    def _decode(row):
+        if row is None:
+            return None
+        row['payload'] = json.loads(row['payload']) if row['payload'] else {}
+        row['result'] = json.loads(row['result']) if row['result'] else None
+        return row
@@ -0,0 +1,142 @@
+# media.py
+"""Serving uploaded media with strong validators and long-lived caching.
+
+Files under UPLOAD_FOLDER are served by the /media route instead of the
+plain static handler:
+
+    /media/v/<fingerprint>/<folder>/<name>   first 16 hex digits of the file's
+                                             SHA-256; cached as immutable for
+                                             a year, so repeat views never
+                                             reach the server
+    /media/<folder>/<name>                   for URLs built client-side (e.g.
+                                             narration audio); revalidated
+                                             with the ETag on every use
+
+The ETag is the full SHA-256 of the content, so it stays valid across
+workers and restarts. Range requests (seeking in audio/video) and If-Range
+are answered with 206 by Werkzeug. With an offload mode the front server
+sends the bytes: 'x-accel' returns an nginx X-Accel-Redirect to an internal
+location aliasing UPLOAD_FOLDER, and 'x-sendfile' sets Flask's
+USE_X_SENDFILE. The route still answers 304s itself in both modes.
+
+Content hashes are remembered per process, keyed by the file's size, mtime
+and inode, so each file is read once per worker until it changes.
+
+With a remote store (STORAGE_BACKEND=s3, see storage.py) pages link to the
+bucket's download URLs directly, and /media answers with a redirect to one.
+"""
+import os
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from flask import request, send_file, make_response, abort, redirect
+from werkzeug.security import safe_join
+
+FINGERPRINT_LENGTH = 16
+HASH_BLOCK = 1024 * 1024
+MAX_REMEMBERED_HASHES = 20000
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+HIDDEN_SUFFIXES = ('.part', '.tmp')  # uploads and derivative builds still being written
+
+
+class MediaStore:
+    """Fingerprinted URLs for stored files, and responses that serve them"""
+
+    def __init__(self, storage, url_prefix='/media', offload='', accel_prefix='/protected-media'):
+        self.storage = storage
+        self.root = storage.root if storage.local else None
+        self.url_prefix = url_prefix.rstrip('/')
+        self.offload = offload
+        self.accel_prefix = accel_prefix.rstrip('/')
+        self._hashes = OrderedDict()  # path -> (size, mtime_ns, inode, sha256 hex)
+        self._lock = threading.Lock()
+
+    # ---------------------------------------------------------------- files
+    def resolve(self, rel_path):
+        """Absolute path of a servable file under the root, or None"""
+        if not rel_path or rel_path.endswith(HIDDEN_SUFFIXES):
+            return None
+        path = safe_join(self.root, rel_path)
+        if path is None or not os.path.isfile(path):
+            return None
+        return path
+
+    def content_hash(self, path, st=None):
+        """SHA-256 of a file, read only when it is new or has changed"""
+        st = st or os.stat(path)
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            cached = self._hashes.get(path)
+            if cached and cached[:3] == signature:
+                self._hashes.move_to_end(path)
+                return cached[3]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                digest.update(block)
+        content_hash = digest.hexdigest()
+
+        with self._lock:
+            self._hashes[path] = signature + (content_hash,)
+            self._hashes.move_to_end(path)
+            while len(self._hashes) > MAX_REMEMBERED_HASHES:
+                self._hashes.popitem(last=False)
+        return content_hash
+
+    # ----------------------------------------------------------------- URLs
+    def url(self, rel_path):
+        """Fingerprinted URL for a stored file (unversioned if it is missing)"""
+        rel_path = rel_path.replace(os.sep, '/')
+        if not self.storage.local:
+            return self.storage.url(rel_path)
+        path = self.resolve(rel_path)
+        if path is None:
+            return f'{self.url_prefix}/{quote(rel_path)}'
+        fingerprint = self.content_hash(path)[:FINGERPRINT_LENGTH]
+        return f'{self.url_prefix}/v/{fingerprint}/{quote(rel_path)}'
+
+    # ------------------------------------------------------------- serving
+    def send(self, rel_path, fingerprint=None):
+        """Response for a media request: 200/206/304, or a front-server offload"""
+        if not self.storage.local:
+            return self._redirect(rel_path)
+        path = self.resolve(rel_path)
+        if path is None:
+            abort(404)
+        st = os.stat(path)
+        etag = self.content_hash(path, st)
+        # A stale fingerprint still gets the current bytes, just not cached for a year
+        immutable = fingerprint is not None and etag.startswith(fingerprint) and len(fingerprint) == FINGERPRINT_LENGTH
+        cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        elif self.offload == 'x-accel':
+            response = make_response('')
+            response.headers['Content-Type'] = mimetype
+            response.headers['X-Accel-Redirect'] = f'{self.accel_prefix}/{quote(rel_path)}'
+        else:
+            # Werkzeug answers Range/If-Range with 206 (and X-Sendfile if enabled)
+            response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=None)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    def _redirect(self, rel_path):
+        if not rel_path or rel_path.endswith(HIDDEN_SUFFIXES):
+            abort(404)
+        try:
+            url = self.storage.url(rel_path)
+        except ValueError:
+            abort(404)
+        response = redirect(url, 302)
+        # Presigned URLs expire, so the redirect itself is not cached
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
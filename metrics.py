@@ -0,0 +1,259 @@
+# metrics.py
+"""Per-request latency and SQL metrics, exposed in Prometheus text format.
+
+When enabled, connections are opened with an instrumented cursor class that
+times every execute()/executemany() and adds it to the current request's
+RequestStats (query count, DB time, rows returned, slowest statement). At
+the end of the request the stats and the request latency go into a
+per-process MetricsRegistry of counters and histograms, labelled by Flask
+endpoint so the label set stays bounded.
+
+Each gunicorn worker has its own registry and writes a JSON snapshot of it
+to a shared directory every `flush_interval` seconds; the /metrics route
+merges the snapshots of all workers, so any worker can answer a scrape.
+Snapshots of exited workers are kept so counters never go backwards.
+
+Nothing here is installed unless METRICS_ENABLED is set, so the disabled
+cost is zero; enabled, it is a ContextVar lookup and two perf_counter()
+calls per statement.
+"""
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+QUERY_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status', None),
+    'http_request_duration_seconds': ('histogram', 'Time to produce a response, by endpoint', LATENCY_BUCKETS),
+    'db_queries_per_request': ('histogram', 'SQL statements executed per request, by endpoint', QUERY_COUNT_BUCKETS),
+    'db_time_per_request_seconds': ('histogram', 'Total SQL time per request, by endpoint', LATENCY_BUCKETS),
+    'db_slowest_query_seconds': ('histogram', 'Slowest SQL statement of each request, by endpoint', QUERY_TIME_BUCKETS),
+    'db_queries_total': ('counter', 'SQL statements executed, by endpoint', None),
+    'db_rows_total': ('counter', 'Rows returned by SELECTs, by endpoint', None),
+}
+
+_current = contextvars.ContextVar('metrics_request_stats', default=None)
+_whitespace = re.compile(r'\s+')
+
+
+class RequestStats:
+    """SQL activity of one request"""
+
+    __slots__ = ('queries', 'db_time', 'rows', 'slowest_sql', 'slowest_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.slowest_sql = None
+        self.slowest_time = 0.0
+
+    def record(self, sql, elapsed, rows):
+        self.queries += 1
+        self.db_time += elapsed
+        self.rows += rows
+        if elapsed >= self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_sql = sql
+
+    def slowest_statement(self, max_length=200):
+        """The slowest statement on one line, shortened for logs"""
+        if self.slowest_sql is None:
+            return None
+        sql = self.slowest_sql
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        sql = _whitespace.sub(' ', sql).strip()
+        return sql if len(sql) <= max_length else sql[:max_length] + '...'
+
+
+def start_request():
+    """Begin collecting SQL stats for the current request"""
+    stats = RequestStats()
+    _current.set(stats)
+    return stats
+
+
+def end_request():
+    _current.set(None)
+
+
+def instrumented_cursor(base):
+    """Subclass of a MySQLdb cursor class that reports statements to the current request"""
+
+    class InstrumentedCursor(base):
+        def execute(self, query, args=None):
+            stats = _current.get()
+            if stats is None:
+                return super().execute(query, args)
+            started = time.perf_counter()
+            try:
+                return super().execute(query, args)
+            finally:
+                rows = self.rowcount if self.description is not None and self.rowcount > 0 else 0
+                stats.record(query, time.perf_counter() - started, rows)
+
+        def executemany(self, query, args):
+            stats = _current.get()
+            if stats is None:
+                return super().executemany(query, args)
+            # MySQLdb falls back to one execute() per row for statements it
+            # cannot batch; count the call once either way
+            token = _current.set(None)
+            started = time.perf_counter()
+            try:
+                return super().executemany(query, args)
+            finally:
+                _current.reset(token)
+                stats.record(query, time.perf_counter() - started, 0)
+
+    InstrumentedCursor.__name__ = f'Instrumented{base.__name__}'
+    return InstrumentedCursor
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class MetricsRegistry:
+    """Counters and histograms for one process, merged with other workers' snapshots"""
+
+    def __init__(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._last_flush = time.monotonic()
+
+    def _check_fork(self):
+        # Counters inherited from a preloading master belong to the master
+        if self._pid != os.getpid():
+            self._reset()
+
+    # ------------------------------------------------------------ recording
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            self._check_fork()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def record_request(self, endpoint, method, status, duration, stats):
+        """Fold one finished request (and its RequestStats, if any) into the registry"""
+        self.inc('http_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status))))
+        labels = (('endpoint', endpoint),)
+        self.observe('http_request_duration_seconds', labels, duration)
+        if stats is not None:
+            self.observe('db_queries_per_request', labels, stats.queries)
+            self.observe('db_time_per_request_seconds', labels, stats.db_time)
+            if stats.queries:
+                self.observe('db_slowest_query_seconds', labels, stats.slowest_time)
+                self.inc('db_queries_total', labels, stats.queries)
+                self.inc('db_rows_total', labels, stats.rows)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    # ------------------------------------------------------------ snapshots
+    def _snapshot(self):
+        with self._lock:
+            self._check_fork()
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), values] for (name, labels), values in self._histograms.items()],
+            }
+
+    def flush(self):
+        """Write this process's snapshot for other workers' /metrics to merge"""
+        self._last_flush = time.monotonic()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{os.getpid()}.json')
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot: {str(e)}")
+
+    def render(self):
+        """All workers' metrics in Prometheus text exposition format"""
+        self.flush()
+        counters = {}
+        histograms = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot.get('histograms', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.get(key)
+                histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(buckets, values):
+                    bucket_labels = labels + (('le', _format_value(float(bound))),)
+                    lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(float(values[-2]))}')
+                lines.append(f'{name}_count{_format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
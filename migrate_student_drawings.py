@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Script to move student drawings from base64 data URLs into PNG snapshot files
+
+Run once after adding the generation/has_snapshot/log_bytes/stroke_count
+columns from database/schema.sql and before dropping drawing_data.
+Usage: python migrate_student_drawings.py
+"""
+
+import base64
+import binascii
+
+from app import app, mysql, drawing_store
+
+# What the old clear endpoint stored instead of deleting the drawing
+BLANK_DRAWING = 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+
+
+def decode_data_url(data_url):
+    """PNG bytes from a data:image/png;base64 URL, or None"""
+    header, _, payload = (data_url or '').partition(',')
+    if not header.startswith('data:image/png;base64'):
+        return None
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def migrate_student_drawings(cur):
+    """Write a snapshot file per legacy drawing; returns (migrated, blank, failed)"""
+    migrated = blank = failed = 0
+    cur.execute("""
+        SELECT id, story_id, student_id, generation, drawing_data
+        FROM student_drawings
+        WHERE has_snapshot = FALSE
+    """)
+    for drawing in cur.fetchall():
+        if drawing['drawing_data'] == BLANK_DRAWING:
+            blank += 1
+        else:
+            image_data = decode_data_url(drawing['drawing_data'])
+            if image_data is None:
+                failed += 1
+                print(f"  ✗ drawing {drawing['id']}: not a PNG data URL")
+                continue
+            generation = drawing['generation'] + 1
+            drawing_store.write_snapshot(drawing['student_id'], drawing['story_id'], generation, image_data)
+            cur.execute("""
+                UPDATE student_drawings
+                SET generation = %s, has_snapshot = TRUE, log_bytes = 0, stroke_count = 0
+                WHERE id = %s
+            """, (generation, drawing['id']))
+            migrated += 1
+    return migrated, blank, failed
+
+
+if __name__ == '__main__':
+    try:
+        with app.app_context():
+            cursor = mysql.connection.cursor()
+            migrated, blank, failed = migrate_student_drawings(cursor)
+            mysql.connection.commit()
+            cursor.close()
+
+            print("✓ Student drawings migrated to files")
+            print(f"  Snapshots written: {migrated}")
+            print(f"  Cleared drawings: {blank}")
+            if failed:
+                print(f"  Unreadable drawings left in place: {failed}")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
@@ -0,0 +1,108 @@
+# pdf_cache.py
+"""On-disk cache for generated story PDFs.
+
+Entries are keyed by a content hash of everything that goes into the PDF, so
+a changed story simply produces a new key and stale files age out through
+least-recently-used eviction once the cache grows past its size budget.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """Content-addressed files in one directory, bounded by total size (LRU by mtime)"""
+
+    def __init__(self, directory, max_bytes=500 * 1024 * 1024, suffix='.pdf'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def get(self, key):
+        """Path of a cached entry, or None; a hit refreshes its position for eviction"""
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        """Store bytes under key atomically (safe across worker processes)"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            entries = []
+            total = 0
+            try:
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                return 0
+            for name in names:
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    # Left behind by a crashed writer
+                    if time.time() - st.st_mtime > 3600:
+                        self._remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if self._remove(path):
+                    total -= size
+                    removed += 1
+            if removed:
+                logger.info(f"Evicted {removed} cached file(s) from {self.directory}")
+            return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+def content_key(*parts, files=()):
+    """Hash JSON-able parts plus the identity (path, size, mtime) of each file"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(b'\0')
+    for path in files:
+        try:
+            st = os.stat(path)
+            signature = f'{path}:{st.st_size}:{st.st_mtime_ns}'
+        except OSError:
+            signature = f'{path}:missing'
+        digest.update(signature.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
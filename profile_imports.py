@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Script to report how long importing the app takes, module by module
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter and
+summarises its output: the total, the slowest modules by cumulative time
+(the module and everything it imported) and by self time, and whether any
+of the heavy optional dependencies that are meant to load on first use
+(reportlab, Pillow, numpy, boto3) were imported at startup. Run it before
+and after adding imports to app.py or the modules it imports; every
+gunicorn worker, job worker and script pays this cost when it starts.
+Usage: python profile_imports.py [--module app] [--top 20] [--fail-over MS]
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+# Loaded on first use only: by story_pdf.py, images.py, item_analysis.py, storage.py
+LAZY_MODULES = ('reportlab', 'PIL', 'numpy', 'boto3', 'botocore')
+
+
+def parse_importtime(stderr):
+    """(name, self_us, cumulative_us, depth) for each line of -X importtime output"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # the header line
+        name = fields[2].rstrip()
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        entries.append((stripped, self_us, cumulative_us, depth))
+    return entries
+
+
+def print_table(title, entries, column, top):
+    print(f"\n{title}")
+    print(f"  {'cumulative':>11}  {'self':>11}  module")
+    for name, self_us, cumulative_us, _ in sorted(entries, key=lambda e: e[column], reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {self_us / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app', help='module to import (default: app)')
+    parser.add_argument('--top', type=int, default=20, help='modules to list per table')
+    parser.add_argument('--fail-over', type=float, metavar='MS',
+                        help='exit with status 1 if the import takes longer than this')
+    args = parser.parse_args()
+
+    try:
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {args.module}'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=300,
+        )
+        entries = parse_importtime(result.stderr)
+        if result.returncode != 0:
+            errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+            print(f"✗ import {args.module} failed:")
+            print('\n'.join(errors[-15:]))
+            raise SystemExit(1)
+
+        # Top-level entries are the module itself and the interpreter's own startup imports
+        total_us = next((cumulative_us for name, _, cumulative_us, depth in reversed(entries)
+                         if depth == 0 and name == args.module), 0)
+        startup_us = sum(cumulative_us for _, _, cumulative_us, depth in entries if depth == 0) - total_us
+        print(f"import {args.module}: {total_us / 1000:.1f} ms "
+              f"(plus {startup_us / 1000:.1f} ms interpreter startup), {len(entries)} modules")
+        print_table(f"Slowest by cumulative time (top {args.top})", entries, 2, args.top)
+        print_table(f"Slowest by self time (top {args.top})", entries, 1, args.top)
+
+        loaded = sorted({name.split('.')[0] for name, _, _, _ in entries
+                         if name.split('.')[0] in LAZY_MODULES})
+        print()
+        if loaded:
+            print(f"✗ Imported at startup but meant to load on first use: {', '.join(loaded)}")
+        else:
+            print(f"✓ None of {', '.join(LAZY_MODULES)} imported at startup")
+
+        failed = bool(loaded)
+        if args.fail_over is not None and total_us / 1000 > args.fail_over:
+            print(f"✗ Import took longer than {args.fail_over:g} ms")
+            failed = True
+        if failed:
+            raise SystemExit(1)
+    except SystemExit:
+        raise
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
@@ -0,0 +1,120 @@
+# progress_buffer.py
+"""Write-behind buffer for reading progress.
+
+A class reading together turns pages in bursts, and every turn used to be
+its own transaction. The buffer keeps the latest position per (student,
+story) in memory, merging rapid turns, and a background thread hands the
+merged entries to a flush callback in one batch every `interval` seconds
+(or sooner once `max_pending` keys are waiting).
+
+Durability trade-off: positions not yet flushed are lost if the process is
+killed without a clean shutdown (flush() runs at exit and from gunicorn's
+worker_exit hook). Each worker has its own buffer, so another worker may
+briefly see an older page.
+"""
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAX_FLUSH_ATTEMPTS = 5  # entries that keep failing are dropped (and logged)
+
+
+class ProgressEntry:
+    __slots__ = ('student_id', 'story_id', 'class_level', 'current_page', 'is_completed',
+                 'first_seen', 'completed_at', 'attempts')
+
+    def __init__(self, student_id, story_id, class_level, current_page, is_completed, at):
+        self.student_id = student_id
+        self.story_id = story_id
+        self.class_level = class_level
+        self.current_page = current_page
+        self.is_completed = is_completed
+        self.first_seen = at
+        self.completed_at = at if is_completed else None
+        self.attempts = 0
+
+    def merge(self, other):
+        """Fold a newer entry for the same key into this one"""
+        self.current_page = other.current_page
+        self.class_level = other.class_level
+        if other.is_completed and not self.is_completed:
+            self.is_completed = True
+            self.completed_at = other.completed_at
+
+
+class ProgressBuffer:
+    """Coalesces progress writes per (student, story) and flushes them in batches"""
+
+    def __init__(self, flush_callback, interval=2.0, max_pending=500):
+        self.flush_callback = flush_callback
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def record(self, entry):
+        key = (entry.student_id, entry.story_id)
+        with self._lock:
+            existing = self._pending.get(key)
+            if existing:
+                existing.merge(entry)
+            else:
+                self._pending[key] = entry
+            pending = len(self._pending)
+            # Started lazily so it lives in the gunicorn worker, not the master
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='progress-flush', daemon=True)
+                self._thread.start()
+        if pending >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self, student_id, story_id):
+        """Unflushed entry for a student's story, if any (for read-your-writes)"""
+        with self._lock:
+            return self._pending.get((student_id, story_id))
+
+    def take(self, student_id, story_id):
+        """Remove and return the unflushed entry, for a caller about to write it directly"""
+        with self._lock:
+            return self._pending.pop((student_id, story_id), None)
+
+    def flush(self):
+        """Write out everything pending; failed batches are merged back for the next try"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                self.flush_callback(list(batch.values()))
+            except Exception as e:
+                logger.error(f"Progress flush of {len(batch)} entries failed: {str(e)}")
+                with self._lock:
+                    # Anything recorded meanwhile is newer than the failed batch
+                    for key, entry in batch.items():
+                        entry.attempts += 1
+                        if entry.attempts >= MAX_FLUSH_ATTEMPTS:
+                            logger.error(f"Dropping progress for student {key[0]}, story {key[1]} "
+                                         f"after {entry.attempts} failed flushes")
+                            continue
+                        newer = self._pending.get(key)
+                        if newer:
+                            entry.merge(newer)
+                        self._pending[key] = entry
+                return 0
+            return len(batch)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Progress flush thread error: {str(e)}")
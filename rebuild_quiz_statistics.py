@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Script to backfill the quiz item statistics from existing answers and attempts
+
+Run after creating quiz_question_stats, quiz_answer_counts and
+quiz_score_buckets from database/schema.sql; new submissions keep them up to
+date. Pass a quiz id to rebuild just that quiz.
+Usage: python rebuild_quiz_statistics.py [quiz_id]
+"""
+
+import sys
+
+from app import app, mysql, rebuild_quiz_item_stats
+
+
+if __name__ == '__main__':
+    quiz_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    try:
+        with app.app_context():
+            cursor = mysql.connection.cursor()
+            rebuild_quiz_item_stats(cursor, quiz_id)
+            mysql.connection.commit()
+
+            counts = {}
+            for table in ('quiz_question_stats', 'quiz_answer_counts', 'quiz_score_buckets'):
+                cursor.execute(f"SELECT COUNT(*) AS count FROM {table}")
+                counts[table] = cursor.fetchone()['count']
+            cursor.close()
+
+            print(f"✓ Quiz statistics rebuilt for {f'quiz {quiz_id}' if quiz_id else 'all quizzes'}")
+            print(f"  Questions: {counts['quiz_question_stats']}")
+            print(f"  Distinct answers: {counts['quiz_answer_counts']}")
+            print(f"  Score buckets: {counts['quiz_score_buckets']}")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Script to recompute the dashboard/analytics rollup tables from the base tables
+
+Run after creating story_stats, class_story_stats, teacher_stats and quiz_stats from
+database/schema.sql, or whenever the teacher dashboard numbers look wrong
+(e.g. after editing progress or quiz attempts by hand).
+Usage: python rebuild_rollups.py
+"""
+
+from app import app, mysql, rebuild_story_rollups, rebuild_teacher_rollups
+
+
+if __name__ == '__main__':
+    try:
+        with app.app_context():
+            cursor = mysql.connection.cursor()
+            # teacher_stats is summed from story_stats, so stories go first
+            rebuild_story_rollups(cursor)
+            rebuild_teacher_rollups(cursor)
+            mysql.connection.commit()
+
+            counts = {}
+            for table in ('story_stats', 'class_story_stats', 'teacher_stats', 'quiz_stats'):
+                cursor.execute(f"SELECT COUNT(*) AS count FROM {table}")
+                counts[table] = cursor.fetchone()['count']
+            cursor.close()
+
+            print("✓ Rollup tables rebuilt")
+            print(f"  Stories: {counts['story_stats']}")
+            print(f"  Story/class rows: {counts['class_story_stats']}")
+            print(f"  Teachers: {counts['teacher_stats']}")
+            print(f"  Quizzes: {counts['quiz_stats']}")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
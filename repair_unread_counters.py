@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Script to recompute the materialized chat unread counters from the message tables
+
+Run after applying the unread-counter migration in database/schema.sql, or
+whenever badges look wrong (e.g. after deleting messages by hand).
+Usage: python repair_unread_counters.py
+"""
+
+from app import app, mysql
+
+
+def repair_unread_counters(cur):
+    """Rebuild per-conversation counters and per-participant totals; returns rows changed"""
+    changed = {}
+
+    cur.execute("""
+        UPDATE chat_conversations cc
+        SET teacher_unread = (
+                SELECT COUNT(*) FROM chat_messages cm
+                WHERE cm.conversation_id = cc.id
+                  AND cm.sender_type = 'student'
+                  AND cm.is_read = FALSE
+            ),
+            student_unread = (
+                SELECT COUNT(*) FROM chat_messages cm
+                WHERE cm.conversation_id = cc.id
+                  AND cm.sender_type = 'teacher'
+                  AND cm.is_read = FALSE
+            ),
+            last_message_at = (
+                SELECT MAX(cm.created_at) FROM chat_messages cm
+                WHERE cm.conversation_id = cc.id
+            )
+    """)
+    changed['chat_conversations'] = cur.rowcount
+
+    cur.execute("""
+        UPDATE student_conversations sc
+        SET student1_unread = (
+                SELECT COUNT(*) FROM student_messages sm
+                WHERE sm.conversation_id = sc.id
+                  AND sm.sender_id != sc.student1_id
+                  AND sm.is_read = FALSE
+            ),
+            student2_unread = (
+                SELECT COUNT(*) FROM student_messages sm
+                WHERE sm.conversation_id = sc.id
+                  AND sm.sender_id != sc.student2_id
+                  AND sm.is_read = FALSE
+            )
+    """)
+    changed['student_conversations'] = cur.rowcount
+
+    # Totals are derived from the per-conversation counters just rebuilt
+    cur.execute("DELETE FROM chat_unread_counters")
+    cur.execute("""
+        INSERT INTO chat_unread_counters (participant_type, participant_id, chat_unread)
+        SELECT 'teacher', teacher_id, SUM(teacher_unread)
+        FROM chat_conversations
+        GROUP BY teacher_id
+    """)
+    cur.execute("""
+        INSERT INTO chat_unread_counters (participant_type, participant_id, chat_unread)
+        SELECT 'student', student_id, SUM(student_unread)
+        FROM chat_conversations
+        GROUP BY student_id
+    """)
+    cur.execute("""
+        INSERT INTO chat_unread_counters (participant_type, participant_id, student_chat_unread)
+        SELECT 'student', student_id, SUM(unread)
+        FROM (
+            SELECT student1_id AS student_id, student1_unread AS unread FROM student_conversations
+            UNION ALL
+            SELECT student2_id AS student_id, student2_unread AS unread FROM student_conversations
+        ) AS per_student
+        GROUP BY student_id
+        ON DUPLICATE KEY UPDATE student_chat_unread = VALUES(student_chat_unread)
+    """)
+    cur.execute("SELECT COUNT(*) AS count FROM chat_unread_counters")
+    changed['chat_unread_counters'] = cur.fetchone()['count']
+
+    return changed
+
+
+if __name__ == '__main__':
+    try:
+        with app.app_context():
+            cursor = mysql.connection.cursor()
+            changed = repair_unread_counters(cursor)
+            mysql.connection.commit()
+            cursor.close()
+
+            print("✓ Unread counters rebuilt")
+            print(f"  Conversations corrected (teacher chat): {changed['chat_conversations']}")
+            print(f"  Conversations corrected (student chat): {changed['student_conversations']}")
+            print(f"  Participant totals written: {changed['chat_unread_counters']}")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        raise SystemExit(1)
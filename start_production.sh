@@ -73,4 +73,4 @@ echo "============================================"
 echo ""
 
 export FLASK_ENV=production
-gunicorn -w 4 -b 0.0.0.0:5000 --timeout 120 --access-logfile - --error-logfile - app:app
+gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,119 @@
+// Incremental chat history: loads the latest page once, then appends only
+// messages newer than the last one shown (?since_id=) and prepends older
+// pages (?before_id=) when the user scrolls to the top.
+//
+// Usage:
+//     const history = new ChatHistory({
+//         box: document.getElementById('chatMessages'),
+//         renderMessage: (m) => `<div>...</div>`,
+//         emptyHtml: '<div class="no-messages">...</div>'
+//     });
+//     history.open(`/api/chat/messages/${conversationId}`);
+//     history.loadNew();   // e.g. when a chat event arrives
+
+class ChatHistory {
+    constructor({ box, renderMessage, emptyHtml, pageSize = 50 }) {
+        this.box = box;
+        this.renderMessage = renderMessage;
+        this.emptyHtml = emptyHtml;
+        this.pageSize = pageSize;
+        this.url = null;
+        this.firstId = null;
+        this.lastId = null;
+        this.hasOlder = false;
+        // Loads run one at a time so overlapping calls never append twice
+        this.queue = Promise.resolve();
+
+        this.box.addEventListener('scroll', () => {
+            if (this.box.scrollTop === 0 && this.hasOlder) {
+                this.loadOlder();
+            }
+        });
+    }
+
+    open(url) {
+        this.url = url;
+        return this.enqueue(url => this.fetchLatest(url));
+    }
+
+    close() {
+        this.url = null;
+        this.firstId = this.lastId = null;
+        this.hasOlder = false;
+    }
+
+    loadNew() {
+        return this.enqueue(url => this.lastId === null ? this.fetchLatest(url) : this.fetchNew(url));
+    }
+
+    loadOlder() {
+        return this.enqueue(url => this.hasOlder ? this.fetchOlder(url) : []);
+    }
+
+    enqueue(task) {
+        const url = this.url;
+        // Skip work queued for a conversation that is no longer open
+        const run = this.queue.then(() => url && url === this.url ? task(url) : []);
+        this.queue = run.catch(error => console.error('Error loading messages:', error));
+        return run;
+    }
+
+    async fetchPage(url, params) {
+        const query = new URLSearchParams({ limit: this.pageSize, ...params });
+        const response = await fetch(`${url}?${query}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const messages = await response.json();
+        // The conversation may have been switched while waiting
+        return url === this.url ? messages : null;
+    }
+
+    async fetchLatest(url) {
+        const messages = await this.fetchPage(url, {});
+        if (messages === null) return [];
+        this.hasOlder = messages.length === this.pageSize;
+        if (messages.length === 0) {
+            this.firstId = this.lastId = null;
+            this.box.innerHTML = this.emptyHtml;
+            return messages;
+        }
+        this.firstId = messages[0].id;
+        this.lastId = messages[messages.length - 1].id;
+        this.box.innerHTML = messages.map(this.renderMessage).join('');
+        this.box.scrollTop = this.box.scrollHeight;
+        return messages;
+    }
+
+    async fetchNew(url) {
+        const added = [];
+        while (true) {
+            const page = await this.fetchPage(url, { since_id: this.lastId });
+            if (page === null) return added;
+            const messages = page.filter(m => m.id > this.lastId);
+            if (messages.length === 0) break;
+            this.box.insertAdjacentHTML('beforeend', messages.map(this.renderMessage).join(''));
+            this.lastId = messages[messages.length - 1].id;
+            added.push(...messages);
+            if (page.length < this.pageSize) break;
+        }
+        if (added.length > 0) {
+            this.box.scrollTop = this.box.scrollHeight;
+        }
+        return added;
+    }
+
+    async fetchOlder(url) {
+        const messages = await this.fetchPage(url, { before_id: this.firstId });
+        if (messages === null) return [];
+        this.hasOlder = messages.length === this.pageSize;
+        if (messages.length === 0) return messages;
+
+        // Keep the message the user was looking at in place
+        const previousHeight = this.box.scrollHeight;
+        this.box.insertAdjacentHTML('afterbegin', messages.map(this.renderMessage).join(''));
+        this.box.scrollTop = this.box.scrollHeight - previousHeight;
+        this.firstId = messages[0].id;
+        return messages;
+    }
+}
@@ -0,0 +1,115 @@
+// Realtime chat events: server-sent events with a long-polling fallback
+//
+// A worker only keeps a limited number of streams and long-polls open
+// (EVENTS_MAX_WAITERS). Past that the stream is refused with 503 and polls are
+// answered at once with retry_after; the client then polls at that pace and
+// tries the stream again after STREAM_RETRY_MS.
+//
+// Usage:
+//     const realtime = new RealtimeClient({
+//         chat_message: (data) => { ... },
+//         student_chat_message: (data) => { ... }
+//     });
+//     realtime.start();
+
+const STREAM_RETRY_MS = 5 * 60 * 1000;
+
+class RealtimeClient {
+    constructor(handlers) {
+        this.handlers = handlers || {};
+        this.cursor = null;
+        this.failedStreams = 0;
+        this.source = null;
+        this.streamRetryAt = null;  // set while polling because the server was busy
+    }
+
+    start() {
+        if ('EventSource' in window) {
+            this.connectStream();
+        } else {
+            this.longPoll();
+        }
+    }
+
+    connectStream() {
+        let opened = false;
+        // Carry the cursor over from polling so nothing is missed in between
+        this.source = new EventSource(this.cursor === null ? '/api/events' : `/api/events?cursor=${this.cursor}`);
+
+        this.source.onopen = () => {
+            opened = true;
+            this.failedStreams = 0;
+        };
+
+        this.source.onmessage = (event) => {
+            this.dispatch(JSON.parse(event.data));
+        };
+
+        this.source.onerror = () => {
+            // Refused (503 when the server is busy): the browser gives up on
+            // the stream, so poll for a while and try it again later
+            if (this.source.readyState === EventSource.CLOSED) {
+                this.source = null;
+                this.streamRetryAt = Date.now() + STREAM_RETRY_MS;
+                this.longPoll();
+                return;
+            }
+            // EventSource reconnects by itself. If the stream never opens
+            // (blocked or buffered by a proxy), switch to long-polling.
+            if (!opened) {
+                this.failedStreams += 1;
+                if (this.failedStreams >= 3) {
+                    console.warn('Event stream unavailable, falling back to long-polling');
+                    this.source.close();
+                    this.source = null;
+                    this.longPoll();
+                }
+            }
+            opened = false;
+        };
+    }
+
+    dispatch(event) {
+        if (event.id) {
+            this.cursor = event.id;
+        }
+        const handler = this.handlers[event.type];
+        if (handler) {
+            try {
+                handler(event.data);
+            } catch (error) {
+                console.error(`Error handling ${event.type} event:`, error);
+            }
+        }
+    }
+
+    async longPoll() {
+        while (true) {
+            if (this.streamRetryAt !== null && Date.now() >= this.streamRetryAt) {
+                this.streamRetryAt = null;
+                this.connectStream();
+                return;
+            }
+            try {
+                const url = this.cursor === null
+                    ? '/api/events/poll'
+                    : `/api/events/poll?cursor=${this.cursor}`;
+                const response = await fetch(url);
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                const body = await response.json();
+                body.events.forEach(event => this.dispatch(event));
+                this.cursor = body.cursor;
+                if (body.retry_after) {
+                    // Answered without waiting; spread clients out so they don't return together
+                    const delay = body.retry_after * 1000 * (0.75 + Math.random() / 2);
+                    await new Promise(resolve => setTimeout(resolve, delay));
+                }
+            } catch (error) {
+                console.error('Error polling for events:', error);
+                await new Promise(resolve => setTimeout(resolve, 5000));
+            }
+        }
+    }
+}
@@ -70,35 +70,16 @@ class TeacherDashboard {
     }
     
     setupWebSocket() {
-        if ('WebSocket' in window) {
-            const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            const wsUrl = `${protocol}//${window.location.host}/ws/teacher`;
-            
-            try {
-                this.ws = new WebSocket(wsUrl);
-                
-                this.ws.onopen = () => {
-                    console.log('WebSocket connected');
-                };
-                
-                this.ws.onmessage = (event) => {
-                    const data = JSON.parse(event.data);
-                    this.handleWebSocketMessage(data);
-                };
-                
-                this.ws.onclose = () => {
-                    console.log('WebSocket disconnected');
-                    // Attempt to reconnect after 5 seconds
-                    setTimeout(() => this.setupWebSocket(), 5000);
-                };
-                
-                this.ws.onerror = (error) => {
-                    console.error('WebSocket error:', error);
-                };
-            } catch (error) {
-                console.error('Failed to setup WebSocket:', error);
-            }
-        }
+        // Server push runs over server-sent events (see realtime.js);
+        // there is no WebSocket endpoint.
+        if (typeof RealtimeClient === 'undefined') return;
+
+        const handlers = {};
+        ['student_progress', 'quiz_submitted', 'new_student', 'notification'].forEach(type => {
+            handlers[type] = (data) => this.handleWebSocketMessage({ type, data });
+        });
+        this.realtime = new RealtimeClient(handlers);
+        this.realtime.start();
     }
     
     handleWebSocketMessage(data) {
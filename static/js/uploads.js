@@ -0,0 +1,179 @@
+// uploads.js - resumable chunked uploads for the story forms (see uploads.py)
+//
+// File inputs marked data-upload-purpose="story_cover" or "story_page" are
+// sent to /api/uploads in chunks before the form submits. Each input is then
+// disabled and replaced by a hidden field carrying the upload id, named after
+// the input (cover_image -> cover_upload_id, page_image_3 -> page_upload_id_3).
+// A failed chunk is retried from the server's offset; the upload id is kept in
+// localStorage per file until it completes, so a reload or a second attempt
+// resumes as well. A file chosen for several inputs is uploaded once and its
+// id used for each of them.
+// The file's SHA-256 is sent when the session is opened: content the server
+// already stores (see blobs.py) completes at once without sending any chunks.
+
+const ChunkedUploads = (function() {
+    const MAX_RETRIES = 6;
+
+    class FatalUploadError extends Error {}
+
+    function storageKey(purpose, file) {
+        return `chunkedUpload:${purpose}:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    async function requestJson(url, options) {
+        const response = await fetch(url, Object.assign({ credentials: 'same-origin' }, options));
+        let data = null;
+        try {
+            data = await response.json();
+        } catch (e) {
+            // Not JSON (e.g. a proxy error page)
+        }
+        return { response, data };
+    }
+
+    // Hex SHA-256 of the file, or null where WebCrypto is unavailable (plain http)
+    async function fileSha256(file) {
+        if (!window.crypto || !window.crypto.subtle) {
+            return null;
+        }
+        try {
+            const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+        } catch (e) {
+            return null;
+        }
+    }
+
+    async function createSession(purpose, file) {
+        const sha256 = await fileSha256(file);
+        const { response, data } = await requestJson('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ purpose: purpose, filename: file.name, size: file.size, sha256: sha256 })
+        });
+        if (!response.ok || !data || !data.success) {
+            throw new FatalUploadError((data && data.error) || `Could not upload ${file.name}`);
+        }
+        return data.upload;
+    }
+
+    async function loadSession(uploadId) {
+        try {
+            const { response, data } = await requestJson(`/api/uploads/${uploadId}`);
+            return response.ok && data && data.success ? data.upload : null;
+        } catch (e) {
+            return null;
+        }
+    }
+
+    async function sendChunk(upload, file) {
+        const end = Math.min(upload.offset + upload.chunk_size, file.size);
+        const { response, data } = await requestJson(`/api/uploads/${upload.id}`, {
+            method: 'PUT',
+            headers: {
+                'Content-Type': 'application/offset+octet-stream',
+                'Upload-Offset': String(upload.offset)
+            },
+            body: file.slice(upload.offset, end)
+        });
+        if (response.ok && data && data.success) {
+            return data.upload;
+        }
+        const message = (data && data.error) || `Upload of ${file.name} failed (${response.status})`;
+        // 409: out of step with the server (resume from its offset); 5xx: try again
+        if (response.status === 409 || response.status >= 500) {
+            throw new Error(message);
+        }
+        throw new FatalUploadError(message);
+    }
+
+    async function uploadFile(file, purpose, onProgress) {
+        const key = storageKey(purpose, file);
+        let upload = null;
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            upload = await loadSession(savedId);
+            if (upload && upload.status !== 'uploading') {
+                upload = null;
+            }
+        }
+        if (!upload) {
+            upload = await createSession(purpose, file);
+            localStorage.setItem(key, upload.id);
+        }
+
+        let retries = 0;
+        while (upload.status === 'uploading') {
+            try {
+                upload = await sendChunk(upload, file);
+                retries = 0;
+                onProgress(upload.offset / upload.size);
+            } catch (error) {
+                if (error instanceof FatalUploadError || ++retries > MAX_RETRIES) {
+                    localStorage.removeItem(key);
+                    throw error;
+                }
+                await sleep(500 * 2 ** retries);
+                upload = (await loadSession(upload.id)) || upload;
+            }
+        }
+
+        // Finished sessions are attached by the form that sent them, never resumed
+        localStorage.removeItem(key);
+        if (upload.status !== 'complete') {
+            throw new Error(`Upload of ${file.name} failed`);
+        }
+        onProgress(1);
+        return upload.id;
+    }
+
+    // Upload every chosen file in the form; onProgress(done, total, fraction)
+    async function prepareForm(form, onProgress) {
+        const inputs = Array.from(form.querySelectorAll('input[type="file"][data-upload-purpose]'))
+            .filter(input => !input.disabled && input.files.length);
+        const uploaded = new Map();  // storage key -> upload id
+        for (let i = 0; i < inputs.length; i++) {
+            const input = inputs[i];
+            const file = input.files[0];
+            const key = storageKey(input.dataset.uploadPurpose, file);
+            if (!uploaded.has(key)) {
+                uploaded.set(key, await uploadFile(file, input.dataset.uploadPurpose,
+                    fraction => onProgress && onProgress(i, inputs.length, fraction)));
+            }
+            const uploadId = uploaded.get(key);
+
+            const hidden = document.createElement('input');
+            hidden.type = 'hidden';
+            hidden.name = input.name.replace('image', 'upload_id');
+            hidden.value = uploadId;
+            form.appendChild(hidden);
+            input.disabled = true;  // the file itself is not posted again
+        }
+    }
+
+    // Submit handler body shared by the story forms
+    function submitWithUploads(form, button) {
+        const original = button ? button.innerHTML : null;
+        if (button) {
+            button.disabled = true;
+        }
+        prepareForm(form, function(done, total, fraction) {
+            if (button) {
+                button.innerHTML = `<i class="fas fa-spinner fa-spin"></i> Uploading ${done + 1}/${total} (${Math.round(fraction * 100)}%)`;
+            }
+        }).then(() => form.submit()).catch(error => {
+            console.error('Upload error:', error);
+            alert(error.message);
+            if (button) {
+                button.disabled = false;
+                button.innerHTML = original;
+            }
+        });
+    }
+
+    return { uploadFile, prepareForm, submitWithUploads };
+})();
@@ -0,0 +1,321 @@
+# storage.py
+"""Where uploaded files are kept: this machine's disk or an S3-compatible bucket.
+
+Files are addressed by key, '<folder>/<name>' relative to the store (the
+same paths /media serves), e.g. 'story_pages/<sha256>.png' or
+'story_pages/derived/<sha256>.png/w960.jpg'.
+
+    LocalStorage   files under UPLOAD_FOLDER (the default), served by /media
+    S3Storage      objects in a bucket on S3 or anything speaking its API
+                   (MinIO, Ceph, R2, ...), so every app node sees the same
+                   files. Browsers download straight from the bucket with
+                   presigned URLs, or from S3_PUBLIC_URL for a public
+                   bucket/CDN.
+
+Both stream: writes take a file object or a finished local file and never
+hold a whole file in memory, and open() returns a readable stream. Code that
+needs a real path (Pillow and reportlab for PDFs, derivative builds) calls
+local_path(): the file itself for LocalStorage, a read-through copy in
+STORAGE_CACHE_DIR for S3Storage. Keys are not rewritten with different
+bytes (blobs are named by their hash, derivatives are built from them), so
+cached copies are only dropped to keep the cache under its size limit.
+
+boto3 is only needed, and only imported, for S3Storage.
+"""
+import os
+import uuid
+import shutil
+import logging
+import mimetypes
+import threading
+from urllib.parse import quote
+
+from werkzeug.security import safe_join
+
+logger = logging.getLogger(__name__)
+
+COPY_BLOCK = 1024 * 1024
+CACHE_PRUNE_EVERY = 100  # downloads between cache size checks
+DELETE_BATCH = 1000  # most keys one DeleteObjects call accepts
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _content_type(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """Files under a directory on this machine"""
+
+    local = True
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        """Absolute path of a key; ValueError if it would leave the root"""
+        path = safe_join(self.root, key)
+        if path is None:
+            raise ValueError(f'invalid storage key: {key}')
+        return path
+
+    # ---------------------------------------------------------------- reads
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def signature(self, key):
+        """Changes whenever the stored file does ('missing' if there is none)"""
+        try:
+            st = os.stat(self.path(key))
+        except OSError:
+            return 'missing'
+        return f'{st.st_size}:{st.st_mtime_ns}'
+
+    def open(self, key):
+        """Binary stream of a stored file; FileNotFoundError if it is missing"""
+        return open(self.path(key), 'rb')
+
+    def list(self, prefix):
+        """(name, size) of each file directly under prefix/"""
+        directory = self.path(prefix)
+        if not os.path.isdir(directory):
+            return []
+        return [(entry.name, entry.stat().st_size) for entry in os.scandir(directory) if entry.is_file()]
+
+    def local_path(self, key):
+        """Path of the file on this machine, or None if it is missing"""
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def url(self, key):
+        """Direct download URL; None, as local files are served by the app"""
+        return None
+
+    # --------------------------------------------------------------- writes
+    def save(self, key, stream):
+        """Store the rest of a binary stream under key"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, COPY_BLOCK)
+            os.replace(tmp_path, path)
+        finally:
+            _remove(tmp_path)
+
+    def put_file(self, key, local_path):
+        """Store a finished local file, which is moved (not copied) into place"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(local_path, path)
+
+    def delete(self, key):
+        _remove(self.path(key))
+
+    def delete_tree(self, prefix):
+        """Delete every file under prefix/"""
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, with a local read-through cache"""
+
+    local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, public_url='', url_expiry=3600, cache_dir='cache/storage',
+                 cache_max_bytes=1024 * 1024 * 1024):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError('STORAGE_BACKEND=s3 needs boto3 (pip install boto3)')
+        self._boto3 = boto3
+        self._client_config = Config(
+            signature_version='s3v4',
+            # MinIO and most self-hosted services only do path-style bucket URLs
+            s3={'addressing_style': 'path' if endpoint_url else 'auto'},
+            retries={'max_attempts': 5, 'mode': 'standard'},
+        )
+        self._client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.public_url = public_url.rstrip('/')
+        self.url_expiry = url_expiry
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.cache_max_bytes = cache_max_bytes
+        self._client = None
+        self._pid = None
+        self._downloads = 0
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Clients hold pooled connections; never share one with a forked worker
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._boto3.client(
+                    's3', endpoint_url=self.endpoint_url, region_name=self.region,
+                    aws_access_key_id=self.access_key, aws_secret_access_key=self.secret_key,
+                    config=self._client_config)
+                self._pid = os.getpid()
+            return self._client
+
+    def _key(self, key):
+        if safe_join('/', key) is None:
+            raise ValueError(f'invalid storage key: {key}')
+        return self.prefix + key
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except self._client_error as e:
+            if self._missing(e):
+                return None
+            raise
+
+    # ---------------------------------------------------------------- reads
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def signature(self, key):
+        """Changes whenever the stored object does ('missing' if there is none)"""
+        head = self._head(key)
+        if head is None:
+            return 'missing'
+        return f"{head['ContentLength']}:{head['ETag']}"
+
+    def open(self, key):
+        """Binary stream of a stored object; FileNotFoundError if it is missing"""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body']
+        except self._client_error as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def list(self, prefix):
+        """(name, size) of each object directly under prefix/"""
+        base = self._key(prefix.rstrip('/') + '/')
+        paginator = self.client.get_paginator('list_objects_v2')
+        files = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=base, Delimiter='/'):
+            files.extend((item['Key'][len(base):], item['Size']) for item in page.get('Contents', []))
+        return files
+
+    def _cache_path(self, key):
+        return safe_join(self.cache_dir, key)
+
+    def local_path(self, key):
+        """Path of a cached copy on this machine, downloaded if needed; None if missing"""
+        path = self._cache_path(key)
+        if path is None:
+            raise ValueError(f'invalid storage key: {key}')
+        if os.path.isfile(path):
+            try:
+                os.utime(path)  # recently used: pruned last
+            except OSError:
+                pass
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            self.client.download_file(self.bucket, self._key(key), tmp_path)
+            os.replace(tmp_path, path)
+        except self._client_error as e:
+            if self._missing(e):
+                return None
+            raise
+        finally:
+            _remove(tmp_path)
+
+        with self._lock:
+            self._downloads += 1
+            prune = self._downloads % CACHE_PRUNE_EVERY == 0
+        if prune:
+            self.prune_cache()
+        return path
+
+    def prune_cache(self):
+        """Delete the least recently used cached copies beyond cache_max_bytes"""
+        entries = []
+        total = 0
+        for directory, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.cache_max_bytes:
+            return 0
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.cache_max_bytes * 0.9:
+                break
+            _remove(path)
+            total -= size
+            removed += 1
+        logger.info(f"Pruned {removed} file(s) from the storage cache")
+        return removed
+
+    def url(self, key):
+        """Direct download URL: under public_url, or presigned for url_expiry seconds"""
+        if self.public_url:
+            return f'{self.public_url}/{quote(self._key(key))}'
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._key(key)},
+            ExpiresIn=self.url_expiry)
+
+    # --------------------------------------------------------------- writes
+    def save(self, key, stream):
+        """Store the rest of a binary stream under key (multipart for large files)"""
+        self.client.upload_fileobj(stream, self.bucket, self._key(key),
+                                   ExtraArgs={'ContentType': _content_type(key)})
+        _remove(self._cache_path(key))
+
+    def put_file(self, key, local_path):
+        """Upload a finished local file, which then becomes this node's cached copy"""
+        self.client.upload_file(local_path, self.bucket, self._key(key),
+                                ExtraArgs={'ContentType': _content_type(key)})
+        cache_path = self._cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            os.replace(local_path, cache_path)
+        except OSError:
+            _remove(local_path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        _remove(self._cache_path(key))
+
+    def delete_tree(self, prefix):
+        """Delete every object under prefix/"""
+        base = self._key(prefix.rstrip('/') + '/')
+        paginator = self.client.get_paginator('list_objects_v2')
+        keys = [item['Key'] for page in paginator.paginate(Bucket=self.bucket, Prefix=base)
+                for item in page.get('Contents', [])]
+        for start in range(0, len(keys), DELETE_BATCH):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH]], 'Quiet': True})
+        cache_path = self._cache_path(prefix)
+        if cache_path:
+            shutil.rmtree(cache_path, ignore_errors=True)
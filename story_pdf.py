@@ -0,0 +1,484 @@
+# story_pdf.py
+"""Story and quiz PDFs, rendered with reportlab.
+
+app.py imports this module the first time a PDF is rendered (by the PDF
+routes or a story_pdf job), so reportlab and Pillow stay out of web worker
+and script startup. The paragraph styles are built once per process and
+shared by every render; nothing modifies them.
+"""
+import io
+import logging
+from functools import lru_cache
+from types import SimpleNamespace
+
+from PIL import Image as PILImage
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak
+from reportlab.lib.units import inch
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def story_styles():
+    """Paragraph styles of a story PDF, built on first use"""
+    styles = getSampleStyleSheet()
+    
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Title'],
+        fontSize=28,
+        spaceAfter=40,
+        spaceBefore=60,
+        alignment=TA_CENTER,
+        textColor=colors.HexColor('#2C3E50'),
+        fontName='Helvetica-Bold',
+        leading=32 
+    )
+    
+    subtitle_style = ParagraphStyle(
+        'CustomSubtitle',
+        parent=styles['Heading2'],
+        fontSize=16,
+        spaceAfter=20,
+        alignment=TA_CENTER,
+        textColor=colors.HexColor('#7F8C8D')
+    )
+    
+    heading_style = ParagraphStyle(
+        'CustomHeading1',
+        parent=styles['Heading1'],
+        fontSize=18,
+        spaceAfter=12,
+        textColor=colors.HexColor('#3498DB'),
+        fontName='Helvetica-Bold'
+    )
+    
+    heading2_style = ParagraphStyle(
+        'CustomHeading2',
+        parent=styles['Heading2'],
+        fontSize=14,
+        spaceAfter=8,
+        textColor=colors.HexColor('#2C3E50'),
+        fontName='Helvetica-Bold'
+    )
+    
+    normal_style = ParagraphStyle(
+        'CustomNormal',
+        parent=styles['Normal'],
+        fontSize=12,
+        spaceAfter=6,
+        textColor=colors.HexColor('#34495E'),
+        alignment=TA_JUSTIFY
+    )
+    
+    story_text_style = ParagraphStyle(
+        'StoryText',
+        parent=styles['Normal'],
+        fontSize=13,
+        spaceAfter=12,
+        leading=16,
+        alignment=TA_JUSTIFY,
+        textColor=colors.HexColor('#2C3E50')
+    )
+    
+    note_style = ParagraphStyle(
+        'NoteStyle',
+        parent=styles['Normal'],
+        fontSize=11,
+        spaceAfter=6,
+        leftIndent=20,
+        textColor=colors.HexColor('#E74C3C'),
+        fontName='Helvetica-Bold'
+    )
+    
+    question_style = ParagraphStyle(
+        'QuestionStyle',
+        parent=styles['Normal'],
+        fontSize=12,
+        spaceAfter=8,
+        textColor=colors.HexColor('#2C3E50'),
+        fontName='Helvetica-Bold'
+    )
+    
+    option_style = ParagraphStyle(
+        'OptionStyle',
+        parent=styles['Normal'],
+        fontSize=11,
+        spaceAfter=4,
+        leftIndent=20,
+        textColor=colors.HexColor('#34495E')
+    )
+    
+    answer_style = ParagraphStyle(
+        'AnswerStyle',
+        parent=styles['Normal'],
+        fontSize=11,
+        spaceAfter=6,
+        leftIndent=10,
+        textColor=colors.HexColor('#27ae60'),
+        fontName='Helvetica-Bold'
+    )
+    
+    explanation_style = ParagraphStyle(
+        'ExplanationStyle',
+        parent=styles['Normal'],
+        fontSize=10,
+        spaceAfter=6,
+        leftIndent=10,
+        textColor=colors.HexColor('#7f8c8d'),
+        fontStyle='italic'
+    )
+
+    return SimpleNamespace(
+        title=title_style,
+        subtitle=subtitle_style,
+        heading=heading_style,
+        heading2=heading2_style,
+        normal=normal_style,
+        story_text=story_text_style,
+        note=note_style,
+        question=question_style,
+        option=option_style,
+        answer=answer_style,
+        explanation=explanation_style,
+    )
+
+
+class StoryPdfRenderer:
+    """Renders story PDFs, taking images from the upload store (print derivatives first)"""
+
+    def __init__(self, derivatives, storage):
+        self.derivatives = derivatives
+        self.storage = storage
+
+    def image(self, folder, filename, max_width, max_height):
+        """Image flowable fitted to the given box, or None if the file is missing.
+
+        Uses the prebuilt print derivative when there is one; otherwise the
+        original is decoded and re-encoded as JPEG here.
+        """
+        manifest = self.derivatives.manifest(folder, filename)
+        source = self.derivatives.print_path(folder, filename) if manifest else None
+        if source is not None:
+            width, height = manifest['width'], manifest['height']
+        else:
+            # A local copy of the original (downloaded once per node from a remote store)
+            image_path = self.storage.local_path(f'{folder}/{filename}')
+            if image_path is None:
+                return None
+        
+            pil_img = PILImage.open(image_path)
+            width, height = pil_img.size
+        
+            # Convert RGBA to RGB if necessary
+            source = io.BytesIO()
+            if pil_img.mode == 'RGBA':
+                rgb_img = PILImage.new('RGB', pil_img.size, (255, 255, 255))
+                rgb_img.paste(pil_img, mask=pil_img.split()[3])
+                rgb_img.save(source, format='JPEG', quality=90)
+            else:
+                pil_img.save(source, format='JPEG', quality=90)
+            source.seek(0)
+    
+        # Maintain aspect ratio
+        aspect_ratio = width / height
+    
+        if width > max_width:
+            width = max_width
+            height = width / aspect_ratio
+    
+        if height > max_height:
+            height = max_height
+            width = height * aspect_ratio
+    
+        return Image(source, width=width, height=height)
+
+    def render(self, story, pages, quiz, student_questions, answer_key_questions=None):
+        """Generate PDF document for story and quiz; returns a BytesIO"""
+        buffer = io.BytesIO()
+    
+        # Create PDF document
+        doc = SimpleDocTemplate(
+            buffer,
+            pagesize=A4,
+            rightMargin=72,
+            leftMargin=72,
+            topMargin=72,
+            bottomMargin=72,
+            title=story['title']
+        )
+    
+        styles = story_styles()
+    
+        # Build story content
+        story_content = []
+    
+        # Cover page with title
+        story_content.append(Spacer(1, 2*inch))
+        story_content.append(Paragraph(story['title'], styles.title))
+        story_content.append(Spacer(1, 0.5*inch))
+    
+    
+        # Add cover image if exists
+        if story['cover_image'] and story['cover_image'] != 'default_story_image.jpg':
+            try:
+                # Fit within 5x4 inches
+                cover = self.image('stories', story['cover_image'], 5*inch, 4*inch)
+            
+                if cover:
+                    # Add image to PDF
+                    story_content.append(cover)
+                    story_content.append(Spacer(1, 20))
+                else:
+                    logger.warning(f"Cover image not found for story {story['id']}: {story['cover_image']}")
+                    story_content.append(Paragraph("<i>Cover image not available</i>", styles.normal))
+            except Exception as e:
+                logger.error(f"Error loading cover image for story {story['id']}: {str(e)}")
+                story_content.append(Paragraph("<i>Cover image not available</i>", styles.normal))
+    
+        # Story metadata
+        meta_data = [
+            f"<b>Author:</b> {story['first_name']} {story['last_name']}",
+            f"<b>Created:</b> {story['created_at'].strftime('%B %d, %Y')}",
+            f"<b>Status:</b> {'Published' if story['is_published'] else 'Draft'}",
+            f"<b>Total Pages:</b> {len(pages)}"
+        ]
+    
+        for meta in meta_data:
+            story_content.append(Paragraph(meta, styles.normal))
+    
+        story_content.append(Spacer(1, 30))
+    
+        # Story description
+        if story['description']:
+            story_content.append(Paragraph("<b>Story Description:</b>", styles.heading2))
+            story_content.append(Paragraph(story['description'], styles.story_text))
+            story_content.append(Spacer(1, 20))
+    
+        # Page break before story pages
+        story_content.append(PageBreak())
+    
+        # Story pages
+        story_content.append(Paragraph("Story Pages", styles.heading))
+        story_content.append(Spacer(1, 20))
+    
+        for i, page in enumerate(pages, 1):
+            # Page header
+            story_content.append(Paragraph(f"<b>Page {page['page_number']}</b>", styles.heading2))
+            story_content.append(Spacer(1, 10))
+        
+            # Try to add page image if exists
+            if page['image_url'] and page['image_url'] != 'default_page_image.jpg':
+                try:
+                    # Fit within 6x4 inches
+                    page_image = self.image('story_pages', page['image_url'], 6*inch, 4*inch)
+                
+                    if page_image:
+                        # Add image to PDF
+                        story_content.append(page_image)
+                        story_content.append(Spacer(1, 10))
+                except Exception as e:
+                    logger.error(f"Error loading page image {page['image_url']} for story {story['id']}: {str(e)}")
+                    # Don't add placeholder, just continue
+        
+            # Page text content
+            story_content.append(Paragraph("<b>Text Content:</b>", styles.normal))
+            story_content.append(Paragraph(page['text_content'], styles.story_text))
+            story_content.append(Spacer(1, 10))
+        
+            # Important notes (if any)
+            if page['important_notes'] and page['important_notes'].strip():
+                story_content.append(Paragraph("<b>Important Notes:</b>", styles.normal))
+                story_content.append(Paragraph(page['important_notes'], styles.note))
+                story_content.append(Spacer(1, 10))
+        
+            # Add separator between pages
+            if i < len(pages):
+                story_content.append(Spacer(1, 20))
+                # Add page break every 3 pages for better readability
+                if i % 3 == 0:
+                    story_content.append(PageBreak())
+    
+        # Add quiz section if quiz exists
+        if quiz:
+            story_content.append(PageBreak())
+            story_content.append(Paragraph("Quiz Assessment", styles.heading))
+            story_content.append(Spacer(1, 20))
+        
+            # Quiz info
+            quiz_info = [
+                f"<b>Quiz Title:</b> {quiz['title']}",
+                f"<b>Description:</b> {quiz['description'] or 'No description'}",
+                f"<b>Time Limit:</b> {quiz['time_limit'] // 60} minutes",
+                f"<b>Passing Score:</b> {quiz['passing_score']}%",
+                f"<b>Total Questions:</b> {len(student_questions)}"
+            ]
+        
+            for info in quiz_info:
+                story_content.append(Paragraph(info, styles.normal))
+        
+            story_content.append(Spacer(1, 30))
+        
+            # STUDENT VERSION: Quiz questions (ONLY QUESTIONS - NO ANSWERS)
+            if student_questions:
+                story_content.append(Paragraph("<b>Questions (Student Version):</b>", styles.heading2))
+                story_content.append(Paragraph("<i>Answer all questions in the space provided.</i>", styles.normal))
+                story_content.append(Spacer(1, 15))
+            
+                for i, question in enumerate(student_questions, 1):
+                    # Get question type and normalize it
+                    question_type = question.get('question_type', '').lower().strip()
+                
+                    # Determine display type
+                    if 'multiple' in question_type or 'choice' in question_type or question_type == 'mcq':
+                        type_display = 'Multiple Choice'
+                        is_mcq = True
+                    elif 'true' in question_type or 'false' in question_type:
+                        type_display = 'True/False'
+                        is_mcq = False
+                    elif 'short' in question_type or 'answer' in question_type:
+                        type_display = 'Short Answer'
+                        is_mcq = False
+                    else:
+                        type_display = question.get('question_type', 'Question')
+                        is_mcq = False
+                
+                    story_content.append(Paragraph(f"<b>Question {i} ({type_display}) - {question['points']} point(s):</b>", styles.question))
+                
+                    # Question text
+                    story_content.append(Paragraph(question['question_text'], styles.normal))
+                    story_content.append(Spacer(1, 10))
+                
+                    # Options for MCQ (show all options without indicating correct answer)
+                    if is_mcq:
+                        # Check if any options exist
+                        has_options = False
+                    
+                        # Option A
+                        if question.get('option_a'):
+                            option_a = str(question['option_a']).strip()
+                            if option_a:
+                                story_content.append(Paragraph(f"A) {option_a}", styles.option))
+                                has_options = True
+                    
+                        # Option B
+                        if question.get('option_b'):
+                            option_b = str(question['option_b']).strip()
+                            if option_b:
+                                story_content.append(Paragraph(f"B) {option_b}", styles.option))
+                                has_options = True
+                    
+                        # Option C
+                        if question.get('option_c'):
+                            option_c = str(question['option_c']).strip()
+                            if option_c:
+                                story_content.append(Paragraph(f"C) {option_c}", styles.option))
+                                has_options = True
+                    
+                        # Option D
+                        if question.get('option_d'):
+                            option_d = str(question['option_d']).strip()
+                            if option_d:
+                                story_content.append(Paragraph(f"D) {option_d}", styles.option))
+                                has_options = True
+                    
+                        if has_options:
+                            story_content.append(Spacer(1, 10))
+                            story_content.append(Paragraph("Answer: __________", styles.option))
+                        else:
+                            story_content.append(Paragraph("(No options provided)", styles.option))
+                            story_content.append(Paragraph("Answer: __________", styles.option))
+                
+                    # For true/false
+                    elif type_display == 'True/False':
+                        story_content.append(Paragraph("Circle one: True / False", styles.option))
+                
+                    # For short answer
+                    elif type_display == 'Short Answer':
+                        story_content.append(Paragraph("Answer: ___________________________________", styles.option))
+                        story_content.append(Paragraph("_________________________________________", styles.option))
+                
+                    # Add space between questions
+                    if i < len(student_questions):
+                        story_content.append(Spacer(1, 20))
+                    else:
+                        story_content.append(Spacer(1, 30))
+        
+            # Add answer key section (for teachers only)
+            if answer_key_questions:
+                story_content.append(PageBreak())
+                story_content.append(Paragraph("Quiz Answer Key (For Teachers Only)", styles.heading))
+                story_content.append(Spacer(1, 20))
+            
+                # Answer key instructions
+                story_content.append(Paragraph("<b>Note:</b> This section contains the correct answers and explanations.", styles.note))
+                story_content.append(Spacer(1, 20))
+            
+                for i, question in enumerate(answer_key_questions, 1):
+                    # Get question type and normalize it
+                    question_type = question.get('question_type', '').lower().strip()
+                
+                    # Determine display type
+                    if 'multiple' in question_type or 'choice' in question_type or question_type == 'mcq':
+                        type_display = 'Multiple Choice'
+                        is_mcq = True
+                    elif 'true' in question_type or 'false' in question_type:
+                        type_display = 'True/False'
+                        is_mcq = False
+                    elif 'short' in question_type or 'answer' in question_type:
+                        type_display = 'Short Answer'
+                        is_mcq = False
+                    else:
+                        type_display = question.get('question_type', 'Question')
+                        is_mcq = False
+                
+                    story_content.append(Paragraph(f"<b>Question {i} ({type_display}) - {question['points']} point(s):</b>", styles.question))
+                
+                    # Question text
+                    story_content.append(Paragraph(question['question_text'], styles.normal))
+                    story_content.append(Spacer(1, 10))
+                
+                    # Show correct answer
+                    if 'correct_answer' in question and question['correct_answer']:
+                        correct_answer = str(question['correct_answer']).strip()
+                    
+                        if is_mcq:
+                            # Map correct answer to option text
+                            if correct_answer.upper() == 'A':
+                                answer_text = str(question.get('option_a', 'Option A')).strip()
+                                story_content.append(Paragraph(f"<b>Correct Answer:</b> A) {answer_text}", styles.answer))
+                            elif correct_answer.upper() == 'B':
+                                answer_text = str(question.get('option_b', 'Option B')).strip()
+                                story_content.append(Paragraph(f"<b>Correct Answer:</b> B) {answer_text}", styles.answer))
+                            elif correct_answer.upper() == 'C':
+                                answer_text = str(question.get('option_c', 'Option C')).strip()
+                                story_content.append(Paragraph(f"<b>Correct Answer:</b> C) {answer_text}", styles.answer))
+                            elif correct_answer.upper() == 'D':
+                                answer_text = str(question.get('option_d', 'Option D')).strip()
+                                story_content.append(Paragraph(f"<b>Correct Answer:</b> D) {answer_text}", styles.answer))
+                            else:
+                                story_content.append(Paragraph(f"<b>Correct Answer:</b> {correct_answer}", styles.answer))
+                        else:
+                            story_content.append(Paragraph(f"<b>Correct Answer:</b> {correct_answer}", styles.answer))
+                    else:
+                        story_content.append(Paragraph("<b>Correct Answer:</b> Not specified", styles.answer))
+                
+                    # Show explanation if available
+                    if 'explanation' in question and question['explanation']:
+                        explanation = str(question['explanation']).strip()
+                        if explanation:
+                            story_content.append(Paragraph(f"<b>Explanation:</b> {explanation}", styles.explanation))
+                
+                    # Add space between questions
+                    if i < len(answer_key_questions):
+                        story_content.append(Spacer(1, 20))
+    
+        # Build PDF
+        doc.build(story_content)
+    
+        buffer.seek(0)
+        return buffer
@@ -6,6 +6,8 @@ This script simulates production environment and tests error handling.
 
 import requests
 import json
+import base64
+import hashlib
 from datetime import datetime
 import time
 
@@ -80,25 +82,90 @@ class APITester:
         print("TESTING DRAWING ENDPOINTS")
         print("="*60)
         
-        # Test save_student_drawing
+        # Test save_student_drawing (raw PNG snapshot)
+        png_1x1 = base64.b64decode(
+            'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+        )
+        
+        response = self.session.post(
+            f"{self.base_url}/api/save_student_drawing?story_id=1",
+            data=png_1x1,
+            headers={'Content-Type': 'image/png'}
+        )
+        
+        generation = None
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                generation = data.get('generation')
+                self.log_test("Save Student Drawing", "PASS", f"Generation: {generation}")
+            else:
+                self.log_test("Save Student Drawing", "FAIL", f"Error: {data.get('error')}")
+        else:
+            self.log_test("Save Student Drawing", "FAIL", f"Status: {response.status_code}")
+        
+        if generation is None:
+            return
+        
+        # Test append_student_drawing_strokes
         payload = {
             'story_id': 1,
-            'drawing_data': 'data:image/png;base64,iVBORw0KGgo...'
+            'generation': generation,
+            'strokes': [{'t': 'path', 'c': '#000000', 'w': 5, 'p': [10, 10, 20, 20]}]
         }
         
         response = self.session.post(
-            f"{self.base_url}/api/save_student_drawing",
+            f"{self.base_url}/api/append_student_drawing_strokes",
             json=payload
         )
         
+        if response.status_code == 200 and response.json().get('success'):
+            self.log_test("Append Drawing Strokes", "PASS", f"Strokes: {response.json().get('stroke_count')}")
+        else:
+            self.log_test("Append Drawing Strokes", "FAIL", f"Status: {response.status_code}")
+        
+        # Test student_drawing_image with ETag revalidation
+        response = self.session.get(f"{self.base_url}/api/student_drawing_image?story_id=1")
+        etag = response.headers.get('ETag')
+        
+        if response.status_code == 200 and response.headers.get('Content-Type') == 'image/png' and etag:
+            response = self.session.get(
+                f"{self.base_url}/api/student_drawing_image?story_id=1",
+                headers={'If-None-Match': etag}
+            )
+            if response.status_code == 304:
+                self.log_test("Drawing Image ETag", "PASS", f"ETag: {etag}")
+            else:
+                self.log_test("Drawing Image ETag", "FAIL", f"Expected 304, got {response.status_code}")
+        else:
+            self.log_test("Drawing Image", "FAIL", f"Status: {response.status_code}")
+    
+    def test_story_page_endpoint(self):
+        """Test the single-page story reader API"""
+        print("\n" + "="*60)
+        print("TESTING STORY PAGE ENDPOINT")
+        print("="*60)
+        
+        response = self.session.get(f"{self.base_url}/api/story/1/page/1")
+        
         if response.status_code == 200:
             data = response.json()
-            if data.get('success'):
-                self.log_test("Save Student Drawing", "PASS", f"Status: {response.status_code}")
+            if data.get('success') and data.get('page') and data.get('number') == 1:
+                preload = 'rel=preload' in response.headers.get('Link', '')
+                self.log_test("Get Story Page", "PASS",
+                              f"Pages: {data.get('total_pages')}, next image preload: {preload}")
             else:
-                self.log_test("Save Student Drawing", "FAIL", f"Error: {data.get('error')}")
+                self.log_test("Get Story Page", "FAIL", f"Unexpected response: {data}")
         else:
-            self.log_test("Save Student Drawing", "FAIL", f"Status: {response.status_code}")
+            self.log_test("Get Story Page", "FAIL", f"Status: {response.status_code}")
+        
+        # Past the last page
+        response = self.session.get(f"{self.base_url}/api/story/1/page/100000")
+        
+        if response.status_code == 404:
+            self.log_test("Story Page Out Of Range", "PASS", f"Status: {response.status_code}")
+        else:
+            self.log_test("Story Page Out Of Range", "FAIL", f"Expected 404, got {response.status_code}")
     
     def test_chat_endpoints(self):
         """Test chat API endpoints"""
@@ -135,6 +202,55 @@ class APITester:
         else:
             self.log_test("Get Classmates", "FAIL", f"Status: {response.status_code}")
     
+    def test_chunked_upload(self):
+        """Test the resumable upload API: out-of-order chunk, resume, completion"""
+        print("\n" + "="*60)
+        print("TESTING CHUNKED UPLOADS")
+        print("="*60)
+        
+        content = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 40
+        response = self.session.post(
+            f"{self.base_url}/api/uploads",
+            json={'purpose': 'story_page', 'filename': 'test_page.png', 'size': len(content)}
+        )
+        if response.status_code != 201:
+            self.log_test("Create Upload", "FAIL", f"Status: {response.status_code}")
+            return
+        upload = response.json()['upload']
+        self.log_test("Create Upload", "PASS", f"Upload: {upload['id']}")
+        
+        url = f"{self.base_url}/api/uploads/{upload['id']}"
+        half = len(content) // 2
+        response = self.session.put(url, data=content[half:], headers={'Upload-Offset': str(half)})
+        if response.status_code == 409 and response.json().get('offset') == 0:
+            self.log_test("Reject Out-of-Order Chunk", "PASS", "409 with offset 0")
+        else:
+            self.log_test("Reject Out-of-Order Chunk", "FAIL", f"Status: {response.status_code}")
+        
+        self.session.put(url, data=content[:half], headers={'Upload-Offset': '0'})
+        offset = self.session.get(url).json()['upload']['offset']
+        response = self.session.put(url, data=content[offset:], headers={'Upload-Offset': str(offset)})
+        if response.status_code == 200:
+            data = response.json()['upload']
+            if data['status'] == 'complete' and data['sha256'] == hashlib.sha256(content).hexdigest():
+                self.log_test("Resume and Complete Upload", "PASS", f"Resumed at {offset}")
+            else:
+                self.log_test("Resume and Complete Upload", "FAIL", f"Upload: {data}")
+        else:
+            self.log_test("Resume and Complete Upload", "FAIL", f"Status: {response.status_code}")
+
+        # The same content again is recognised by its hash and needs no chunks
+        response = self.session.post(
+            f"{self.base_url}/api/uploads",
+            json={'purpose': 'story_page', 'filename': 'copy_of_page.png', 'size': len(content),
+                  'sha256': hashlib.sha256(content).hexdigest()}
+        )
+        data = response.json().get('upload', {}) if response.status_code == 201 else {}
+        if data.get('status') == 'complete' and data.get('duplicate'):
+            self.log_test("Detect Duplicate Upload", "PASS", f"Upload: {data['id']}")
+        else:
+            self.log_test("Detect Duplicate Upload", "FAIL", f"Status: {response.status_code}, upload: {data}")
+
     def test_error_handling(self):
         """Test error handling with invalid parameters"""
         print("\n" + "="*60)
@@ -215,6 +331,7 @@ def main():
         # Test student endpoints
         if tester.login_student():
             tester.test_drawing_endpoints()
+            tester.test_story_page_endpoint()
             tester.test_chat_endpoints()
             tester.test_classmates_endpoint()
             tester.test_error_handling()
@@ -223,6 +340,7 @@ def main():
         tester.session.clear()
         if tester.login_teacher():
             tester.test_chat_endpoints()
+            tester.test_chunked_upload()
         
         # Test production simulation
         tester.test_production_simulation()
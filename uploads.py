@@ -0,0 +1,277 @@
+# uploads.py
+"""Resumable, chunked uploads for story media.
+
+A multipart story form is spooled whole by Werkzeug before the view runs, and
+a dropped connection loses all of it. Instead the browser creates an upload
+session, then sends the file as raw chunks (PUT with an Upload-Offset header)
+that are streamed straight into `<final name>.part` in the upload folder and
+hashed (SHA-256) as they arrive. After an interruption the client asks for
+the session's offset and carries on from there. The last chunk hands the
+.part file to the blob store (see blobs.py), which renames it to its content
+address (no copy) or drops it if that content is already stored, and the
+story form then refers to the finished upload by id. A session opened with
+the sha256 of content that is already stored is complete at once, and the
+client sends no chunks at all.
+
+Chunks for one session are serialized with a row lock on the `uploads` row.
+The running hash is kept per process; a chunk that lands on a process whose
+hash is not at the right offset re-reads the part file once to catch up.
+Part files live in the local UPLOAD_FOLDER even with a remote store, so
+with several app nodes /api/uploads/<id> needs session affinity (or a
+shared UPLOAD_FOLDER); only finished files go to the store.
+"""
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+# purpose -> (folder under UPLOAD_FOLDER, file type checked by allowed_file)
+UPLOAD_PURPOSES = {
+    'story_cover': ('stories', 'image'),
+    'story_page': ('story_pages', 'image'),
+}
+
+COPY_BLOCK = 64 * 1024
+MAX_HASH_STATES = 256  # running hashes kept per process
+
+
+class UploadConflict(Exception):
+    """A chunk was sent for an offset other than the session's current one"""
+
+    def __init__(self, offset):
+        super().__init__(f'upload is at offset {offset}')
+        self.offset = offset
+
+
+class UploadStore:
+    """Upload sessions in the `uploads` table, files in UPLOAD_FOLDER/<folder>/"""
+
+    def __init__(self, upload_folder, blobs, chunk_size=4 * 1024 * 1024, max_bytes=100 * 1024 * 1024,
+                 session_hours=24):
+        self.upload_folder = upload_folder
+        self.blobs = blobs
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.session_hours = session_hours
+        self._hashes = OrderedDict()  # upload id -> (offset, hash object)
+        self._lock = threading.Lock()
+
+    def part_path(self, upload):
+        """Local file the chunks go to; the finished file is handed to the blob store"""
+        folder, _ = UPLOAD_PURPOSES[upload['purpose']]
+        return os.path.join(self.upload_folder, folder, upload['stored_name'] + '.part')
+
+    # ------------------------------------------------------------- sessions
+    def create(self, cur, created_by, purpose, filename, size, sha256=None):
+        """Open an upload session; the caller checks the file type for the purpose"""
+        if purpose not in UPLOAD_PURPOSES:
+            raise ValueError('unknown upload purpose')
+        if not isinstance(size, int) or size <= 0:
+            raise ValueError('size must be a positive number of bytes')
+        if size > self.max_bytes:
+            raise ValueError(f'files are limited to {self.max_bytes // (1024 * 1024)} MB')
+        if sha256 is not None:
+            sha256 = str(sha256).lower()
+            if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+                raise ValueError('sha256 must be 64 hex digits')
+
+        upload_id = uuid.uuid4().hex
+        folder, _ = UPLOAD_PURPOSES[purpose]
+        existing = sha256 and self.blobs.reuse(cur, folder, sha256, size, filename)
+        if existing:
+            # Already stored: nothing to send
+            cur.execute("""
+                INSERT INTO uploads (id, created_by, purpose, original_name, stored_name,
+                                     total_bytes, received_bytes, expected_sha256, sha256, status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'complete')
+            """, (upload_id, created_by, purpose, filename[:255], existing, size, size, sha256, sha256))
+            upload = self.get(cur, upload_id, created_by)
+            upload['duplicate'] = True
+            logger.info(f"Upload {upload_id} matched stored blob {folder}/{existing}")
+            return upload
+
+        stored_name = f"{upload_id}_{secure_filename(filename) or 'upload'}"
+        cur.execute("""
+            INSERT INTO uploads (id, created_by, purpose, original_name, stored_name,
+                                 total_bytes, expected_sha256)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (upload_id, created_by, purpose, filename[:255], stored_name[:255], size, sha256))
+        os.makedirs(os.path.join(self.upload_folder, folder), exist_ok=True)
+        return self.get(cur, upload_id, created_by)
+
+    def get(self, cur, upload_id, created_by, for_update=False):
+        """A session owned by created_by, or None"""
+        cur.execute(f"""
+            SELECT * FROM uploads
+            WHERE id = %s AND created_by = %s
+            {'FOR UPDATE' if for_update else ''}
+        """, (upload_id, created_by))
+        return cur.fetchone()
+
+    # --------------------------------------------------------------- chunks
+    def append(self, cur, upload_id, created_by, offset, stream, length):
+        """Write one chunk at `offset` from a stream of `length` bytes.
+
+        Returns the updated session, or None if it does not exist. Runs in the
+        caller's transaction, which must be committed afterwards; the session
+        row stays locked until then.
+        """
+        upload = self.get(cur, upload_id, created_by, for_update=True)
+        if upload is None:
+            return None
+        if upload['status'] != 'uploading':
+            raise UploadConflict(upload['received_bytes'])
+        if offset != upload['received_bytes']:
+            raise UploadConflict(upload['received_bytes'])
+        if length <= 0 or length > self.chunk_size:
+            raise ValueError(f'chunks must be 1 to {self.chunk_size} bytes')
+        if offset + length > upload['total_bytes']:
+            raise ValueError('chunk runs past the declared file size')
+
+        part_path = self.part_path(upload)
+        digest = self._hash_at(upload_id, part_path, offset)
+        written = 0
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            # Drop bytes from an earlier chunk that never got recorded
+            f.truncate(offset)
+            f.seek(offset)
+            while written < length:
+                block = stream.read(min(COPY_BLOCK, length - written))
+                if not block:
+                    break
+                f.write(block)
+                digest.update(block)
+                written += len(block)
+            f.flush()
+            os.fsync(f.fileno())
+        if written != length:
+            raise ValueError(f'chunk ended after {written} of {length} bytes')
+
+        received = offset + written
+        if received < upload['total_bytes']:
+            cur.execute("UPDATE uploads SET received_bytes = %s WHERE id = %s", (received, upload_id))
+            self._remember_hash(upload_id, received, digest)
+            upload['received_bytes'] = received
+            return upload
+
+        # Last chunk: check the hash and store the file under it
+        self._forget_hash(upload_id)
+        sha256 = digest.hexdigest()
+        if upload['expected_sha256'] and upload['expected_sha256'] != sha256:
+            cur.execute("UPDATE uploads SET received_bytes = %s, sha256 = %s, status = 'failed' WHERE id = %s",
+                        (received, sha256, upload_id))
+            self._remove(part_path)
+            upload.update(received_bytes=received, sha256=sha256, status='failed')
+            return upload
+        folder, _ = UPLOAD_PURPOSES[upload['purpose']]
+        stored_name, duplicate = self.blobs.adopt(cur, folder, part_path, sha256, received,
+                                                  upload['original_name'])
+        cur.execute("""
+            UPDATE uploads SET received_bytes = %s, sha256 = %s, stored_name = %s, status = 'complete'
+            WHERE id = %s
+        """, (received, sha256, stored_name, upload_id))
+        upload.update(received_bytes=received, sha256=sha256, stored_name=stored_name,
+                      status='complete', duplicate=duplicate)
+        logger.info(f"Upload {upload_id} complete ({received} bytes{', duplicate' if duplicate else ''})")
+        return upload
+
+    def _hash_at(self, upload_id, part_path, offset):
+        """A hash of the part file's first `offset` bytes (a copy, safe to extend)"""
+        with self._lock:
+            state = self._hashes.get(upload_id)
+            if state is not None and state[0] == offset:
+                self._hashes.move_to_end(upload_id)
+                return state[1].copy()
+        digest = hashlib.sha256()
+        if offset:
+            remaining = offset
+            with open(part_path, 'rb') as f:
+                while remaining:
+                    block = f.read(min(COPY_BLOCK, remaining))
+                    if not block:
+                        raise ValueError('partial upload is missing on the server; start again')
+                    digest.update(block)
+                    remaining -= len(block)
+        return digest
+
+    def _remember_hash(self, upload_id, offset, digest):
+        with self._lock:
+            self._hashes[upload_id] = (offset, digest)
+            self._hashes.move_to_end(upload_id)
+            while len(self._hashes) > MAX_HASH_STATES:
+                self._hashes.popitem(last=False)
+
+    def _forget_hash(self, upload_id):
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+
+    # ----------------------------------------------------------- attaching
+    def attach(self, cur, upload_id, created_by, purpose):
+        """Stored file name of a finished upload, now owned by the caller's row (same transaction).
+
+        An upload its creator has already attached can be attached again (the
+        same image on two pages): the file is a blob, so rows can share it.
+        """
+        cur.execute("""
+            SELECT status, stored_name FROM uploads
+            WHERE id = %s AND created_by = %s AND purpose = %s
+            FOR UPDATE
+        """, (upload_id, created_by, purpose))
+        upload = cur.fetchone()
+        if not upload or upload['status'] not in ('complete', 'attached'):
+            raise ValueError(f'upload {upload_id} is not a finished {purpose} upload')
+        if upload['status'] == 'complete':
+            cur.execute("UPDATE uploads SET status = 'attached' WHERE id = %s", (upload_id,))
+        return upload['stored_name']
+
+    # ------------------------------------------------------------- cleanup
+    def purge_expired(self, cur, limit=50):
+        """Delete sessions never attached within session_hours; returns the count.
+
+        Partial files go with them; finished files are blobs, reclaimed by the
+        blob store's garbage collection once nothing refers to them.
+        """
+        cur.execute("""
+            SELECT * FROM uploads
+            WHERE status IN ('uploading', 'complete', 'failed')
+              AND updated_at < NOW() - INTERVAL %s HOUR
+            LIMIT %s
+        """, (self.session_hours, limit))
+        expired = cur.fetchall()
+        for upload in expired:
+            if upload['status'] == 'uploading':
+                self._remove(self.part_path(upload))
+            self._forget_hash(upload['id'])
+        if expired:
+            placeholders = ', '.join(['%s'] * len(expired))
+            cur.execute(f"DELETE FROM uploads WHERE id IN ({placeholders})",
+                        [upload['id'] for upload in expired])
+        return len(expired)
+
+    def payload(self, upload):
+        """JSON view of a session for the client"""
+        return {
+            'id': upload['id'],
+            'purpose': upload['purpose'],
+            'filename': upload['original_name'],
+            'size': upload['total_bytes'],
+            'offset': upload['received_bytes'],
+            'status': upload['status'],
+            'sha256': upload['sha256'],
+            'duplicate': bool(upload.get('duplicate')),
+            'chunk_size': self.chunk_size
+        }
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+